@@ -15,17 +15,15 @@ Issues
 '''
 
 import argparse
-import textwrap
-from openai import OpenAI
-
-client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
 import os
+import sys
+import textwrap
 import time
 
 from datetime import datetime, timedelta, timezone
 
-# Set the API key and model
-
+import clients
+from scheduler import get_scheduler
 
 
 _print = print
@@ -43,18 +41,52 @@ def get_args():
     parser.add_argument("-l", "--list-models", help="List available models", action="store_true")
     parser.add_argument("-t", "--temperature", help="Set the model's temperature from 0 to 1. 0 is more predictable; 1 more creative", type=float, default=0.6)
     parser.add_argument("-m", "--model", help="Select the model to use", default="text-davinci-003")
+    parser.add_argument("--batch", help="Complete the prompts in a JSONL file ('-' for stdin) instead of prompting")
+    parser.add_argument("-o", "--output", help="JSONL file batch results are appended to ('-' for stdout)",
+                        default="-")
+    parser.add_argument("-j", "--jobs", help="Requests made concurrently in batch mode", type=int, default=4)
+    parser.add_argument("-p", "--pack", help="Prompts sent in each completion request in batch mode (up to 20)",
+                        type=int, default=8)
 
     return parser.parse_args()
 
 def list_models():
     '''List the various model types - current flat, but would be interesting to show hierarchy'''
-    models = client.models.list()
+    models = clients.openai_client().models.list()
 #    print(models)
 
     for model in models["data"]:
         print(model["id"])
     print()
 
+# Maximum tokens generated for each prompt
+MAX_TOKENS = 1024
+
+
+def complete(model, prompts, temperature):
+    """Complete a list of prompts in a single request, returning the completion text of each"""
+    client = clients.openai_client()
+    completions = get_scheduler().call(model, lambda: client.completions.with_raw_response.create(
+        model=model, prompt=prompts, max_tokens=MAX_TOKENS, n=1, stop=None, temperature=temperature),
+        sum(len(prompt) // 4 + MAX_TOKENS for prompt in prompts))
+    # Choices aren't necessarily in prompt order; with n=1 the index is the prompt's position
+    texts = [None] * len(prompts)
+    for choice in completions.choices:
+        texts[choice.index] = choice.text
+    return texts
+
+
+def run_batch(args):
+    """Complete each prompt in a batch file, packing several into each request"""
+    import batch
+
+    def answer(jobs):
+        texts = complete(args.model, [job["prompt"] for job in jobs], args.temperature)
+        return [{"response": text} for text in texts]
+
+    return batch.run_file(args.batch, args.output, answer, args.jobs, min(args.pack, 20))
+
+
 def main():
 
     args = get_args()
@@ -62,13 +94,14 @@ def main():
     if args.list_models == True:
         list_models()
 
+    if args.batch:
+        sys.exit(0 if run_batch(args) else 1)
+
     while True:
         # Set the prompt and generate text
         prompt = input('openai> ')
         #prompt = "What is the best way to work out the value of PI"
-        completions = client.completions.create(engine=args.model, prompt=prompt, max_tokens=1024, n=1, stop=None,
-                                               temperature=args.temperature)
-        message = completions.choices[0].text
+        message = complete(args.model, [prompt], args.temperature)[0]
 
         paragraph = str.splitlines(message)
         for lines in paragraph:
@@ -1,62 +1,62 @@
 #!/bin/bash
 
-APP_PATH_DISCORD=/home/wastedye/python/openai/discordbot.py
-APP_PATH_SLACK=/home/wastedye/python/openai/slackbot.py
-APP_NAME_DISCORD=discordbot
-APP_NAME_SLACK=slackbot
+# Runs the Discord and Slack bots together in one process (see botruntime.py),
+# from the directory this script is in
+APP_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+APP_PATH="$APP_DIR/botruntime.py"
+APP_NAME=botruntime
+
+# Seconds stop waits for the bots to answer the messages they have already received
+STOP_TIMEOUT=120
 
 # Start the application
 start() {
-    echo "Starting $APP_NAME_DISCORD ..."
-#    /home/wastedye/virtualenv/python/discord-bot/3.10/bin/python3.10_bin "$APP_PATH_DISCORD" &
-    "$APP_PATH_DISCORD" &
-    echo "Starting $APP_NAME_SLACK ..."
-#    /home/wastedye/virtualenv/python/discord-bot/3.10/bin/python3.10_bin "$APP_PATH_SLACK" &
-    "$APP_PATH_SLACK" &
+    echo "Starting $APP_NAME ..."
+    # The bots write their logs and chats relative to the working directory
+    (cd "$APP_DIR" && "$APP_PATH" "$@" &)
 }
 
 # Stop the application
 stop() {
-    echo "Stopping $APP_NAME_DISCORD ..."
-    pkill -f "$APP_PATH_DISCORD"
-    echo "Stopping $APP_NAME_SLACK ..."
-    pkill -f "$APP_PATH_SLACK"
+    echo "Stopping $APP_NAME ..."
+    pkill -f "$APP_PATH"
+    # Wait while queued messages are answered (by the worker processes, with --processes) and chats are saved
+    for i in $(seq "$STOP_TIMEOUT"); do
+        pgrep -f "$APP_PATH" > /dev/null 2>&1 || return 0
+        sleep 1
+    done
+    echo "$APP_NAME is still running after $STOP_TIMEOUT seconds"
 }
 
 # Check if the application is running
 status() {
-    pgrep -f "$APP_PATH_DISCORD" > /dev/null 2>&1
-    if [ $? -eq 0 ]; then
-        echo "$APP_NAME_DISCORD is running"
-    else
-        echo "$APP_NAME_DISCORD is not running"
-    fi
-
-    pgrep -f "$APP_PATH_SLACK" > /dev/null 2>&1
+    pgrep -f "$APP_PATH" > /dev/null 2>&1
     if [ $? -eq 0 ]; then
-        echo "$APP_NAME_SLACK is running"
+        echo "$APP_NAME is running"
     else
-        echo "$APP_NAME_SLACK is not running"
+        echo "$APP_NAME is not running"
     fi
 }
 
-# Parse command line arguments
-case "$1" in
+# Parse command line arguments; anything after the command is passed to botruntime.py
+command="$1"
+shift
+case "$command" in
     start)
-        start
+        start "$@"
         ;;
     stop)
         stop
         ;;
     restart)
         stop
-        start
+        start "$@"
         ;;
     status)
         status
         ;;
     *)
-        echo "Usage: $0 {start|stop|restart|status}"
+        echo "Usage: $0 {start|stop|restart|status} [botruntime.py options]"
         exit 1
         ;;
 esac
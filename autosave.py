@@ -0,0 +1,72 @@
+"""Write-behind autosave of live conversations
+
+The bot frontends mark a conversation dirty after each turn. A background
+thread saves the dirty conversations to the chat store every interval, or
+sooner once enough are waiting, so saving never adds latency to a turn. As
+saves only write new turns, flushing a conversation repeatedly is cheap.
+Call stop() on shutdown to flush whatever is still waiting.
+"""
+
+import logging
+import threading
+
+log = logging.getLogger('autosave')
+
+
+class AutoSaver:
+    """Background thread saving dirty conversations to a chat store"""
+
+    def __init__(self, chat_store, platform, location, interval=60, threshold=50):
+        """location maps a conversation key to the location keywords passed to the chat store"""
+        self.chat_store = chat_store
+        self.platform = platform
+        self.location = location
+        self.interval = interval
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        # key -> conversation, holding on to evicted conversations until they are saved
+        self.dirty = {}
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, key, conversation):
+        """Note that a conversation has turns that need saving"""
+        with self.lock:
+            self.dirty[key] = conversation
+            count = len(self.dirty)
+        if count >= self.threshold:
+            self.wakeup.set()
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Save all dirty conversations now"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        saved = 0
+        for key, conversation in dirty.items():
+            if not conversation.unsaved_turns():
+                continue
+            try:
+                self.chat_store.save(conversation, self.platform, **self.location(key))
+                saved += 1
+            except Exception:
+                log.exception(f"Autosave of {key} failed")
+                # Try again on the next flush unless the conversation has been marked again since
+                with self.lock:
+                    self.dirty.setdefault(key, conversation)
+        if saved:
+            log.info(f"Autosaved {saved} conversations")
+
+    def stop(self):
+        """Stop the background thread, saving anything still dirty"""
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
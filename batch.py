@@ -0,0 +1,141 @@
+"""Non-interactive batch runs of many prompts
+
+Prompts are read from a JSONL file (or stdin), one job per line: either an
+object with a "prompt" and optionally an "id" and other fields, or just a
+JSON string. Jobs are run concurrently on a bounded pool of threads, and the
+results are written to a JSONL output in input order as soon as they are
+ready, one {"id": ..., "response": ...} or {"id": ..., "error": ...} record
+per job. Rerunning with the same output file skips the jobs that already
+have a response there, so a failed or interrupted run can be resumed.
+
+Jobs can be packed several to a request for APIs that take lists of prompts;
+the handler is always passed a list of jobs and returns a result for each.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import sys
+
+log = logging.getLogger('batch')
+
+
+def read_jobs(file):
+    """Yield the jobs in a JSONL file, numbering any without an id by line"""
+    for number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        job = json.loads(line)
+        if isinstance(job, str):
+            job = {"prompt": job}
+        job.setdefault("id", number)
+        yield job
+
+
+def finished_ids(path):
+    """Return the ids of the jobs with a response in an existing output file"""
+    finished = set()
+    if path == "-" or not os.path.exists(path):
+        return finished
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Most likely the last line of an interrupted run
+                continue
+            if "error" not in record:
+                finished.add(record["id"])
+    return finished
+
+
+def drop_partial_line(path):
+    """Truncate an output file after its last complete line
+
+    A run interrupted while writing a result leaves it half written; the next
+    result would be appended to it, and neither could be read back"""
+    if path == "-" or not os.path.exists(path):
+        return
+    with open(path, "rb+") as file:
+        end = position = file.seek(0, os.SEEK_END)
+        keep = 0
+        while position > 0:
+            start = max(0, position - 65536)
+            file.seek(start)
+            newline = file.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                keep = start + newline + 1
+                break
+            position = start
+        if keep < end:
+            log.warning(f"Dropping the incomplete last line of {path}")
+            file.truncate(keep)
+
+
+def groups(jobs, size):
+    """Yield lists of up to size jobs"""
+    group = []
+    for job in jobs:
+        group.append(job)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def run(jobs, handle, output, workers=8, pack=1):
+    """Run handle on groups of up to pack jobs, writing the results to output in order
+
+    Returns the number of jobs that succeeded and failed"""
+    succeeded = failed = 0
+    # Groups submitted but not yet written, oldest first; bounded so a huge input isn't read all at once
+    window = deque()
+
+    def write_next():
+        nonlocal succeeded, failed
+        group, future = window.popleft()
+        try:
+            results = future.result()
+        except Exception as error:
+            log.warning(f"Jobs {[job['id'] for job in group]} failed: {error}")
+            results = [{"error": str(error)}] * len(group)
+        for job, result in zip(group, results):
+            output.write(json.dumps(dict(result, id=job["id"])) + "\n")
+            if "error" in result:
+                failed += 1
+            else:
+                succeeded += 1
+        output.flush()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+        for group in groups(jobs, pack):
+            window.append((group, executor.submit(handle, group)))
+            while len(window) > workers * 2 or (window and window[0][1].done()):
+                write_next()
+        while window:
+            write_next()
+    return succeeded, failed
+
+
+def run_file(input_path, output_path, handle, workers=8, pack=1):
+    """Run the jobs in input_path ("-" for stdin), appending the results to output_path ("-" for stdout)
+
+    Jobs already answered in output_path are skipped"""
+    drop_partial_line(output_path)
+    finished = finished_ids(output_path)
+    infile = sys.stdin if input_path == "-" else open(input_path)
+    outfile = sys.stdout if output_path == "-" else open(output_path, "a")
+    try:
+        jobs = (job for job in read_jobs(infile) if job["id"] not in finished)
+        succeeded, failed = run(jobs, handle, outfile, workers, pack)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    print(f"{succeeded} succeeded, {failed} failed, {len(finished)} already done", file=sys.stderr)
+    return failed == 0
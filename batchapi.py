@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""Run bulk, non-urgent chat requests through the OpenAI Batch API
+
+The Batch API answers requests within 24 hours at a lower price, and outside
+the live rate limits. This tool works in four steps:
+
+* export - write Batch API request JSONL for saved chats (from the chat store,
+           or legacy JSON chat files, which are imported into the store first)
+           and for prompt files in the JSONL format used by batch mode
+* submit - upload a request file and start a batch
+* poll   - wait for a batch to finish and download its results
+* merge  - add the replies in a results file to the chats they answer,
+           creating a chat for each prompt, and save them in the store
+
+Files are read and written a line at a time, so they can be much larger than
+memory. Set OPENAI_BASE_URL to try it against benchmarks/fakeopenai.py.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import batch
+import chatai
+import chatstore
+import clients
+
+log = logging.getLogger('batchapi')
+
+ENDPOINT = "/v1/chat/completions"
+
+# Batch statuses after which nothing more will happen
+FINISHED = {"completed", "failed", "expired", "cancelled"}
+
+
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description="Run chat requests through the OpenAI Batch API",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-f", "--directory", help="Directory chats are stored in", default="chats")
+    parser.add_argument("--backend", help="How chats are stored", choices=chatstore.BACKENDS, default="sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Write a Batch API request file",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    export.add_argument("output", help="Request file to write")
+    export.add_argument("--chat", help="Id of a saved chat to continue (may be repeated)", action="append",
+                        default=[])
+    export.add_argument("--platform", help="Continue the saved chats from this platform")
+    export.add_argument("--limit", help="Maximum saved chats exported with --platform", type=int, default=1000)
+    export.add_argument("--legacy", help="Legacy JSON chat file to import and continue (may be repeated)",
+                        action="append", default=[])
+    export.add_argument("--prompts", help="JSONL prompt file to answer, as used by --batch")
+    export.add_argument("-p", "--prompt", help="Follow-up message added to each saved chat; without it only chats "
+                                               "ending with an unanswered user message are exported")
+    export.add_argument("-m", "--model", help="Select the model to use", default="gpt-4")
+    export.add_argument("-t", "--temperature", help="Set the model's temperature from 0 to 1", type=float,
+                        default=0.6)
+    export.add_argument("-r", "--role", help="System role for prompts", default="You are a helpful assistant")
+
+    submit = commands.add_parser("submit", help="Upload a request file and start a batch")
+    submit.add_argument("requests", help="Request file written by export")
+
+    poll = commands.add_parser("poll", help="Wait for a batch to finish and download the results",
+                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    poll.add_argument("batch_id", help="Batch id printed by submit")
+    poll.add_argument("output", help="Results file to write")
+    poll.add_argument("-i", "--interval", help="Seconds between status checks", type=float, default=60)
+
+    merge = commands.add_parser("merge", help="Save the replies in a results file to the chat store")
+    merge.add_argument("requests", help="Request file written by export")
+    merge.add_argument("results", help="Results file written by poll")
+
+    return parser.parse_args()
+
+
+def request_line(custom_id, model, messages, temperature):
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": ENDPOINT,
+                       "body": {"model": model, "messages": messages, "temperature": temperature}}) + "\n"
+
+
+def chat_requests(store, chat_ids, args):
+    """Yield a request continuing each saved chat"""
+    budget = chatai.token_budget(args.model)
+    for chat_id in chat_ids:
+        conversation = store.load(chat_id)
+        if conversation is None:
+            log.warning(f"No saved chat {chat_id}")
+            continue
+        if args.prompt:
+            conversation.add_turn("user", args.prompt)
+        elif not conversation.turns or conversation.turns[-1].role != "user":
+            continue
+        yield request_line(f"chat-{conversation.chat_id}", args.model, conversation.to_message(budget),
+                           args.temperature)
+
+
+def export(store, args):
+    """Write a request for each chat and prompt, returning the number written"""
+    chat_ids = list(args.chat)
+    if args.platform:
+        chat_ids += [chat["id"] for chat in store.find(platform=args.platform, limit=args.limit)]
+    for path in args.legacy:
+        with open(path) as file:
+            conversation = chatai.Conversation.from_dict(json.load(file))
+        chat_ids.append(store.save(conversation, "cli", thread=os.path.basename(path)))
+
+    count = 0
+    with open(args.output, "w") as output:
+        for line in chat_requests(store, chat_ids, args):
+            output.write(line)
+            count += 1
+        if args.prompts:
+            with open(args.prompts) as prompts:
+                for job in batch.read_jobs(prompts):
+                    messages = [{"role": "system", "content": job.get("role", args.role)},
+                                {"role": "user", "content": job["prompt"]}]
+                    output.write(request_line(f"prompt-{job['id']}", args.model, messages, args.temperature))
+                    count += 1
+    print(f"Wrote {count} requests to {args.output}")
+    return count
+
+
+def submit(client, path):
+    """Upload a request file and create a batch for it, returning the batch id"""
+    with open(path, "rb") as file:
+        uploaded = client.files.create(file=file, purpose="batch")
+    created = client.batches.create(input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window="24h")
+    print(f"Started batch {created.id}")
+    return created.id
+
+
+def poll(client, batch_id, path, interval):
+    """Wait for a batch to finish, then download its results (and any errors) into path"""
+    while True:
+        status = client.batches.retrieve(batch_id)
+        counts = status.request_counts
+        if counts:
+            log.info(f"Batch {batch_id} {status.status}: {counts.completed} of {counts.total} completed")
+        if status.status in FINISHED:
+            break
+        time.sleep(interval)
+
+    with open(path, "wb") as output:
+        for file_id in (status.output_file_id, status.error_file_id):
+            if file_id:
+                with client.files.with_streaming_response.content(file_id) as response:
+                    for data in response.iter_bytes():
+                        output.write(data)
+    print(f"Batch {batch_id} {status.status}; results written to {path}")
+    return status.status == "completed"
+
+
+def index_results(path):
+    """Return the offset in a results file of the result for each custom id"""
+    offsets = {}
+    with open(path, "rb") as file:
+        while True:
+            offset = file.tell()
+            line = file.readline()
+            if not line:
+                break
+            if line.strip():
+                offsets[json.loads(line)["custom_id"]] = offset
+    return offsets
+
+
+def reply_text(result):
+    """Return the reply in a result, or None if the request failed"""
+    response = result.get("response")
+    if result.get("error") or not response or response.get("status_code") != 200:
+        return None
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+def merge(store, requests_path, results_path):
+    """Save the reply to each request in the chat store, in request order"""
+    offsets = index_results(results_path)
+    merged = failed = 0
+    with open(requests_path) as requests, open(results_path, "rb") as results:
+        for line in requests:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            custom_id = request["custom_id"]
+            reply = None
+            if custom_id in offsets:
+                results.seek(offsets[custom_id])
+                reply = reply_text(json.loads(results.readline()))
+            if reply is None:
+                log.warning(f"No reply for {custom_id}")
+                failed += 1
+                continue
+
+            kind, name = custom_id.split("-", 1)
+            messages = request["body"]["messages"]
+            if kind == "chat":
+                conversation = store.load(name)
+                if conversation is None:
+                    log.warning(f"Saved chat {name} no longer exists")
+                    failed += 1
+                    continue
+                # Add the follow-up message unless it's what the chat was waiting on
+                last = conversation.turns[-1] if conversation.turns else None
+                if last is None or last.role != "user" or last.content != messages[-1]["content"]:
+                    conversation.add_turn("user", messages[-1]["content"])
+                conversation.add_turn("assistant", reply)
+                store.save(conversation, "batch")
+            else:
+                conversation = chatai.Conversation()
+                for message in messages:
+                    conversation.add_turn(message["role"], message["content"])
+                conversation.add_turn("assistant", reply)
+                store.save(conversation, "batch", thread=name)
+            merged += 1
+    print(f"Merged {merged} replies, {failed} missing or failed")
+    return failed == 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(name)-8s | %(message)s")
+    args = get_args()
+
+    if args.command in ("submit", "poll"):
+        # The Batch API isn't rate limited like live requests, so let the client retry for itself
+        client = clients.openai_client().with_options(max_retries=2)
+        if args.command == "submit":
+            submit(client, args.requests)
+            return
+        sys.exit(0 if poll(client, args.batch_id, args.output, args.interval) else 1)
+
+    store = chatstore.open_store(args.backend, args.directory)
+    try:
+        if args.command == "export":
+            chatai.configure_context(args.model, "trim", None)
+            export(store, args)
+        else:
+            sys.exit(0 if merge(store, args.requests, args.results) else 1)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""Throughput benchmark for the chat paths, run entirely offline
+
+Starts the fake OpenAI server from fakeopenai.py and drives N concurrent
+conversations of M messages each through one of
+
+* chatai   - chatai.take_turn called from a thread per conversation,
+* discord  - discordbot.on_message with fake Discord messages and channels,
+* slack    - slackbot.handle_message with a fake Slack WebClient, so turns go
+             through the keyed dispatcher as they do in the bot.
+
+For each it reports messages/sec, the p50/p99 end-to-end latency of a turn
+and, with --memory, how much memory was still held at the end of the run.
+The discord scenario needs discord.py installed; neither bot connects to
+Discord or Slack.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import botcommon
+import fakeopenai
+
+
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chat paths against a local fake OpenAI API",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("-s", "--scenario", help="What to drive", choices=["chatai", "discord", "slack", "all"],
+                        default="chatai")
+    parser.add_argument("-c", "--conversations", help="Number of concurrent conversations", type=int, default=50)
+    parser.add_argument("-n", "--messages", help="Messages sent in each conversation", type=int, default=10)
+    parser.add_argument("-m", "--model", help="Model name sent to the fake API", default="gpt-3.5-turbo")
+    parser.add_argument("-l", "--latency", help="Seconds before each fake response starts", type=float, default=0.05)
+    parser.add_argument("-t", "--tokens-per-second", help="Rate fake responses are generated at (0 for instant)",
+                        type=float, default=0.0)
+    parser.add_argument("-r", "--reply-tokens", help="Length of each fake reply in tokens", type=int, default=200)
+    parser.add_argument("-w", "--workers", help="Worker threads (chatai threads, Slack dispatcher workers)", type=int,
+                        default=16)
+    parser.add_argument("--stream", help="Stream responses in the bots", action=argparse.BooleanOptionalAction,
+                        default=False)
+    parser.add_argument("-M", "--memory", help="Trace memory allocations (slows the run down)", action="store_true")
+
+    return parser.parse_args()
+
+
+class Run:
+    """Latencies of the turns in one benchmark run"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.elapsed = 0.0
+        self.memory = None
+
+    def record(self, start):
+        latency = time.monotonic() - start
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, fraction):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def report(self):
+        count = len(self.latencies)
+        print(f"{self.name}: {count} messages in {self.elapsed:.2f}s, {count / self.elapsed:.1f} msgs/sec")
+        if count:
+            print(f"  latency p50 {self.percentile(0.5) * 1000:.1f} ms, p99 {self.percentile(0.99) * 1000:.1f} ms")
+        if self.memory is not None:
+            retained, peak = self.memory
+            print(f"  memory retained {retained / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB")
+
+
+def measure(run, trace_memory, fn):
+    """Time fn(), optionally tracing the memory it allocates and still holds at the end"""
+    if trace_memory:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+    start = time.monotonic()
+    fn()
+    run.elapsed = time.monotonic() - start
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        run.memory = (current - before, peak - before)
+
+
+def prompt(conversation, message):
+    return f"Conversation {conversation} message {message}: " + "tell me something about this. " * 8
+
+
+def bench_chatai(args):
+    import chatai
+
+    run = Run("chatai.take_turn")
+
+    def converse(index):
+        conversation = chatai.Conversation()
+        conversation.set_system_role("You are a helpful assistant")
+        for message in range(args.messages):
+            start = time.monotonic()
+            if args.stream:
+                for _ in chatai.take_turn(conversation, args.model, prompt(index, message), stream=True,
+                                          user=f"user{index}"):
+                    pass
+            else:
+                chatai.take_turn(conversation, args.model, prompt(index, message), user=f"user{index}")
+            run.record(start)
+
+    def go():
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(converse, range(args.conversations)))
+
+    measure(run, args.memory, go)
+    return run
+
+
+# Fake Discord objects: just the attributes and coroutines discordbot.on_message uses
+
+class FakeDiscordMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content):
+        self.content = content
+        self.channel.edits += 1
+
+
+class FakeDiscordChannel:
+    def __init__(self, name):
+        self.name = name
+        self.sent = 0
+        self.edits = 0
+
+    async def typing(self):
+        pass
+
+    async def send(self, content):
+        self.sent += 1
+        return FakeDiscordMessage(self, content)
+
+
+def bench_discord(args):
+    import chatai
+    from convstore import ConversationStore
+    import discordbot
+
+    sys.argv = [sys.argv[0], "-m", args.model, "--stream" if args.stream else "--no-stream",
+                "--autosave-interval", "0", "--max-inflight", str(args.workers)]
+    discordbot.setup(discordbot.get_args(), None, ConversationStore(), None)
+    chatai.configure_context(args.model, "trim", None)
+
+    run = Run("discordbot.on_message")
+    guild = SimpleNamespace(name="bench")
+
+    async def converse(index):
+        channel = FakeDiscordChannel(f"channel{index % 10}")
+        author = SimpleNamespace(name=f"user{index}", bot=False)
+        for message in range(args.messages):
+            start = time.monotonic()
+            await discordbot.on_message(SimpleNamespace(id=index * args.messages + message, author=author,
+                                                        guild=guild, channel=channel,
+                                                        content=prompt(index, message)))
+            run.record(start)
+
+    async def converse_all():
+        await asyncio.gather(*(converse(index) for index in range(args.conversations)))
+
+    measure(run, args.memory, lambda: asyncio.run(converse_all()))
+    return run
+
+
+class FakeSlackClient:
+    """The WebClient methods slackbot calls, answering locally"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.posts = 0
+
+    def _ts(self):
+        with self.lock:
+            self.counter += 1
+            return f"{time.time():.0f}.{self.counter:06d}"
+
+    def chat_postEphemeral(self, **kwargs):
+        return {"ok": True}
+
+    def chat_postMessage(self, **kwargs):
+        with self.lock:
+            self.posts += 1
+        return {"ok": True, "ts": self._ts()}
+
+    def chat_update(self, **kwargs):
+        return {"ok": True, "ts": kwargs["ts"]}
+
+    def conversations_replies(self, **kwargs):
+        return {"ok": True, "messages": [], "has_more": False}
+
+
+def bench_slack(args, directory):
+    import chatai
+    from convstore import ConversationStore
+    import slackbot
+
+    sys.argv = [sys.argv[0], "-m", args.model, "--stream" if args.stream else "--no-stream",
+                "--autosave-interval", "0", "--workers", str(args.workers),
+                "--history-dir", os.path.join(directory, "slack_history")]
+    slackbot.setup(slackbot.get_args(), None, ConversationStore(), None)
+    slackbot.slack_web_client = client = FakeSlackClient()
+    chatai.configure_context(args.model, "trim", None)
+
+    run = Run("slackbot.handle_message")
+    done = threading.Semaphore(0)
+    run_turn = slackbot.run_turn
+
+    def timed_run_turn(event, client):
+        try:
+            run_turn(event, client)
+        finally:
+            run.record(event["bench_start"])
+            done.release()
+
+    # handle_message looks run_turn up when it's called, so this sees every turn it dispatches
+    slackbot.run_turn = timed_run_turn
+
+    def go():
+        for message in range(args.messages):
+            for index in range(args.conversations):
+                thread_ts = f"1700000000.{index:06d}"
+                event = {"type": "message", "user": f"user{index}", "channel": f"C{index % 10}",
+                         "text": prompt(index, message), "thread_ts": thread_ts,
+                         "event_ts": f"1700000001.{message * args.conversations + index:06d}",
+                         "bench_start": time.monotonic()}
+                slackbot.handle_message(event, None, client)
+        for _ in range(args.messages * args.conversations):
+            done.acquire()
+
+    try:
+        measure(run, args.memory, go)
+    finally:
+        slackbot.run_turn = run_turn
+        slackbot.shutdown()
+    return run
+
+
+def main():
+    args = get_args()
+    server, url = fakeopenai.start_server(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                                          reply_tokens=args.reply_tokens)
+    os.environ["OPENAI_BASE_URL"] = url
+    os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+    # The fake API has no rate limits; don't let the scheduler's defaults for real models pace the run
+    from scheduler import get_scheduler
+    get_scheduler().limits[args.model] = (10 ** 9, 0)
+
+    scenarios = ["chatai", "discord", "slack"] if args.scenario == "all" else [args.scenario]
+    print(f"{args.conversations} conversations x {args.messages} messages, {args.reply_tokens} token replies, "
+          f"{args.latency * 1000:.0f} ms latency" + (", streamed" if args.stream else ""))
+    with tempfile.TemporaryDirectory() as directory:
+        # The bots log to files in the working directory
+        os.chdir(directory)
+        botcommon.configure_logging("bench.log")
+        for scenario in scenarios:
+            if scenario == "chatai":
+                run = bench_chatai(args)
+            elif scenario == "discord":
+                run = bench_discord(args)
+            else:
+                run = bench_slack(args, directory)
+            run.report()
+    print(f"{server.fake.requests} requests served")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmark for building message lists from a Conversation
+
+Compares the cached message view used by Conversation.to_message and the
+join based __str__ against rebuilding them from the turns on every call,
+which is what happened before the cache was introduced.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from conversation import Conversation
+
+
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark Conversation message list construction",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("-t", "--turns", help="Number of user/assistant exchanges in the conversation", type=int,
+                        default=300)
+    parser.add_argument("-n", "--number", help="Number of calls to time", type=int, default=2000)
+
+    return parser.parse_args()
+
+
+def rebuild_messages(conversation):
+    """The original to_message: a fresh list of fresh dicts on every call"""
+    message = []
+    for conv in conversation.turns:
+        message.append({"role": conv.role, "content": conv.content})
+    return message
+
+
+def concat_str(conversation):
+    """The original __str__: repeated string concatenation"""
+    conversation_str = ""
+    for turn in conversation.turns:
+        conversation_str += f"{turn.role}: {turn.content}\n"
+    return conversation_str
+
+
+def build_conversation(turns):
+    conversation = Conversation()
+    conversation.set_system_role("You are a helpful assistant")
+    for i in range(turns):
+        conversation.add_turn("user", f"Question {i}: " + "how does this work? " * 10)
+        conversation.add_turn("assistant", f"Answer {i}: " + "it works like this. " * 40)
+    return conversation
+
+
+def allocated(fn, conversation, number):
+    """Return the bytes allocated by number calls of fn, holding on to each result as a caller would"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [fn(conversation) for _ in range(number)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return after - before
+
+
+def report(name, old, new, conversation, number):
+    old_time = timeit.timeit(lambda: old(conversation), number=number)
+    new_time = timeit.timeit(lambda: new(conversation), number=number)
+    old_mem = allocated(old, conversation, min(number, 200))
+    new_mem = allocated(new, conversation, min(number, 200))
+    print(f"{name}")
+    print(f"  rebuilt: {old_time / number * 1e6:10.1f} us/call {old_mem / 1024:10.0f} KiB retained")
+    print(f"  current: {new_time / number * 1e6:10.1f} us/call {new_mem / 1024:10.0f} KiB retained")
+    print(f"  speedup: {old_time / new_time:10.1f}x")
+
+
+def main():
+    args = get_args()
+    conversation = build_conversation(args.turns)
+    print(f"Conversation with {len(conversation.turns)} turns, {args.number} calls")
+
+    report("to_message", rebuild_messages, lambda conv: conv.to_message(), conversation, args.number)
+    report("__str__", concat_str, str, conversation, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""Startup benchmark: how long importing each entry point takes
+
+Imports each module in a fresh interpreter with python -X importtime and
+reports the time spent importing it, how many modules that pulled in, and
+which of the slow third-party packages (openai, httpx, tiktoken, flask,
+discord, slack_bolt) were loaded. With --ref, the same modules are also
+imported from a git revision of the tree (checked out into a temporary
+directory with git archive) so the two can be compared.
+
+Modules whose dependencies aren't installed are reported as failing.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = ["conversation", "chatai", "chatstore", "ai", "batchapi", "image", "discordbot", "slackbot"]
+
+HEAVY = ["openai", "httpx", "tiktoken", "flask", "discord", "slack_bolt"]
+
+# import time: self [us] | cumulative | imported package
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description="Measure how long importing each entry point takes",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("modules", help="Modules to import", nargs="*", default=MODULES)
+    parser.add_argument("-n", "--runs", help="Imports of each module; the fastest is reported", type=int, default=5)
+    parser.add_argument("--ref", help="Git revision to compare against, e.g. HEAD~1")
+
+    return parser.parse_args()
+
+
+def import_time(directory, module):
+    """Import module in a new interpreter, returning (seconds, modules loaded, heavy packages loaded)"""
+    # Older revisions create API clients on import, which need a key (but no connection)
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "unused"))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=directory, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise ImportError(error[-1] if error else f"exit status {result.returncode}")
+
+    total = 0
+    loaded = set()
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            total += int(match.group(1))
+            loaded.add(match.group(4))
+    heavy = [package for package in HEAVY if package in loaded]
+    return total / 1e6, len(loaded), heavy
+
+
+def measure(directory, module, runs):
+    """Return the fastest of several imports of module, or the error if it can't be imported"""
+    try:
+        results = [import_time(directory, module) for _ in range(runs)]
+    except ImportError as e:
+        return e
+    return min(results)
+
+
+def describe(result):
+    if isinstance(result, Exception):
+        return f"failed: {result}"
+    seconds, count, heavy = result
+    return f"{seconds * 1000:7.1f} ms, {count:4d} modules" + (f" ({', '.join(heavy)})" if heavy else "")
+
+
+def export_revision(revision, directory):
+    """Write the tree at a git revision into directory"""
+    archive = subprocess.run(["git", "archive", revision], cwd=ROOT, capture_output=True, check=True)
+    subprocess.run(["tar", "-x", "-C", directory], input=archive.stdout, check=True)
+
+
+def main():
+    args = get_args()
+
+    baseline = None
+    with tempfile.TemporaryDirectory() as directory:
+        if args.ref:
+            export_revision(args.ref, directory)
+            baseline = {module: measure(directory, module, args.runs) for module in args.modules}
+
+        for module in args.modules:
+            result = measure(ROOT, module, args.runs)
+            print(f"{module:14s} {describe(result)}")
+            if baseline is not None:
+                before = baseline[module]
+                print(f"{'  ' + args.ref:14s} {describe(before)}")
+                if not isinstance(result, Exception) and not isinstance(before, Exception):
+                    print(f"{'':14s} {before[0] / max(result[0], 1e-6):.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
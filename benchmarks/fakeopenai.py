@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the OpenAI API
+
+Serves just enough of the API for the tools and bots in this repository to run
+without spending real tokens: chat completions (plain and streamed), legacy
+completions, model listing, image generation, and file uploads and batches
+for the Batch API (batches complete as soon as they have been processed).
+Responses carry the x-ratelimit-* headers, and a requests-per-minute limit or
+random failures can be configured to exercise the request scheduler's pacing
+and retries.
+
+Point a client at it with
+
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=unused ./chatai.py
+"""
+
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+
+# A 1x1 transparent PNG, returned for every image request
+PNG_1X1 = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+WORDS = ("the quick brown fox jumps over the lazy dog while the model thinks about "
+         "what to say next and writes another line of text").split()
+
+
+class FakeOpenAI:
+    """Behaviour of the fake server, shared by all its request handlers"""
+
+    def __init__(self, latency=0.0, tokens_per_second=0.0, reply_tokens=50, rpm=0, fail_rate=0.0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.rpm = rpm
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.requests = 0
+        self.rejected = 0
+        # Uploaded and generated files by id, as (filename, purpose, bytes), and batches by id
+        self.files = {}
+        self.batches = {}
+
+    def admit(self):
+        """Return (allowed, remaining requests, seconds until a request is allowed)"""
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            if self.rpm and len(self.recent) >= self.rpm:
+                self.rejected += 1
+                return False, 0, 60 - (now - self.recent[0])
+            self.recent.append(now)
+            return True, max(0, self.rpm - len(self.recent)), 0.0
+
+    def reply_words(self, prompt):
+        """Deterministic reply of reply_tokens words, one per token"""
+        start = len(prompt) % len(WORDS)
+        words = [WORDS[(start + i) % len(WORDS)] for i in range(self.reply_tokens)]
+        # Break the reply into lines so the chunking code has something to work with
+        for i in range(11, len(words), 12):
+            words[i] += "\n"
+        return words
+
+    def chat_completion(self, body):
+        """Non-streamed chat completion response for a request body"""
+        messages = body.get("messages", [])
+        words = self.reply_words(messages[-1]["content"] if messages else "")
+        prompt_tokens = sum(len(message["content"].split()) + 4 for message in messages)
+        return {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                          "total_tokens": prompt_tokens + len(words)}}
+
+    def add_file(self, filename, purpose, data):
+        file_id = "file-" + uuid.uuid4().hex[:24]
+        with self.lock:
+            self.files[file_id] = (filename, purpose, data)
+        return self.file_object(file_id)
+
+    def file_object(self, file_id):
+        filename, purpose, data = self.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def create_batch(self, body):
+        batch_id = "batch_" + uuid.uuid4().hex[:24]
+        batch = {"id": batch_id, "object": "batch", "endpoint": body["endpoint"], "errors": None,
+                 "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+                 "status": "in_progress", "output_file_id": None, "error_file_id": None,
+                 "created_at": int(time.time()), "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                 "metadata": body.get("metadata")}
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self.run_batch, args=(batch,), daemon=True).start()
+        return batch
+
+    def run_batch(self, batch):
+        """Answer every request in a batch's input file, writing the results to an output file"""
+        time.sleep(self.latency)
+        output = []
+        errors = []
+        counts = batch["request_counts"]
+        for line in self.files[batch["input_file_id"]][2].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            counts["total"] += 1
+            result = {"id": "batch_req_" + uuid.uuid4().hex[:24], "custom_id": request["custom_id"]}
+            if request.get("url") != batch["endpoint"] or (self.fail_rate and random.random() < self.fail_rate):
+                counts["failed"] += 1
+                errors.append(dict(result, response=None, error={"code": "invalid_request",
+                                                                  "message": "Request failed"}))
+                continue
+            counts["completed"] += 1
+            output.append(dict(result, error=None, response={
+                "status_code": 200, "request_id": uuid.uuid4().hex, "body": self.chat_completion(request["body"])}))
+        with self.lock:
+            if output:
+                batch["output_file_id"] = self.add_file("batch_output.jsonl", "batch_output",
+                                                        "".join(json.dumps(r) + "\n" for r in output).encode())["id"]
+            if errors:
+                batch["error_file_id"] = self.add_file("batch_errors.jsonl", "batch_output",
+                                                       "".join(json.dumps(r) + "\n" for r in errors).encode())["id"]
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def limit_headers(self, remaining):
+            if not fake.rpm:
+                return {}
+            return {"x-ratelimit-limit-requests": str(fake.rpm),
+                    "x-ratelimit-remaining-requests": str(remaining),
+                    "x-ratelimit-reset-requests": "1s"}
+
+        def send_not_found(self):
+            self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+        def do_GET(self):
+            parts = ["", ""] + self.path.split("?")[0].rstrip("/").split("/")
+            if parts[-2] == "batches" and parts[-1] in fake.batches:
+                self.send_json(200, fake.batches[parts[-1]])
+            elif parts[-1] == "content" and parts[-2] in fake.files:
+                data = fake.files[parts[-2]][2]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif parts[-2] == "files" and parts[-1] in fake.files:
+                self.send_json(200, fake.file_object(parts[-1]))
+            elif self.path.rstrip("/").endswith("/models"):
+                self.send_json(200, {"object": "list", "data": [
+                    {"id": model, "object": "model", "created": 0, "owned_by": "fake"}
+                    for model in ("gpt-4", "gpt-3.5-turbo", "text-davinci-003", "dall-e-3")]})
+            else:
+                self.send_not_found()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+            path = self.path.rstrip("/")
+
+            # The Batch API isn't subject to the live rate limits
+            if path.endswith("/files"):
+                self.upload(data)
+                return
+            body = json.loads(data or b"{}")
+            if path.endswith("/batches"):
+                self.send_json(200, fake.create_batch(body))
+                return
+
+            allowed, remaining, retry_after = fake.admit()
+            if not allowed:
+                headers = self.limit_headers(0)
+                headers["retry-after"] = f"{retry_after:.2f}"
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, headers)
+                return
+            if fake.fail_rate and random.random() < fake.fail_rate:
+                self.send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+                return
+
+            time.sleep(fake.latency)
+            headers = self.limit_headers(remaining)
+            if path.endswith("/chat/completions"):
+                self.chat(body, headers)
+            elif path.endswith("/completions"):
+                self.completion(body, headers)
+            elif path.endswith("/images/generations"):
+                self.send_json(200, {"created": int(time.time()),
+                                     "data": [{"b64_json": base64.b64encode(PNG_1X1).decode()}]}, headers)
+            else:
+                self.send_not_found()
+
+        def upload(self, data):
+            """Store a file uploaded as multipart form data"""
+            form = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + data)
+            fields = {}
+            filename = "upload"
+            for part in form.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                fields[name] = part.get_payload(decode=True)
+                if name == "file":
+                    filename = part.get_filename() or filename
+            self.send_json(200, fake.add_file(filename, fields.get("purpose", b"").decode(), fields.get("file", b"")))
+
+        def generate(self, words):
+            """Wait as long as producing words would take at the configured token rate"""
+            if fake.tokens_per_second:
+                time.sleep(len(words) / fake.tokens_per_second)
+
+        def chat(self, body, headers):
+            messages = body.get("messages", [])
+            words = fake.reply_words(messages[-1]["content"] if messages else "")
+            base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "fake")}
+
+            if not body.get("stream"):
+                self.generate(words)
+                self.send_json(200, fake.chat_completion(body), headers)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            for i, word in enumerate(words):
+                self.generate([word])
+                delta = {"content": word if i == 0 else " " + word}
+                self.send_event(dict(base, object="chat.completion.chunk",
+                                     choices=[{"index": 0, "delta": delta, "finish_reason": None}]))
+            self.send_event(dict(base, object="chat.completion.chunk",
+                                 choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self.send_event(dict(base, object="chat.completion.chunk", choices=[],
+                                     usage=fake.chat_completion(body)["usage"]))
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+
+        def send_event(self, event):
+            self.send_chunk(b"data: " + json.dumps(event).encode() + b"\n\n")
+
+        def send_chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def completion(self, body, headers):
+            prompts = body.get("prompt", "")
+            if isinstance(prompts, str):
+                prompts = [prompts]
+            choices = []
+            completion_tokens = 0
+            for prompt in prompts:
+                for _ in range(body.get("n", 1)):
+                    words = fake.reply_words(prompt)
+                    completion_tokens += len(words)
+                    choices.append({"index": len(choices), "text": " ".join(words), "logprobs": None,
+                                    "finish_reason": "stop"})
+            self.generate(range(completion_tokens))
+            prompt_tokens = sum(len(prompt.split()) for prompt in prompts)
+            self.send_json(200, {"id": "cmpl-fake", "object": "text_completion", "created": int(time.time()),
+                                 "model": body.get("model", "fake"), "choices": choices,
+                                 "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                           "total_tokens": prompt_tokens + completion_tokens}}, headers)
+
+    return Handler
+
+
+def start_server(port=0, **options):
+    """Start a fake server in a background thread, returning (server, base URL)"""
+    fake = FakeOpenAI(**options)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(fake))
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the OpenAI API",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("-p", "--port", help="Port to listen on", type=int, default=8765)
+    parser.add_argument("-l", "--latency", help="Seconds before each response starts", type=float, default=0.0)
+    parser.add_argument("-t", "--tokens-per-second", help="Rate responses are generated at (0 for instant)",
+                        type=float, default=0.0)
+    parser.add_argument("-n", "--reply-tokens", help="Length of each reply in tokens", type=int, default=50)
+    parser.add_argument("-r", "--rpm", help="Requests per minute before returning 429 (0 for no limit)", type=int,
+                        default=0)
+    parser.add_argument("-e", "--fail-rate", help="Fraction of requests failing with a 500", type=float, default=0.0)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    server, url = start_server(args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                               reply_tokens=args.reply_tokens, rpm=args.rpm, fail_rate=args.fail_rate)
+    print(f"Fake OpenAI API at {url}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"{server.fake.requests} requests, {server.fake.rejected} rate limited")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
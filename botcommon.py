@@ -0,0 +1,134 @@
+"""Chat handling shared by the Discord and Slack frontends
+
+Both bots keep their conversations in a ConversationStore, start them with the
+same system role and answer a message by taking a turn and splitting the
+response into chunks short enough for the platform. They also share most of
+their command-line options, so botruntime.py can host both in one process.
+"""
+
+import argparse
+import logging
+import time
+
+import chatai
+import chatstore
+import chunker
+import metrics
+from conversation import Conversation
+from convstore import ConversationStore
+from statebackend import SQLiteStateBackend
+
+DEFAULT_ROLE = "You are a helpful assistant"
+
+LOG_FORMAT = "%(asctime)s | %(name)-7s | %(levelname)-8s | %(module)s:%(lineno)-4d | %(message)s"
+LOG_DATE_FORMAT = '%a %d %b %Y %I:%M:%S %p %z'
+
+
+def add_arguments(parser, directory, image_dir):
+    """Add the options shared by the bots, with defaults for where they keep chats and images"""
+    parser.add_argument("-f", "--directory", help="Directory to store chats", default=directory)
+    parser.add_argument("--backend", help="How chats are stored", choices=chatstore.BACKENDS, default="sqlite")
+    parser.add_argument("--autosave-interval", help="Seconds between autosaves of changed conversations (0 to disable)",
+                        type=int, default=60)
+    parser.add_argument("--autosave-threshold", help="Autosave early once this many conversations have changed",
+                        type=int, default=50)
+    parser.add_argument("-m", "--model", help="Select the model to use", default="gpt-4") # gpt-4
+    parser.add_argument("-t", "--temperature", help="Set the model's temperature from 0 to 1. 0 is more predictable; 1 more creative", type=float, default=0.6)
+    parser.add_argument("--cache", help="Cache responses to identical prompts (only used at temperature 0)",
+                        action="store_true")
+    parser.add_argument("--cache-size", help="Maximum responses cached in memory", type=int, default=1000)
+    parser.add_argument("--cache-ttl", help="Seconds a cached response stays valid", type=int, default=24 * 3600)
+    parser.add_argument("--cache-dir", help="Directory to also cache responses on disk")
+    parser.add_argument("--cache-disk-size", help="Maximum responses cached on disk", type=int, default=10000)
+    parser.add_argument("--stream", help="Post responses as they are generated", action=argparse.BooleanOptionalAction,
+                        default=True)
+    parser.add_argument("-b", "--token-budget", help="Prompt token budget (default depends on the model)", type=int)
+    parser.add_argument("-c", "--context", help="How to keep long conversations within the token budget",
+                        choices=chatai.CONTEXT_STRATEGIES, default="trim")
+    parser.add_argument("--max-conversations", help="Maximum conversations held in memory", type=int, default=1000)
+    parser.add_argument("--max-memory", help="Maximum memory used by conversations, in MiB", type=int, default=256)
+    parser.add_argument("--idle-timeout", help="Evict conversations idle for this many seconds (0 to disable)",
+                        type=int, default=0)
+    parser.add_argument("--spill-dir", help="Directory to spill evicted conversations to (default: discard them)")
+    parser.add_argument("--state-dir", help="Directory of conversation state shared with other bot processes, "
+                                            "so any of them can answer any message")
+    parser.add_argument("--state-shards", help="Number of databases the shared state is spread over", type=int,
+                        default=4)
+    parser.add_argument("--image-model", help="Model used to generate images", default="dall-e-3")
+    parser.add_argument("--image-dir", help="Directory to cache generated images", default=image_dir)
+    parser.add_argument("--metrics-port", help="Serve metrics over HTTP on this port (0 to disable)", type=int,
+                        default=0)
+    parser.add_argument("--metrics-dump", help="Seconds between dumps of the metrics to the log (0 to disable)",
+                        type=int, default=0)
+    parser.add_argument("--log-sample", help="Fraction of prompts and responses logged in full at debug level",
+                        type=float, default=0.1)
+    parser.add_argument("-d", "--debug", help="Log at debug level", action="store_true")
+
+
+def configure_logging(filename):
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT, filename=filename)
+
+
+def configure(args, log):
+    """Apply the options affecting the whole process: metrics, and how chatai keeps context and caches"""
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_dump:
+        metrics.dump_every(args.metrics_dump, log)
+    chatai.configure_context(args.model, args.context, args.token_budget)
+    if args.cache:
+        chatai.enable_response_cache(args.cache_size, args.cache_ttl, args.cache_dir, args.cache_disk_size)
+
+
+def open_conversations(args):
+    """Create the store of live conversations configured by args"""
+    backend = SQLiteStateBackend(args.state_dir, args.state_shards) if args.state_dir else None
+    return ConversationStore(args.max_conversations, args.max_memory * 1024 * 1024, args.idle_timeout,
+                             args.spill_dir, backend)
+
+
+def set_system_role(conversation, system_role=None):
+    if system_role is None:
+        conversation.set_system_role(DEFAULT_ROLE)
+    else:
+        conversation.set_system_role(system_role)
+
+
+def get_conversation(conversations, key, load=None, claim=False):
+    """Return the conversation for key, starting a new one if there isn't one
+
+    load(conversation) is called to fill in a new conversation, for example
+    from the platform's message history. With claim set, the conversation is
+    marked in use, so the store doesn't evict it until finish_turn is called"""
+    def new_conversation():
+        conversation = Conversation()
+        set_system_role(conversation)
+        if load is not None:
+            load(conversation)
+        return conversation
+
+    return conversations.get_or_create(key, new_conversation, claim)
+
+
+def split_response(response, platform):
+    """Split a response into chunks short enough to post on platform"""
+    start = time.monotonic()
+    chunks = chunker.split_text(response, chunker.chunk_limit(platform))
+    metrics.observe("bot_chunking_seconds", time.monotonic() - start)
+    return chunks
+
+
+def process_chat_turn(conversation, message, args, platform, log, user=None):
+    """Take a turn, returning the response split into chunks for platform"""
+    metrics.sampled_debug(log, args.log_sample, "user asks: %s", message)
+    response = chatai.take_turn(conversation, args.model, message, temperature=args.temperature, user=user)
+    metrics.sampled_debug(log, args.log_sample, "assistant responses: %s", response)
+    return split_response(response, platform)
+
+
+async def aprocess_chat_turn(conversation, message, args, platform, log, user=None):
+    """Async version of process_chat_turn"""
+    metrics.sampled_debug(log, args.log_sample, "user asks: %s", message)
+    response = await chatai.atake_turn(conversation, args.model, message, temperature=args.temperature, user=user)
+    metrics.sampled_debug(log, args.log_sample, "assistant responses: %s", response)
+    return split_response(response, platform)
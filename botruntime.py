@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""Run the Discord and Slack bots together in one process
+
+Both bots share one asyncio event loop, chat store, conversation store (each
+in its own namespace), image service and request scheduler, so the rate limits
+of each model are enforced across both of them and conversations are held
+within one memory limit. The Discord bot runs on the event loop; the Slack bot
+handles events on its Socket Mode client's threads and answers them on its
+dispatcher's worker threads, as it does on its own.
+
+Options are those of the two bots combined. A bot can be left out with
+--no-discord or --no-slack.
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+import botcommon
+import chatstore
+import discordbot
+import slackbot
+from imagegen import ImageService
+
+log = logging.getLogger('runtime')
+
+
+def make_parser():
+    """Return the parser of the command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description="Run the Discord and Slack chatGPT bots in one process",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    botcommon.add_arguments(parser, "chats", "images")
+    discordbot.add_arguments(parser)
+    slackbot.add_arguments(parser)
+    parser.add_argument("--discord", help="Run the Discord bot", action=argparse.BooleanOptionalAction,
+                        default=True)
+    parser.add_argument("--slack", help="Run the Slack bot", action=argparse.BooleanOptionalAction, default=True)
+    return parser
+
+
+def get_args():
+    """Get command-line arguments"""
+    return make_parser().parse_args()
+
+
+async def serve(args):
+    """Run the bots until SIGTERM or SIGINT"""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    if args.slack:
+        # Connecting checks the token with Slack; don't hold up the loop while it does
+        await loop.run_in_executor(None, slackbot.connect)
+        log.info("Slack bot connected")
+
+    tasks = [asyncio.create_task(stopping.wait())]
+    if args.discord:
+        tasks.append(asyncio.create_task(discordbot.client.start(discordbot.token)))
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    log.info("Stopping")
+    if args.discord:
+        await discordbot.client.close()
+    for task in done:
+        # Raise the error if the Discord bot stopped by itself
+        task.result()
+
+
+def main():
+    args = get_args()
+    botcommon.configure_logging('bots.log')
+    botcommon.configure(args, log)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+    if args.discord and not discordbot.token:
+        log.warning("DISCORD_CHATGPT_BOT_TOKEN isn't set; not running the Discord bot")
+        args.discord = False
+
+    chat_store = chatstore.open_store(args.backend, args.directory)
+    conversations = botcommon.open_conversations(args)
+    images = ImageService(model=args.image_model, directory=args.image_dir)
+    if args.discord:
+        discordbot.setup(args, chat_store, conversations.namespace("discord"), images)
+    if args.slack:
+        slackbot.setup(args, chat_store, conversations.namespace("slack"), images)
+
+    try:
+        asyncio.run(serve(args))
+    finally:
+        if args.slack:
+            slackbot.shutdown()
+        if args.discord:
+            discordbot.shutdown()
+        images.shutdown()
+        chat_store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -16,76 +16,128 @@ Notes
 from datetime import datetime
 
 import argparse
-import json
-import os
+import asyncio
+import sys
 import textwrap
-from openai import OpenAI
-
-client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-
-
-# Set the API key and model
-
-
-
-
-class Turn:
-    """Define an turn in a conversation"""
-
-    def __init__(self, role, content):
-        self.role = role
-        self.content = content
-
-    def to_dict(self):
-        """Convert a Turn into a dictionary entry"""
-        return {"role": self.role, "content": self.content}
-
-
-class Conversation:
-    def __init__(self):
-        self.turns = []
-
-    def add_turn(self, role, content):
-        turn = Turn(role, content)
-        self.turns.append(turn)
-
-    def to_message(self):
-        """Convert a Conversation into a message list"""
-        message = []
-        for conv in self.turns:
-            message.append({"role": conv.role, "content": conv.content})
-        return message
-
-    def to_dict(self):
-        """Convert a Conversation into a dictionary"""
-        return {"chat": [obj.to_dict() for obj in self.turns]}
-
-    def clear(self):
-        """Clear the list"""
-        self.turns.clear()
-
-    def set_system_role(self, role):
-        """Set the system role for this conversation"""
-        # TODO: Perhaps always do this in the first slot?
-        self.add_turn("system", role)
-
-    def get_system_role(self):
-        """Get the current system role for this conversation"""
-        return self.turns[0].content
-
-    def num_turns(self):
-        """Return the number of turns in the conversation"""
-        return int((len(self.turns)-1) / 2)
-
-    def get_entry(self, num):
-        return self.turns[num] if num <= len(self.turns) else Turn("","")
-
-    def __str__(self):
-        conversation_str = ""
-        for turn in self.turns:
-            conversation_str += f"{turn.role}: {turn.content}\n"
-        return conversation_str
-
+import time
+
+import clients
+import metrics
+from conversation import TOKENS_PER_MESSAGE, Conversation
+from scheduler import get_scheduler
+
+# Maximum number of requests the async interface will have outstanding at once;
+# further turns wait for a free slot rather than piling onto the API
+MAX_INFLIGHT = 8
+_inflight = None
+
+# Optional cache of responses to identical prompts; see enable_response_cache
+response_cache = None
+
+
+# Prompt token budget for each model. Older turns beyond the budget are either
+# left out of the request ("trim"), replaced by a rolling summary before the
+# request ("summarize") or left out while a summary is written in the background
+# to replace them in later requests ("background"; see summarizer.py)
+TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 3000,
+    "gpt-3.5-turbo-16k": 12000,
+    "gpt-4": 6000,
+    "gpt-4-32k": 24000,
+    "gpt-4-1106-preview": 24000,
+}
+DEFAULT_TOKEN_BUDGET = 3000
+CONTEXT_STRATEGIES = ["trim", "summarize", "background"]
+context_strategy = "trim"
+
+# Summarizer used by the "background" strategy; created by configure_context
+background_summarizer = None
+
+# Cheaper model used to summarize older turns, and the fraction of the budget
+# the conversation is compacted down to so we don't summarize on every turn
+SUMMARY_MODEL = "gpt-3.5-turbo"
+SUMMARY_TARGET = 0.75
+
+# Tokens reserved against the rate limit for a completion before we know its real size
+COMPLETION_ESTIMATE = 500
+
+
+def token_budget(model):
+    """Return the prompt token budget for a model"""
+    return TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+
+def configure_context(model, strategy="trim", budget=None):
+    """Select how conversations are kept within budget, optionally overriding the model's budget"""
+    global context_strategy, background_summarizer
+    if strategy not in CONTEXT_STRATEGIES:
+        raise ValueError(f"Unknown context strategy {strategy}; use one of {CONTEXT_STRATEGIES}")
+    context_strategy = strategy
+    if strategy == "background" and background_summarizer is None:
+        from summarizer import Summarizer
+        background_summarizer = Summarizer()
+    if budget:
+        TOKEN_BUDGETS[model] = budget
+
+
+def estimate_tokens(messages):
+    """Rough token count of a request and its response, reserved against the rate limit"""
+    return sum(len(message["content"]) // 4 + TOKENS_PER_MESSAGE for message in messages) + COMPLETION_ESTIMATE
+
+
+def complete(model, messages, user=None, **kwargs):
+    """Make a chat completion request, paced and retried by the shared scheduler
+
+    A streamed response's last event carries its usage, and has no choices"""
+    if kwargs.get("stream"):
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    client = clients.openai_client()
+    return get_scheduler().call(model, lambda: client.chat.completions.with_raw_response.create(
+        model=model, messages=messages, n=1, stop=None, **kwargs), estimate_tokens(messages), user)
+
+
+async def acomplete(model, messages, user=None, **kwargs):
+    """Async version of complete"""
+    if kwargs.get("stream"):
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    aclient = clients.async_openai_client()
+    return await get_scheduler().acall(model, lambda: aclient.chat.completions.with_raw_response.create(
+        model=model, messages=messages, n=1, stop=None, **kwargs), estimate_tokens(messages), user)
+
+
+def summary_request(turns):
+    """Build the message list asking for a summary of turns"""
+    transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in turns)
+    return [{"role": "system", "content": "Summarize the following conversation in a short paragraph, keeping "
+                                          "any facts, names and decisions needed to continue it."},
+            {"role": "user", "content": transcript}]
+
+
+def context_messages(conversation, model):
+    """Return the messages to send for a conversation, keeping it within the model's token budget"""
+    budget = token_budget(model)
+    if context_strategy == "summarize":
+        count = conversation.overflow(int(budget * SUMMARY_TARGET))
+        if count:
+            response = complete(SUMMARY_MODEL, summary_request(conversation.oldest_turns(count)), temperature=0.2)
+            conversation.compact(count, response.choices[0].message.content)
+    elif context_strategy == "background":
+        background_summarizer.check(conversation, budget)
+    return conversation.to_message(budget)
+
+
+async def acontext_messages(conversation, model):
+    """Async version of context_messages"""
+    budget = token_budget(model)
+    if context_strategy == "summarize":
+        count = conversation.overflow(int(budget * SUMMARY_TARGET))
+        if count:
+            response = await acomplete(SUMMARY_MODEL, summary_request(conversation.oldest_turns(count)),
+                                       temperature=0.2)
+            conversation.compact(count, response.choices[0].message.content)
+    elif context_strategy == "background":
+        background_summarizer.check(conversation, budget)
+    return conversation.to_message(budget)
 
 
 _print = print
@@ -111,13 +163,22 @@ def get_args():
     parser.add_argument("-r", "--role", help="Describe the system's role", default="You are a helpful assistant")
     parser.add_argument("-s", "--store", help="Store conversation", action="store_false")
     parser.add_argument("-f", "--directory", help="Directory to store chats", default="chats")
+    parser.add_argument("--backend", help="How chats are stored", choices=["sqlite", "jsonl"], default="sqlite")
+    parser.add_argument("--stream", help="Print the response as it is generated", action="store_true")
+    parser.add_argument("-b", "--token-budget", help="Prompt token budget (default depends on the model)", type=int)
+    parser.add_argument("-c", "--context", help="How to keep long conversations within the token budget",
+                        choices=CONTEXT_STRATEGIES, default="trim")
+    parser.add_argument("--batch", help="Answer the prompts in a JSONL file ('-' for stdin) instead of chatting")
+    parser.add_argument("-o", "--output", help="JSONL file batch results are appended to ('-' for stdout)",
+                        default="-")
+    parser.add_argument("-j", "--jobs", help="Prompts answered concurrently in batch mode", type=int, default=8)
 
     return parser.parse_args()
 
 
 def list_models():
     """List the various model types - current flat, but would be interesting to show hierarchy"""
-    models = client.models.list()
+    models = clients.openai_client().models.list()
 #    print(models)
 
     for model in models["data"]:
@@ -125,35 +186,224 @@ def list_models():
     print()
 
 
-def write_chat(directory, conv_time, conversation):
-    """Write a chat to a file, creating the directory if required"""
+def write_chat(store, conversation, platform="cli", **location):
+    """Save the turns of a chat not yet written to the store, returning the chat id"""
+    chat_id = store.save(conversation, platform, **location)
+    print(f"stored chat as {chat_id}")
+    return chat_id
+
 
-    # Create directory if required
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+def enable_response_cache(max_entries=1000, ttl=24 * 3600, directory=None, max_disk_entries=10000):
+    """Cache responses to identical deterministic requests"""
+    global response_cache
+    import respcache
+    response_cache = respcache.ResponseCache(max_entries, ttl, directory, max_disk_entries)
+    return response_cache
 
-    my_dict = conversation.to_dict()
 
-    file_path = directory + "/" + conv_time
-    print(f"write to {file_path}")
+def cache_key(model, temperature, messages):
+    """Return the response cache key for a request, or None if it shouldn't be cached
 
-    with open(file_path, "w") as file:
-        json.dump(my_dict, file)
+    Only requests at temperature 0 are cached, as other settings are expected to vary"""
+    if response_cache is None or temperature != 0:
+        return None
+    import respcache
+    return respcache.make_key(model, temperature, messages)
 
-    print(f"stored chat as {file_path}")
-    return file_path
 
+async def acached_reply(key):
+    """Look a request up in the response cache, keeping any reads of the disk tier off the event loop"""
+    if not key:
+        return None
+    if response_cache.directory is None:
+        return response_cache.get(key)
+    return await asyncio.to_thread(response_cache.get, key)
 
-def take_turn(conversation, model, message):
-    """Interface to support discord - record user message, ask openai and record (and return) response"""
-    conversation.add_turn("user", message)
-    messages = conversation.to_message()
-    response = client.chat.completions.create(model=model, messages=messages, n=1, stop=None,
-                                            temperature=0.6)
-    reply = response.choices[0].message.content
-    conversation.add_turn("assistant", reply)
+
+async def acache_reply(key, reply):
+    """Cache a reply, keeping any writes (and sweeps) of the disk tier off the event loop"""
+    if not key:
+        return
+    if response_cache.directory is None:
+        response_cache.put(key, reply)
+    else:
+        await asyncio.to_thread(response_cache.put, key, reply)
+
+
+def take_turn(conversation, model, message, stream=False, temperature=0.6, user=None):
+    """Interface to support discord - record user message, ask openai and record (and return) response
+
+    With stream set, a generator of response deltas is returned instead; the full
+    response is recorded in the conversation once the generator is exhausted"""
+    conversation.start_turn()
+    streaming = False
+    try:
+        conversation.add_turn("user", message)
+        messages = context_messages(conversation, model)
+
+        key = cache_key(model, temperature, messages)
+        reply = response_cache.get(key) if key else None
+        if reply is not None:
+            conversation.add_turn("assistant", reply)
+            return iter([reply]) if stream else reply
+
+        if stream:
+            start = time.monotonic()
+            response = complete(model, messages, user, temperature=temperature, stream=True)
+            streaming = True
+            return stream_reply(conversation, response, key, start, finish=True)
+
+        response = complete(model, messages, user, temperature=temperature)
+        reply = response.choices[0].message.content
+        conversation.add_turn("assistant", reply)
+        if key:
+            response_cache.put(key, reply)
+        return reply
+    finally:
+        if not streaming:
+            conversation.finish_turn()
+
+
+def stream_reply(conversation, response, key=None, start=None, finish=False):
+    """Yield the content deltas of a streamed response and record the reply in the conversation
+
+    If a cache key is given, the reply is cached once the stream completes; if the
+    time the request was started is given, the time to the first token is recorded.
+    With finish set, the turn started by take_turn is finished with the stream"""
+    parts = []
+    try:
+        for event in response:
+            delta = event.choices[0].delta.content if event.choices else None
+            if delta:
+                if not parts and start is not None:
+                    metrics.observe("openai_time_to_first_token_seconds", time.monotonic() - start)
+                parts.append(delta)
+                yield delta
+        if key:
+            response_cache.put(key, "".join(parts))
+    finally:
+        # Record whatever we received, even if the caller stopped early
+        conversation.add_turn("assistant", "".join(parts))
+        if finish:
+            conversation.finish_turn()
+
+
+def set_max_inflight(limit):
+    """Set the maximum number of concurrent requests made by atake_turn"""
+    global MAX_INFLIGHT, _inflight
+    MAX_INFLIGHT = limit
+    _inflight = None
+
+
+def _inflight_slots():
+    global _inflight
+    if _inflight is None:
+        _inflight = asyncio.Semaphore(MAX_INFLIGHT)
+    return _inflight
+
+
+async def atake_turn(conversation, model, message, temperature=0.6, user=None):
+    """Async version of take_turn for use inside an event loop
+
+    Turns on the same conversation are serialized, while turns on different
+    conversations run concurrently up to MAX_INFLIGHT requests"""
+    conversation.start_turn()
+    try:
+        async with conversation.async_lock():
+            conversation.add_turn("user", message)
+            messages = await acontext_messages(conversation, model)
+
+            key = cache_key(model, temperature, messages)
+            reply = await acached_reply(key)
+            if reply is None:
+                async with _inflight_slots():
+                    response = await acomplete(model, messages, user, temperature=temperature)
+                reply = response.choices[0].message.content
+                await acache_reply(key, reply)
+            conversation.add_turn("assistant", reply)
+    finally:
+        conversation.finish_turn()
     return reply
 
+
+async def astream_turn(conversation, model, message, temperature=0.6, user=None):
+    """Streaming version of atake_turn - an async generator of response deltas
+
+    The conversation lock and an in-flight slot are held until the stream finishes"""
+    conversation.start_turn()
+    try:
+        async with conversation.async_lock():
+            conversation.add_turn("user", message)
+            messages = await acontext_messages(conversation, model)
+
+            key = cache_key(model, temperature, messages)
+            reply = await acached_reply(key)
+            if reply is not None:
+                conversation.add_turn("assistant", reply)
+                yield reply
+                return
+
+            parts = []
+            try:
+                async with _inflight_slots():
+                    start = time.monotonic()
+                    response = await acomplete(model, messages, user, temperature=temperature, stream=True)
+                    async for event in response:
+                        delta = event.choices[0].delta.content if event.choices else None
+                        if delta:
+                            if not parts:
+                                metrics.observe("openai_time_to_first_token_seconds", time.monotonic() - start)
+                            parts.append(delta)
+                            yield delta
+                await acache_reply(key, "".join(parts))
+            finally:
+                conversation.add_turn("assistant", "".join(parts))
+    finally:
+        conversation.finish_turn()
+
+
+def print_wrapped(text, width=80):
+    """Print a complete response, wrapping each paragraph"""
+    paragraph = str.splitlines(text)
+    for lines in paragraph:
+        wrapper = textwrap.TextWrapper(width=width, break_long_words=True)
+        msg = wrapper.wrap(lines)
+        for line in msg:
+            print(line)
+        print()
+
+
+def print_stream(deltas, width=80):
+    """Print a streamed response as it arrives, wrapping lines at width"""
+    line = ""
+    for delta in deltas:
+        line += delta
+        while "\n" in line:
+            done, line = line.split("\n", 1)
+            print_partial(done, width)
+            print()
+        # Print each full-width line as soon as there is enough text to fill it
+        line = print_partial(line, width, hold_back=True)
+    if line:
+        print_partial(line, width)
+        print()
+
+
+def print_partial(line, width, hold_back=False):
+    """Print line wrapped at width; with hold_back the unfinished tail is returned rather than printed"""
+    while len(line) > width:
+        cut = line.rfind(" ", 0, width + 1)
+        if cut <= 0:
+            cut = width
+        print(line[:cut], flush=True)
+        line = line[cut:].lstrip(" ")
+    if hold_back:
+        return line
+    if line:
+        print(line, flush=True)
+    return ""
+
+
 def chat(args):
     """Provide a bidirectional user chat interface to openAPI's chat model"""
     print(f"System role: {args.role}")
@@ -169,49 +419,71 @@ def chat(args):
             if prompt.lower() in end_markers:
                 print("Chat finished")
                 if args.store:
-                    write_chat(args.directory, start_time, conversation)
+                    write_chat(store, conversation)
                 break
 
             conversation.add_turn("user", prompt)
-            messages = conversation.to_message()
+            messages = context_messages(conversation, args.model)
             if args.debug:
                 print(messages)
-            response = client.chat.completions.create(model=args.model, messages=messages, n=1, stop=None,
-                                                    temperature=args.temperature)
+
+            if args.stream:
+                start = time.monotonic()
+                response = complete(args.model, messages, temperature=args.temperature, stream=True)
+                print_stream(stream_reply(conversation, response, start=start))
+                if args.usage:
+                    print('[Usage is not reported for streamed responses]')
+                continue
+
+            response = complete(args.model, messages, temperature=args.temperature)
             reply = response.choices[0].message.content
             conversation.add_turn("assistant", reply)
 
-            paragraph = str.splitlines(reply)
-            for lines in paragraph:
-                wrapper = textwrap.TextWrapper(width=80, break_long_words=True)
-                msg = wrapper.wrap(lines)
-                for line in msg:
-                    print(line)
-                print()
+            print_wrapped(reply)
             if args.usage:
                 print(f'[Prompt tokens: {response.usage.prompt_tokens} Completion tokens: {response.usage.completion_tokens} '
                       f'Total tokens: {response.usage.total_tokens}]')
     except KeyboardInterrupt:
         print('exiting')
         if args.store:
-            write_chat(args.directory, start_time, conversation)
+            write_chat(store, conversation)
     except EOFError:
         print('exiting')
         if args.store:
-            write_chat(args.directory, start_time, conversation)
+            write_chat(store, conversation)
+
+
+def run_batch(args):
+    """Answer each prompt in a batch file as the first turn of its own conversation"""
+    import batch
+
+    def answer(jobs):
+        results = []
+        for job in jobs:
+            conversation = Conversation()
+            conversation.set_system_role(job.get("role", args.role))
+            reply = take_turn(conversation, args.model, job["prompt"], temperature=args.temperature)
+            results.append({"response": reply})
+        return results
+
+    return batch.run_file(args.batch, args.output, answer, args.jobs)
 
 
 def main():
     """A turn based conversation interface to openAI's chat API"""
 
     args = get_args()
+    configure_context(args.model, args.context, args.token_budget)
 
     if args.list_models:
         list_models()
 
-    global start_time
-    start_time = datetime.now()
-    start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
+    if args.batch:
+        sys.exit(0 if run_batch(args) else 1)
+
+    global store
+    import chatstore
+    store = chatstore.open_store(args.backend, args.directory)
     chat(args)
 
 
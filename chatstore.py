@@ -0,0 +1,210 @@
+"""Storage backends for saved chats
+
+A chat is saved incrementally: the first save of a conversation creates the
+chat and later saves only write the turns recorded since. Chats are indexed by
+where they took place (platform, server, channel, thread and author) so past
+chats can be found and reloaded quickly.
+
+Two backends are provided:
+
+* SQLiteChatStore - one row per turn in a single SQLite database
+* JsonlChatStore - an append-only JSONL file per chat plus an append-only index
+"""
+
+from datetime import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import uuid
+
+from conversation import Conversation
+
+log = logging.getLogger('chats')
+
+BACKENDS = ["sqlite", "jsonl"]
+
+# Length of the title recorded for a chat, taken from its first user message
+TITLE_LENGTH = 60
+
+# Form of the ids JsonlChatStore gives chats; ids come from users, so they are
+# checked before being used in a path
+JSONL_CHAT_ID = re.compile(r"\d{8}-\d{6}-[0-9a-f]{8}")
+
+
+def chat_title(turns):
+    """One line title for a chat, taken from its first user message"""
+    for turn in turns:
+        if turn.role == "user":
+            line = turn.content.strip().split("\n")[0]
+            return line[:TITLE_LENGTH]
+    return ""
+
+
+def now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ChatStore:
+    """Interface shared by the chat storage backends"""
+
+    def save(self, conversation, platform, server="", channel="", thread="", author=""):
+        """Save the turns recorded since the last save, returning the chat id"""
+        raise NotImplementedError
+
+    def find(self, platform=None, server=None, channel=None, thread=None, author=None, limit=20):
+        """Return summaries of the most recently updated matching chats as dictionaries"""
+        raise NotImplementedError
+
+    def load(self, chat_id):
+        """Load a saved chat into a new Conversation; further saves continue the same chat"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteChatStore(ChatStore):
+    """Chats stored in SQLite, one row per turn"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, platform TEXT, server TEXT, "
+                            "channel TEXT, thread TEXT, author TEXT, title TEXT, created TEXT, updated TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS chats_location ON chats (platform, server, channel, thread)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS turns (chat_id INTEGER, seq INTEGER, role TEXT, "
+                            "content TEXT, covers INTEGER, PRIMARY KEY (chat_id, seq))")
+
+    def save(self, conversation, platform, server="", channel="", thread="", author=""):
+        # Read the unsaved turns under the lock, as the autosave thread may be saving the same conversation
+        with self.lock, self.db:
+            turns = conversation.unsaved_turns()
+            if conversation.chat_id is None:
+                cursor = self.db.execute("INSERT INTO chats (platform, server, channel, thread, author, title, "
+                                         "created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                         (platform, server, channel, thread, author, chat_title(turns), now(), now()))
+                conversation.chat_id = cursor.lastrowid
+            elif turns:
+                self.db.execute("UPDATE chats SET updated = ? WHERE id = ?", (now(), conversation.chat_id))
+            self.db.executemany("INSERT OR REPLACE INTO turns (chat_id, seq, role, content, covers) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                [(conversation.chat_id, turn.seq, turn.role, turn.content, turn.covers)
+                                 for turn in turns])
+            if turns:
+                conversation.saved_seq = turns[-1].seq
+        return conversation.chat_id
+
+    def find(self, platform=None, server=None, channel=None, thread=None, author=None, limit=20):
+        where = []
+        params = []
+        for column, value in (("platform", platform), ("server", server), ("channel", channel),
+                              ("thread", thread), ("author", author)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        query = "SELECT * FROM chats"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY updated DESC, id DESC LIMIT ?"
+        with self.lock:
+            rows = self.db.execute(query, params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def load(self, chat_id):
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            return None
+        with self.lock:
+            rows = self.db.execute("SELECT seq, role, content, covers FROM turns WHERE chat_id = ? ORDER BY seq",
+                                   (chat_id,)).fetchall()
+        if not rows:
+            return None
+        chat = [{key: row[key] for key in row.keys() if row[key] is not None} for row in rows]
+        return Conversation.from_dict({"chat": chat, "chat_id": chat_id, "saved_seq": rows[-1]["seq"]})
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class JsonlChatStore(ChatStore):
+    """Chats stored as append-only JSONL files, one per chat, with an append-only index"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, "index.jsonl")
+
+    def _chat_path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.jsonl")
+
+    def save(self, conversation, platform, server="", channel="", thread="", author=""):
+        with self.lock:
+            turns = conversation.unsaved_turns()
+            if conversation.chat_id is None:
+                # Unique even when several chats are saved in the same second
+                conversation.chat_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+                entry = {"id": conversation.chat_id, "platform": platform, "server": server, "channel": channel,
+                         "thread": thread, "author": author, "title": chat_title(turns), "created": now()}
+                with open(self.index_path, "a") as file:
+                    file.write(json.dumps(entry) + "\n")
+            with open(self._chat_path(conversation.chat_id), "a") as file:
+                for turn in turns:
+                    file.write(json.dumps(turn.to_dict()) + "\n")
+            if turns:
+                conversation.saved_seq = turns[-1].seq
+        return conversation.chat_id
+
+    def find(self, platform=None, server=None, channel=None, thread=None, author=None, limit=20):
+        wanted = {"platform": platform, "server": server, "channel": channel, "thread": thread, "author": author}
+        matches = []
+        with self.lock:
+            try:
+                with open(self.index_path) as file:
+                    for line in file:
+                        entry = json.loads(line)
+                        if all(value is None or entry.get(key) == value for key, value in wanted.items()):
+                            matches.append(entry)
+            except FileNotFoundError:
+                return []
+        for entry in matches:
+            try:
+                updated = os.path.getmtime(self._chat_path(entry["id"]))
+            except OSError:
+                updated = 0
+            entry["updated"] = datetime.fromtimestamp(updated).strftime("%Y-%m-%d %H:%M:%S")
+        matches.sort(key=lambda entry: entry["updated"], reverse=True)
+        return matches[:limit]
+
+    def load(self, chat_id):
+        if not JSONL_CHAT_ID.fullmatch(str(chat_id)):
+            return None
+        chat = []
+        try:
+            with open(self._chat_path(chat_id)) as file:
+                for line in file:
+                    chat.append(json.loads(line))
+        except FileNotFoundError:
+            return None
+        if not chat:
+            return None
+        # A turn may have been written again, keep its latest version
+        chat = sorted({entry["seq"]: entry for entry in chat}.values(), key=lambda entry: entry["seq"])
+        return Conversation.from_dict({"chat": chat, "chat_id": chat_id, "saved_seq": chat[-1]["seq"]})
+
+
+def open_store(backend, directory):
+    """Open the chat store of the given backend type, creating its directory if required"""
+    os.makedirs(directory, exist_ok=True)
+    if backend == "sqlite":
+        return SQLiteChatStore(os.path.join(directory, "chats.db"))
+    if backend == "jsonl":
+        return JsonlChatStore(directory)
+    raise ValueError(f"Unknown chat store {backend}; use one of {BACKENDS}")
@@ -0,0 +1,130 @@
+"""Splitting of responses into messages that fit a chat platform's limits
+
+Responses are broken at line ends where possible, and lines longer than a
+whole message are hard split. Code blocks are kept intact across a split: a
+chunk ending inside a ``` fence has the fence closed, and the next chunk
+reopens it with the same opening line (so the language is kept).
+
+StreamChunker works incrementally on a streamed response, returning each
+chunk as soon as it is complete; split_text splits a whole response at once.
+"""
+
+# Maximum message length on each platform. Slack allows longer messages, but
+# collapses them and limits blocks to 3000 characters.
+PLATFORM_LIMITS = {
+    "discord": 2000,
+    "slack": 3000,
+}
+
+# Room left in each message for anything the platform or bot adds
+HEADROOM = 100
+
+FENCE = "```"
+
+
+def chunk_limit(platform):
+    """Return the chunk size to use for a platform"""
+    return PLATFORM_LIMITS[platform] - HEADROOM
+
+
+class StreamChunker:
+    """Split text fed in pieces into chunks of at most limit characters"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lines = []     # Lines (or parts of lines) in the chunk being filled
+        self.size = 0
+        self.partial = []   # Pieces of the line still being received
+        self.partial_size = 0
+        self.fence = None   # Opening line of the code block the chunk is in, if any
+        self.midline = False  # Whether the last text added was only part of a line
+
+    def _close(self):
+        return "\n" + FENCE if self.fence else ""
+
+    def _finish(self, chunks):
+        """Complete the chunk being filled, reopening any open code block in the next one"""
+        text = "".join(self.lines)
+        if text.strip() and text != self.fence:
+            chunks.append(text + self._close())
+        self.lines = [self.fence] if self.fence else []
+        self.size = len(self.fence) if self.fence else 0
+
+    def _add(self, text, chunks):
+        """Add a complete line, or a hard split part of one, to the chunk"""
+        fence = (not self.midline and text.lstrip().startswith(FENCE) and text.endswith("\n")
+                 and len(text) <= self.limit // 4)
+        closing = fence and self.fence
+        # Room for closing the chunk's code block: a closing fence takes the place of the one we
+        # would otherwise add, and an opening fence needs room for one
+        reserve = 0 if closing else len("\n" + FENCE) if fence else len(self._close())
+        # Start a new chunk rather than break a line, unless the line won't fit in one anyway
+        if not self.midline and self.size + len(text) + reserve > self.limit >= len(text) + reserve:
+            self._finish(chunks)
+            if closing:
+                # The fence closing the finished chunk ends the code block in place of this one
+                self.lines = []
+                self.size = 0
+                self.fence = None
+                return
+        # A line too long for a message of its own is split wherever it has to be; fences are
+        # short enough that they never are
+        while self.size + len(text) + reserve > self.limit:
+            cut = self.limit - self.size - reserve
+            if cut > 0:
+                self.lines.append(text[:cut])
+                self.size += cut
+                text = text[cut:]
+            self._finish(chunks)
+        self.lines.append(text)
+        self.size += len(text)
+        self.midline = not text.endswith("\n")
+        if fence:
+            self.fence = None if self.fence else text
+
+    def feed(self, text):
+        """Add text, returning the list of chunks completed by it"""
+        chunks = []
+        lines = text.split("\n")
+        for line in lines[:-1]:
+            self.partial.append(line + "\n")
+            self._add("".join(self.partial), chunks)
+            self.partial = []
+            self.partial_size = 0
+        if lines[-1]:
+            self.partial.append(lines[-1])
+            self.partial_size += len(lines[-1])
+            # Don't hold on to a line that can no longer fit in any message
+            if self.partial_size > self.limit:
+                self._add("".join(self.partial), chunks)
+                self.partial = []
+                self.partial_size = 0
+        return chunks
+
+    def flush(self):
+        """Return the remaining chunks once all the text has been fed"""
+        chunks = []
+        if self.partial:
+            self._add("".join(self.partial), chunks)
+            self.partial = []
+            self.partial_size = 0
+        self._finish(chunks)
+        self.lines = []
+        self.size = 0
+        self.fence = None
+        self.midline = False
+        return chunks
+
+    def pending(self):
+        """Return the text of the chunk still being filled, as it would be sent now"""
+        text = "".join(self.lines) + "".join(self.partial)
+        if text == self.fence:
+            return ""
+        close = self._close()
+        return text[:self.limit - len(close)] + close
+
+
+def split_text(text, limit):
+    """Split text into a list of chunks of at most limit characters"""
+    chunker = StreamChunker(limit)
+    return chunker.feed(text) + chunker.flush()
@@ -0,0 +1,75 @@
+"""API clients shared by everything in a process
+
+Each process uses a single OpenAI client (and a single async one), so all
+requests share one pool of kept-alive connections instead of each module
+opening its own, and new requests don't pay for a TCP and TLS handshake.
+HTTP/2 is used when the h2 package is installed, multiplexing concurrent
+requests over a few connections.
+
+The clients don't retry requests themselves; the request scheduler does.
+They are created on first use, so importing this module (or the modules
+using it) doesn't import openai or httpx, which are slow to load.
+"""
+
+import os
+import threading
+
+# Connection pool limits; concurrent requests beyond MAX_CONNECTIONS wait for a free connection
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 60
+
+# Responses can take minutes to generate, but connecting shouldn't take long
+TIMEOUT = 600
+CONNECT_TIMEOUT = 10
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _http_options():
+    """Keyword arguments for the httpx clients"""
+    import httpx
+
+    return {"limits": httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                   max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                   keepalive_expiry=KEEPALIVE_EXPIRY),
+            "timeout": httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT),
+            "http2": http2_available()}
+
+
+def openai_client():
+    """Return the OpenAI client shared by this process"""
+    global _client
+    with _lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI
+
+            options = _http_options()
+            _client = OpenAI(api_key=os.environ['OPENAI_API_KEY'], max_retries=0, timeout=options["timeout"],
+                             http_client=httpx.Client(**options))
+        return _client
+
+
+def async_openai_client():
+    """Return the async OpenAI client shared by this process"""
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            import httpx
+            from openai import AsyncOpenAI
+
+            options = _http_options()
+            _async_client = AsyncOpenAI(api_key=os.environ['OPENAI_API_KEY'], max_retries=0,
+                                        timeout=options["timeout"], http_client=httpx.AsyncClient(**options))
+        return _async_client
@@ -0,0 +1,281 @@
+"""The conversation model: the turns of a chat and the message lists sent for it
+
+This module has no dependencies beyond the standard library (tiktoken is used
+for counting tokens if it is installed), so the bots, chat stores and tools can
+load and manipulate conversations without importing the API client.
+"""
+
+import asyncio
+import threading
+
+# Approximate per-message overhead of the chat format, in tokens
+TOKENS_PER_MESSAGE = 4
+
+# Approximate memory used by a Turn beyond its content, in bytes
+TURN_OVERHEAD_BYTES = 200
+
+# Start of the system turn replacing older turns with a summary of them
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# Encoder used to count tokens; None until first needed, False if tiktoken isn't installed
+_encoding = None
+
+
+def count_tokens(text):
+    """Count the tokens in text, estimating from its length if tiktoken is not installed"""
+    global _encoding
+    if _encoding is None:
+        # tiktoken is slow to import, so it is only loaded once a token needs counting
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            _encoding = False
+    if not _encoding:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text))
+
+
+class Turn:
+    """Define an turn in a conversation"""
+
+    __slots__ = ("role", "content", "tokens", "seq", "covers")
+
+    def __init__(self, role, content, seq=0, covers=None):
+        self.role = role
+        self.content = content
+        self.tokens = count_tokens(content) + TOKENS_PER_MESSAGE
+        # Position of the turn in the order turns were recorded, used to save only new turns
+        self.seq = seq
+        # For a summary turn, the seq of the last turn it replaces
+        self.covers = covers
+
+    def to_message(self):
+        """Convert a Turn into a message list entry"""
+        return {"role": self.role, "content": self.content}
+
+    def to_dict(self):
+        """Convert a Turn into a dictionary entry"""
+        entry = {"role": self.role, "content": self.content, "seq": self.seq}
+        if self.covers is not None:
+            entry["covers"] = self.covers
+        return entry
+
+
+class Conversation:
+    def __init__(self):
+        self.turns = []
+        self.total_tokens = 0
+        self.content_bytes = 0
+        self.next_seq = 0
+        # Identity of this conversation in a chat store, and the last turn saved there
+        self.chat_id = None
+        self.saved_seq = -1
+        # Message list view of turns, extended as turns are added and rebuilt
+        # only after turns are cleared or replaced
+        self._messages = []
+        self._alock = None
+        # Held while turns are added or replaced, as a summary may be swapped in from another thread
+        self._lock = threading.Lock()
+        # Number of turns being taken (or other uses), during which the conversation must stay where it is
+        self.pending_turns = 0
+
+    def async_lock(self):
+        """Lock used to keep async turns on this conversation in order"""
+        if self._alock is None:
+            self._alock = asyncio.Lock()
+        return self._alock
+
+    def start_turn(self):
+        """Note that a turn is being taken (or the conversation is otherwise in use), until finish_turn is called"""
+        with self._lock:
+            self.pending_turns += 1
+
+    def finish_turn(self):
+        with self._lock:
+            self.pending_turns -= 1
+
+    def busy(self):
+        """Return True while a turn is being taken, or waiting to be taken, on this conversation"""
+        return self.pending_turns > 0
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a Conversation from a dictionary made by to_dict
+
+        Summary turns replace the turns they cover, so the turns of a saved chat
+        may also be given in the order they were recorded"""
+        turns = []
+        for i, entry in enumerate(data["chat"]):
+            turn = Turn(entry["role"], entry["content"], entry.get("seq", i), entry.get("covers"))
+            if turn.covers is None:
+                turns.append(turn)
+                continue
+            start = 1 if turns and turns[0].role == "system" and turns[0].covers is None else 0
+            # A summary replaces any earlier summary as well as the turns it covers
+            turns[start:] = [turn] + [old for old in turns[start:] if old.covers is None and old.seq > turn.covers]
+
+        conversation = cls()
+        for turn in turns:
+            conversation._append(turn)
+        conversation.chat_id = data.get("chat_id")
+        conversation.saved_seq = data.get("saved_seq", -1)
+        return conversation
+
+    def add_turn(self, role, content, covers=None):
+        with self._lock:
+            self._append(Turn(role, content, self.next_seq, covers))
+
+    def _append(self, turn):
+        self.turns.append(turn)
+        self.next_seq = max(self.next_seq, turn.seq + 1)
+        self.total_tokens += turn.tokens
+        self.content_bytes += len(turn.content)
+        if self._messages is not None:
+            self._messages.append(turn.to_message())
+
+    def _history_start(self):
+        """Index of the first turn after the system role"""
+        return 1 if self.turns and self.turns[0].role == "system" else 0
+
+    def to_message(self, budget=None):
+        """Convert a Conversation into a message list
+
+        The list is shared between calls and must not be modified by the caller.
+        With a token budget, the oldest turns after the system role are left out
+        until the rest fit; the most recent turn is always included. The list is
+        built under the lock, as a summary may be swapped in from another thread"""
+        with self._lock:
+            if self._messages is None:
+                self._messages = [turn.to_message() for turn in self.turns]
+            if budget is None or self.total_tokens <= budget:
+                return self._messages
+
+            turns = self.turns
+            start = self._history_start()
+            used = sum(turn.tokens for turn in turns[:start])
+            first = len(turns)
+            while first > start and (first == len(turns) or used + turns[first - 1].tokens <= budget):
+                first -= 1
+                used += turns[first].tokens
+            return self._messages[:start] + self._messages[first:]
+
+    def overflow(self, budget):
+        """Return how many of the oldest turns after the system role must go for the rest to fit budget"""
+        start = self._history_start()
+        excess = self.total_tokens - budget
+        count = 0
+        # Always leave the most recent turn in place
+        for turn in self.turns[start:-1]:
+            if excess <= 0:
+                break
+            excess -= turn.tokens
+            count += 1
+        return count
+
+    def oldest_turns(self, count):
+        """Return the count oldest turns after the system role"""
+        start = self._history_start()
+        return self.turns[start:start + count]
+
+    def compact(self, count, summary):
+        """Replace the count oldest turns after the system role with a summary turn"""
+        self.replace_turns(self.oldest_turns(count), summary)
+
+    def replace_turns(self, removed, summary):
+        """Replace turns returned by oldest_turns with a summary turn, returning the summary turn
+
+        The summary may have been written while other turns were taken, so if
+        the turns are no longer the oldest (as the conversation was cleared,
+        say) nothing is replaced and None is returned"""
+        with self._lock:
+            start = self._history_start()
+            count = len(removed)
+            if not removed or any(old is not new for old, new in zip(self.turns[start:start + count], removed)):
+                return None
+            covers = max(old.seq if old.covers is None else old.covers for old in removed)
+            turn = Turn("system", SUMMARY_PREFIX + summary, self.next_seq, covers)
+            self.next_seq += 1
+            self.turns[start:start + count] = [turn]
+            self.total_tokens += turn.tokens - sum(old.tokens for old in removed)
+            self.content_bytes += len(turn.content) - sum(len(old.content) for old in removed)
+            self._messages = None
+        return turn
+
+    def rebase(self, other, start, last=None):
+        """Replace the turns before index start with the turns of other, a newer copy of this conversation
+
+        Turns from start on are added again after other's turns; this is how
+        turns taken on a stale copy are merged into the latest one. last is the
+        turn expected just before start; if it isn't there any more (as the
+        conversation was cleared meanwhile, say) nothing is changed and False
+        is returned"""
+        with self._lock:
+            if start and (len(self.turns) < start or self.turns[start - 1] is not last):
+                return False
+            new = self.turns[start:]
+            self.turns = []
+            self.total_tokens = 0
+            self.content_bytes = 0
+            self.next_seq = 0
+            self._messages = None
+            for turn in other.turns:
+                self._append(turn)
+            for turn in new:
+                self._append(Turn(turn.role, turn.content, self.next_seq, turn.covers))
+            self.chat_id = other.chat_id
+            self.saved_seq = other.saved_seq
+        return True
+
+    def snapshot(self):
+        """Return a copy of the list of turns, taken while none are being added or replaced"""
+        with self._lock:
+            return list(self.turns)
+
+    def to_dict(self, turns=None):
+        """Convert a Conversation (or a snapshot of its turns) into a dictionary"""
+        data = {"chat": [obj.to_dict() for obj in (self.turns if turns is None else turns)]}
+        if self.chat_id is not None:
+            data["chat_id"] = self.chat_id
+            data["saved_seq"] = self.saved_seq
+        return data
+
+    def unsaved_turns(self):
+        """Return the turns recorded since the conversation was last saved"""
+        return [turn for turn in self.turns if turn.seq > self.saved_seq]
+
+    def clear(self):
+        """Clear the list, starting a new chat"""
+        with self._lock:
+            self.turns.clear()
+            self.total_tokens = 0
+            self.content_bytes = 0
+            self.next_seq = 0
+            self.chat_id = None
+            self.saved_seq = -1
+            self._messages = None
+
+    def set_system_role(self, role):
+        """Set the system role for this conversation"""
+        # TODO: Perhaps always do this in the first slot?
+        self.add_turn("system", role)
+        with self._lock:
+            self._messages = None
+
+    def size_bytes(self):
+        """Approximate memory held by this conversation"""
+        return self.content_bytes + len(self.turns) * TURN_OVERHEAD_BYTES
+
+    def get_system_role(self):
+        """Get the current system role for this conversation"""
+        return self.turns[0].content
+
+    def num_turns(self):
+        """Return the number of turns in the conversation"""
+        return int((len(self.turns)-1) / 2)
+
+    def get_entry(self, num):
+        return self.turns[num] if num <= len(self.turns) else Turn("","")
+
+    def __str__(self):
+        return "".join(f"{turn.role}: {turn.content}\n" for turn in self.turns)
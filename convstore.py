@@ -0,0 +1,414 @@
+"""Bounded store of live conversations shared by the bot frontends
+
+Conversations are keyed by a tuple identifying where they take place, such as
+(server, author, channel) for Discord or (user, channel, thread) for Slack.
+The store keeps at most a configured number of conversations and bytes in
+memory, evicting the least recently used (and any idle past a timeout) that
+have no turn underway. If a spill directory is given, evicted conversations
+are written there and loaded back transparently the next time they are asked
+for.
+
+Frontends sharing one store, as the bots do in botruntime.py, each use a
+namespace() of it, so their keys can't collide while the limits cover them
+all.
+
+Given a shared state backend (see statebackend.py), the store also keeps
+conversations there so several bot processes can serve the same users. Each
+get() checks whether another process has written the conversation since it
+was last read and picks up its turns; commit() writes the conversation back
+after a turn, merging in any turns written elsewhere in the meantime. Turns
+summarized here (see Conversation.replace_turns) are replaced by the summary in
+the merged copy too, unless the turns were changed elsewhere first. The
+backend is read and written without holding the store's lock, so other
+conversations aren't held up while the databases are busy; reads and writes
+of any one conversation are kept in order by a lock for its key.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from conversation import Conversation
+
+log = logging.getLogger('store')
+
+# Number of locks ordering the creation of conversations and their backend reads and writes, each
+# shared by the keys hashing to it
+SYNC_LOCKS = 64
+
+
+class ConversationStore:
+    """LRU store of conversations with optional spill to disk"""
+
+    def __init__(self, max_conversations=1000, max_bytes=256 * 1024 * 1024, idle_timeout=None, spill_dir=None,
+                 backend=None):
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.spill_dir = spill_dir
+        self.backend = backend
+        self.lock = threading.RLock()
+        # key -> [conversation, size in bytes, last used], least recently used first
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        # key -> path of the spilled conversation
+        self.spilled = {}
+        # key -> (version, number of turns, last turn, first two turns) when last read from or written to the
+        # backend
+        self.synced = {}
+        self.sync_locks = [threading.RLock() for _ in range(SYNC_LOCKS)]
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._index_spilled()
+
+    def _index_spilled(self):
+        """Find conversations spilled by an earlier run"""
+        for name in os.listdir(self.spill_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            try:
+                with open(path) as file:
+                    key = tuple(json.load(file)["key"])
+            except (OSError, ValueError, KeyError):
+                log.warning(f"Ignoring unreadable spill file {path}")
+                continue
+            self.spilled[key] = path
+
+    def _spill_path(self, key):
+        digest = hashlib.sha1(json.dumps(list(key)).encode()).hexdigest()
+        return os.path.join(self.spill_dir, digest + ".json")
+
+    def get(self, key, claim=False):
+        """Return the conversation for key, reloading it if it was spilled, or None if unknown
+
+        With claim set, the conversation is marked in use (see
+        Conversation.start_turn) before anything else can evict it"""
+        if self.backend is not None:
+            return self._get_shared(key, claim)
+        with self.lock:
+            entry = self.resident.get(key)
+            if entry is not None:
+                self.resident.move_to_end(key)
+                conversation = entry[0]
+                self._resize(entry)
+                entry[2] = time.monotonic()
+            else:
+                conversation = self._reload(key)
+                if conversation is None:
+                    return None
+                self._add(key, conversation)
+            if claim:
+                conversation.start_turn()
+            self._evict(key)
+            return conversation
+
+    def _get_shared(self, key, claim):
+        """get() with a backend, which is read without holding the store's lock"""
+        with self._sync_lock(key):
+            with self.lock:
+                entry = self.resident.get(key)
+                if entry is not None:
+                    self.resident.move_to_end(key)
+                    entry[2] = time.monotonic()
+            if entry is not None:
+                conversation = entry[0]
+                self._refresh(key, conversation)
+            else:
+                data, version = self.backend.load(key)
+                if data is None:
+                    return None
+                conversation = Conversation.from_dict(data)
+                self._synced(key, conversation.turns, version)
+            with self.lock:
+                # Nothing else can add or evict the key while its lock is held
+                if entry is None:
+                    self._add(key, conversation)
+                else:
+                    self._resize(entry)
+                if claim:
+                    conversation.start_turn()
+                evicted = self._evict(key)
+        self._write_evicted(evicted)
+        return conversation
+
+    def get_or_create(self, key, factory, claim=False):
+        """Return the conversation for key as get() does, or one made by factory() if there isn't one
+
+        The key's lock is held throughout, so threads asking for a new
+        conversation at the same time all get the same one"""
+        with self._sync_lock(key):
+            conversation = self.get(key, claim)
+            if conversation is None:
+                conversation = factory()
+                if claim:
+                    conversation.start_turn()
+                self.put(key, conversation)
+            return conversation
+
+    def put(self, key, conversation):
+        """Add or replace the conversation for key"""
+        if self.backend is None:
+            with self._sync_lock(key), self.lock:
+                self._remove(key)
+                self._add(key, conversation)
+                self._evict(key)
+            return
+        with self._sync_lock(key):
+            with self.lock:
+                self._remove(key)
+                self._add(key, conversation)
+            self._commit(key, conversation, replace=True)
+            with self.lock:
+                evicted = self._evict(key)
+        self._write_evicted(evicted)
+
+    def commit(self, key):
+        """Write the conversation for key to the backend, if there is one, after it has changed"""
+        if self.backend is None:
+            return
+        with self._sync_lock(key):
+            with self.lock:
+                entry = self.resident.get(key)
+            if entry is not None:
+                self._commit(key, entry[0])
+                with self.lock:
+                    self._resize(entry)
+
+    def _sync_lock(self, key):
+        """Lock held while the conversation for key is read from or written to the backend"""
+        return self.sync_locks[hash(key) % len(self.sync_locks)]
+
+    def _local_start(self, key, turns):
+        """Index of the first of a conversation's turns added since the backend was last read, and
+        whether the turns before it were compacted into a summary since
+
+        turns is a snapshot of the conversation's turns; None is returned if they were replaced"""
+        count, last, head = self.synced.get(key, (0, 0, None, []))[1:]
+        if not count:
+            return 0, False
+        if not turns or turns[0] is not head[0]:
+            # Cleared or given a new role
+            return None, False
+        if len(turns) < 2 or turns[1].covers is None or (len(head) > 1 and turns[1] is head[1]):
+            if len(turns) < count or turns[count - 1] is not last:
+                return None, False
+            return count, False
+        # A new summary follows the system role; the turns after the last one read are new
+        for index in range(len(turns) - 1, 1, -1):
+            if turns[index] is last:
+                return index + 1, True
+        # The summary covers the last turn read as well
+        return 2, True
+
+    def _synced(self, key, turns, version):
+        self.synced[key] = (version, len(turns), turns[-1] if turns else None, turns[:2])
+
+    def _compact(self, key, latest, prefix):
+        """Replace the turns of latest, a newer copy from the backend, that a summary made here covers
+
+        prefix is the conversation's turns before its new ones: the system role,
+        the summary and any turns read that it doesn't cover. Turns written
+        elsewhere since the backend was last read are kept after them. If latest no longer starts with the turns read then (as
+        it was cleared or summarized elsewhere), the summary is dropped"""
+        count, last = self.synced[key][1:3]
+        old = latest.turns[count - 1] if len(latest.turns) >= count else None
+        if old is None or (old.role, old.content, old.seq) != (last.role, last.content, last.seq):
+            log.info(f"Dropped summary of conversation {key} changed elsewhere")
+            return latest
+        compacted = Conversation.from_dict({"chat": [turn.to_dict() for turn in prefix]})
+        compacted.chat_id = latest.chat_id
+        compacted.saved_seq = latest.saved_seq
+        latest.rebase(compacted, count, old)
+        return latest
+
+    def _merge(self, key, conversation, data, version, start, turns, compacted=False):
+        """Rebase a conversation's turns from start on onto the backend's copy
+
+        With compacted set, the summary among the turns before start is kept
+        (see _compact). Returns False if the conversation's turns were replaced
+        since the snapshot turns was taken"""
+        latest = Conversation.from_dict(data)
+        if compacted:
+            latest = self._compact(key, latest, turns[:start])
+        if not conversation.rebase(latest, start, turns[start - 1] if start else None):
+            return False
+        # Turns added here but not yet written come after the backend's, which are now the conversation's first
+        self._synced(key, latest.turns, version)
+        return True
+
+    def _refresh(self, key, conversation):
+        """Pick up the turns other processes have written for a conversation"""
+        if self.backend.version(key) == self.synced.get(key, (0,))[0]:
+            return
+        turns = conversation.snapshot()
+        start, compacted = self._local_start(key, turns)
+        if start is None:
+            # Replaced here; commit() will overwrite the backend's copy
+            return
+        if compacted:
+            # Write the summary merged with the latest copy, so it isn't dropped by merging again
+            self._commit(key, conversation)
+            return
+        data, version = self.backend.load(key)
+        if data is not None:
+            self._merge(key, conversation, data, version, start, turns)
+
+    def _commit(self, key, conversation, replace=False):
+        """Write a conversation to the backend, retrying until no one else has written it in between
+
+        Unless replacing it, turns added since the conversation was read are
+        merged into the latest copy first. A conversation whose turns were
+        replaced (by clearing it, for instance) replaces the backend's copy"""
+        version = self.synced.get(key, (0,))[0]
+        turns = conversation.snapshot()
+        while True:
+            written = self.backend.save(key, conversation.to_dict(turns), version)
+            if written is not None:
+                self._synced(key, turns, written)
+                return
+            data, version = self.backend.load(key)
+            start, compacted = (None, False) if replace or data is None else self._local_start(key, turns)
+            if start is not None and self._merge(key, conversation, data, version, start, turns, compacted):
+                log.info(f"Merged conversation {key} with version {version} written elsewhere")
+            turns = conversation.snapshot()
+
+    def _add(self, key, conversation):
+        size = conversation.size_bytes()
+        self.resident[key] = [conversation, size, time.monotonic()]
+        self.resident_bytes += size
+
+    def _remove(self, key):
+        entry = self.resident.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+        path = self.spilled.pop(key, None)
+        if path is not None:
+            os.remove(path)
+
+    def _resize(self, entry):
+        """Refresh the recorded size of a conversation, which grows as turns are added"""
+        size = entry[0].size_bytes()
+        self.resident_bytes += size - entry[1]
+        entry[1] = size
+
+    def _reload(self, key):
+        path = self.spilled.pop(key, None)
+        if path is None:
+            return None
+        with open(path) as file:
+            conversation = Conversation.from_dict(json.load(file))
+        os.remove(path)
+        log.info(f"Reloaded spilled conversation {key}")
+        return conversation
+
+    def _evict(self, keep):
+        """Evict least recently used conversations, other than keep, until within limits
+
+        Conversations with a turn underway are skipped, as the turn would be
+        added to a copy the store no longer holds. With a backend, the evicted
+        conversations are returned, with their keys' locks held, to be passed
+        to _write_evicted once the store's lock is released"""
+        now = time.monotonic()
+        evicted = []
+        for key, entry in list(self.resident.items()):
+            if len(self.resident) <= 1:
+                break
+            idle = self.idle_timeout and now - entry[2] > self.idle_timeout
+            if not idle and len(self.resident) <= self.max_conversations and self.resident_bytes <= self.max_bytes:
+                break
+            if key == keep or entry[0].busy():
+                continue
+            if self.backend is not None:
+                # Waiting for another thread to release the key's lock here
+                # could deadlock; leave the key to a later eviction
+                lock = self._sync_lock(key)
+                if not lock.acquire(blocking=False):
+                    continue
+                evicted.append((key, entry[0], lock))
+            del self.resident[key]
+            self.resident_bytes -= entry[1]
+            if self.backend is None:
+                self._spill(key, entry[0])
+        return evicted
+
+    def _write_evicted(self, evicted):
+        """Write conversations evicted by _evict to the backend, where they are read back from
+
+        Holding the key's lock until then stops the conversation being read
+        back before it is written"""
+        for key, conversation, lock in evicted:
+            try:
+                turns = conversation.snapshot()
+                if self.synced.get(key, (0, 0, None))[1:3] != (len(turns), turns[-1] if turns else None):
+                    self._commit(key, conversation)
+                self.synced.pop(key, None)
+                log.info(f"Evicted conversation {key}")
+            finally:
+                lock.release()
+
+    def _spill(self, key, conversation):
+        if not self.spill_dir:
+            log.info(f"Evicted conversation {key}")
+            return
+        path = self._spill_path(key)
+        data = conversation.to_dict()
+        data["key"] = list(key)
+        with open(path, "w") as file:
+            json.dump(data, file)
+        self.spilled[key] = path
+        log.info(f"Spilled conversation {key} to {path}")
+
+    def resident_items(self):
+        """Return (key, conversation) pairs held in memory, least recently used first"""
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.resident.items()]
+
+    def spilled_keys(self):
+        """Return the keys of conversations spilled to disk"""
+        with self.lock:
+            return list(self.spilled)
+
+    def namespace(self, name):
+        """Return a view of the store for one frontend's conversations"""
+        return Namespace(self, name)
+
+    def summary(self):
+        """One line description of what the store is holding"""
+        with self.lock:
+            return (f"{len(self.resident)} conversations resident ({self.resident_bytes // 1024} KiB), "
+                    f"{len(self.spilled)} spilled to disk")
+
+
+class Namespace:
+    """View of a ConversationStore with every key prefixed by a name"""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get(self, key, claim=False):
+        return self.store.get((self.name,) + key, claim)
+
+    def get_or_create(self, key, factory, claim=False):
+        return self.store.get_or_create((self.name,) + key, factory, claim)
+
+    def put(self, key, conversation):
+        self.store.put((self.name,) + key, conversation)
+
+    def commit(self, key):
+        self.store.commit((self.name,) + key)
+
+    def resident_items(self):
+        return [(key[1:], conversation) for key, conversation in self.store.resident_items() if key[0] == self.name]
+
+    def spilled_keys(self):
+        return [key[1:] for key in self.store.spilled_keys() if key[0] == self.name]
+
+    def summary(self):
+        return self.store.summary()
@@ -0,0 +1,50 @@
+"""Recognising events the bots have already handled
+
+Slack redelivers an event if it isn't acknowledged quickly enough, and Discord
+can replay events when its gateway connection resumes. The bots remember the
+ids of recent events in a SeenSet and drop any they see again, before doing
+any work for them. Ids are forgotten after a time-to-live, and the oldest are
+forgotten early if too many are held.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+# Slack gives up redelivering an event after about an hour
+DEFAULT_TTL = 3600
+DEFAULT_MAX_SIZE = 10000
+
+
+class SeenSet:
+    """Bounded set of recently seen ids, each expiring after ttl seconds"""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # id -> when it was first seen, oldest first
+        self.seen_at = OrderedDict()
+
+    def seen(self, key):
+        """Return True if key was seen within the ttl, otherwise record it and return False"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if key in self.seen_at:
+                return True
+            self.seen_at[key] = now
+            if len(self.seen_at) > self.max_size:
+                self.seen_at.popitem(last=False)
+            return False
+
+    def _expire(self, now):
+        while self.seen_at:
+            key, when = next(iter(self.seen_at.items()))
+            if now - when <= self.ttl:
+                break
+            self.seen_at.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.seen_at)
@@ -13,29 +13,35 @@ TODO
   and regenerating responses. Perhaps look at automatically threading conversations should there is
   natural interface for multiple conversations
 * Define a few default system roles that can be easily selected
-* Allow interface to different models, such as images
 
 """
 
 # Notes
 # Installed discord and python-dotenv packages
 
-from datetime import datetime
 import argparse
+import asyncio
+import contextlib
+import io
 import logging
 import json
 import os
+import signal
+import sys
+import time
 
 import discord
 from discord.ext import commands
+import botcommon
 import chatai
+import chatstore
+import chunker
+import metrics
+from autosave import AutoSaver
+from dedupe import SeenSet
+from imagegen import ImageService
+from statebackend import shard
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(name)-7s | %(levelname)-8s | %(module)s:%(lineno)-4d | %(message)s",
-    datefmt='%a %d %b %Y %I:%M:%S %p %z',
-    filename='discord.log',
-)
 botlog = logging.getLogger('dbot')
 
 
@@ -51,8 +57,27 @@ client = commands.Bot(command_prefix=COMMAND_PREFIX, description=DESCRIPTION, in
 
 token = os.getenv('DISCORD_CHATGPT_BOT_TOKEN')
 
-# Create a dictionary of conversations
-conversations = {}
+# Conversations keyed by (server, author, channel); set by setup()
+conversations = None
+
+# Background saver of changed conversations, if enabled
+autosaver = None
+
+# Image generation for .image; set by setup()
+images = None
+
+# Ids of the messages handled recently, to drop any delivered again
+seen_messages = SeenSet()
+
+def add_arguments(parser):
+    """Add the options only the Discord bot has"""
+    parser.add_argument("-i", "--max-inflight", help="Maximum concurrent requests to openAI", type=int, default=8)
+    parser.add_argument("--discord-workers", help="Number of Discord bot processes sharing the token; Discord "
+                                                  "sends every message to each of them", type=int, default=1)
+    parser.add_argument("--discord-worker-index", help="Which of the --discord-workers processes this is; it only "
+                                                       "answers the conversations whose key hashes to it",
+                        type=int, default=0)
+
 
 def get_args():
     """Get command-line arguments"""
@@ -61,33 +86,43 @@ def get_args():
         description="Interface to chatGPT discord-bot",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-
-    parser.add_argument("-f", "--directory", help="Directory to store chats", default="discord_chats")
-    parser.add_argument("-m", "--model", help="Select the model to use", default="gpt-4") # gpt-4
+    botcommon.add_arguments(parser, "discord_chats", "discord_images")
+    add_arguments(parser)
 
     return parser.parse_args()
 
 
-def set_system_role(conversation, system_role=None):
-    if system_role is None:
-        conversation.set_system_role("You are a helpful assistant")
-    else:
-        conversation.set_system_role(system_role)
+def get_conversation(author_id, server_id, channel_id, claim=False):
+#    print(f'get_conversation on server {server_id} author {author_id} channel {channel_id}')
 
-def get_system_role(conversation):
-    return conversation.get_system_role()
+    return botcommon.get_conversation(conversations, (server_id, author_id, channel_id), claim=claim)
 
-def get_conversation(author_id, server_id, channel_id):
-#    print(f'get_conversation on server {server_id} author {author_id} channel {channel_id}')
 
-    if server_id not in conversations:
-        conversations[server_id] = {}
-    if author_id not in conversations[server_id]:
-        conversations[server_id][author_id] = {}
-    if channel_id not in conversations[server_id][author_id]:
-        conversations[server_id][author_id][channel_id] = chatai.Conversation()
-        set_system_role(conversations[server_id][author_id][channel_id])
-    return conversations[server_id][author_id][channel_id]
+@contextlib.asynccontextmanager
+async def using_conversation(author_id, server_id, channel_id, commit=False):
+    """Get a conversation and keep the store from evicting it until the block ends
+
+    The store may read and write the shared state, so it is used from a worker
+    thread rather than the event loop. With commit set, the conversation is
+    written back to the shared state at the end of the block"""
+    conversation = await asyncio.to_thread(get_conversation, author_id, server_id, channel_id, True)
+    try:
+        yield conversation
+        if commit:
+            await asyncio.to_thread(conversations.commit, (server_id, author_id, channel_id))
+    finally:
+        conversation.finish_turn()
+
+
+def owns(message):
+    """Return True if this process answers the conversation a message belongs to
+
+    Every process logged in with the token receives every message, so with
+    --discord-workers each answers only its share of the conversations"""
+    if args.discord_workers <= 1:
+        return True
+    key = (message.guild.name, message.author.name, message.channel.name)
+    return shard(key, args.discord_workers) == args.discord_worker_index
 
 @client.event
 async def on_ready():
@@ -103,29 +138,60 @@ async def on_member_join(member):
 async def on_member_remove(member):
     botlog.info(f'{member} has left a server')
 
-def process_chat_turn(conversation, message, model):
-    botlog.info(f"user asks: {message}")
-    response = chatai.take_turn(conversation, model, message)
-    botlog.info(f"assistant responses: {response}")
-
-    # This should be its own helper function. One issue here is that there
-    # will be a line break if the split is midline
-
-    # Discord has a 2000 character response limit - Split the response into
-    # chunks of 1900 characters or less, and also prevent splitting in the
-    # middle of a line; we use 1900 to give plenty of room for any additional
-    # message overhead
-
-    response_chunks = []
-    chunk = ""
-    for line in response.split("\n"):
-        if len(chunk) + len(line) + 1 > 1900:
-            response_chunks.append(chunk)
-            chunk = ""
-        chunk += line + "\n"
-    response_chunks.append(chunk)
-
-    return response_chunks
+# Minimum number of seconds between edits of a message being streamed
+EDIT_INTERVAL = 1.0
+
+
+async def stream_chat_turn(channel, conversation, message, model, user=None):
+    """Stream a response into the channel, posting the first text early and editing it as it grows
+
+    Chunks are split as in botcommon.process_chat_turn; once a chunk is
+    complete it is finalized and the rest of the response continues in a new
+    message"""
+    metrics.sampled_debug(botlog, args.log_sample, "user asks: %s", message)
+    chunks = chunker.StreamChunker(chunker.chunk_limit("discord"))
+    sent = None     # Message holding the chunk currently being filled
+    shown = ""      # What that message currently displays
+    last_edit = 0
+    response = []
+
+    async def finalize(chunk):
+        nonlocal sent, shown
+        if sent is None:
+            await timed_send(channel.send(chunk))
+        elif chunk != shown:
+            await timed_send(sent.edit(content=chunk))
+        sent, shown = None, ""
+
+    async for delta in chatai.astream_turn(conversation, model, message, temperature=args.temperature,
+                                                user=user):
+        response.append(delta)
+        for chunk in chunks.feed(delta):
+            await finalize(chunk)
+
+        now = time.monotonic()
+        if sent is not None and now - last_edit < EDIT_INTERVAL:
+            continue
+        text = chunks.pending()
+        if not text.strip() or text == shown:
+            continue
+        if sent is None:
+            sent = await timed_send(channel.send(text))
+        else:
+            await timed_send(sent.edit(content=text))
+        shown, last_edit = text, now
+
+    for chunk in chunks.flush():
+        await finalize(chunk)
+    metrics.sampled_debug(botlog, args.log_sample, "assistant responses: %s", "".join(response))
+
+
+async def timed_send(request):
+    """Await a send or edit of a message, recording how long Discord took"""
+    start = time.monotonic()
+    result = await request
+    metrics.observe("bot_send_seconds", time.monotonic() - start)
+    return result
 
 
 @client.event
@@ -137,6 +203,16 @@ async def on_message(message):
     if message.author.bot:
         return
 
+    # Another process answers this conversation (and its commands)
+    if not owns(message):
+        return
+
+    # Events can be replayed when the gateway connection resumes
+    if seen_messages.seen(message.id):
+        botlog.info(f"Dropped duplicate message {message.id}")
+        metrics.inc("bot_duplicate_events_total", platform="discord")
+        return
+
     # Ensure we can handle commands; if not a command, treat it as chat input
     # We also ignore slash commands... note we don't ignore the response from
     # something like /giphy - presumably that comes from a different client?
@@ -146,12 +222,25 @@ async def on_message(message):
         # Now interface with chatai
         await message.channel.typing()  # Simulate typing
 
-        conversation = get_conversation(message.author.name, message.guild.name, message.channel.name)
-        response_chunks = process_chat_turn(conversation, message.content, args.model)
-
-        # Send each chunk as a separate message
-        for chunk in response_chunks:
-            await message.channel.send(chunk)
+        async with using_conversation(message.author.name, message.guild.name, message.channel.name,
+                                      commit=True) as conversation:
+            with metrics.labelled(platform="discord", guild=message.guild.name, channel=message.channel.name,
+                                  model=args.model):
+                start = time.monotonic()
+                if args.stream:
+                    await stream_chat_turn(message.channel, conversation, message.content, args.model,
+                                           message.author.name)
+                else:
+                    response_chunks = await botcommon.aprocess_chat_turn(conversation, message.content, args,
+                                                                         "discord", botlog, message.author.name)
+
+                    # Send each chunk as a separate message
+                    for chunk in response_chunks:
+                        await timed_send(message.channel.send(chunk))
+                metrics.observe("bot_turn_seconds", time.monotonic() - start)
+
+        if autosaver:
+            autosaver.mark_dirty((message.guild.name, message.author.name, message.channel.name), conversation)
 
 @client.command()
 async def test(ctx):
@@ -162,46 +251,76 @@ async def test(ctx):
 @client.command(aliases=['new', 'newconv', 'reset'])
 async def clear(ctx):
     """Start a new conversation"""
-    conversation = get_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name)
-    conversation.clear()
-    set_system_role(conversation)
+    async with using_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name, commit=True) as conversation:
+        conversation.clear()
+        botcommon.set_system_role(conversation)
     await ctx.send("Starting a new conversation")
 
 @client.command(aliases=['system_role', 'sysrole', 'system'])
 async def role(ctx, *sysrole):
     """Specify what role chatGPT should take and start a new conversation"""
-    conversation = get_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name)
-
-    if len(sysrole) == 0:
-        msg = f"Current system role: {get_system_role(conversation)}"
-    else:
-        role_str = ' '.join(sysrole)
-        conversation.clear()
-        set_system_role(conversation, role_str)
-        msg = f"Starting a new conversation with system role: {role_str}"
+    async with using_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name,
+                                  commit=len(sysrole) > 0) as conversation:
+        if len(sysrole) == 0:
+            msg = f"Current system role: {conversation.get_system_role()}"
+        else:
+            role_str = ' '.join(sysrole)
+            conversation.clear()
+            botcommon.set_system_role(conversation, role_str)
+            msg = f"Starting a new conversation with system role: {role_str}"
     await ctx.send(msg)
 
 
 @client.command(aliases=['store', 'record'])
 async def save(ctx, *sysrole):
-    """Store a chat to a file"""
-    save_time = datetime.now()
-    save_time = save_time.strftime("%Y-%m-%d %H:%M:%S")
-
-    conversation = get_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name)
-    filename = chatai.write_chat(args.directory, save_time, conversation)
-    msg = f'Chat written to {filename}'
+    """Store a chat"""
+    async with using_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name) as conversation:
+        chat_id = chatai.write_chat(chat_store, conversation, "discord", server=ctx.guild.name,
+                                    channel=ctx.channel.name, author=ctx.author.name)
+    msg = f'Chat saved as {chat_id}'
     await ctx.send(msg)
 
 
+@client.command(aliases=['history'])
+async def saved(ctx):
+    """List your chats saved in this channel"""
+    chats = chat_store.find(platform="discord", server=ctx.guild.name, channel=ctx.channel.name,
+                            author=ctx.author.name)
+    for chat in chats:
+        await ctx.send(f"{chat['id']}: {chat['title']} (updated {chat['updated']})")
+    await ctx.send(f"{len(chats)} saved chats; use {COMMAND_PREFIX}restore <id> to continue one")
+
+
+@client.command(aliases=['load'])
+async def restore(ctx, chat_id):
+    """Continue a saved chat in this channel"""
+    conversation = chat_store.load(chat_id)
+    if conversation is None:
+        await ctx.send(f"No saved chat {chat_id}")
+        return
+    await asyncio.to_thread(conversations.put, (ctx.guild.name, ctx.author.name, ctx.channel.name), conversation)
+    await ctx.send(f"Restored chat {chat_id} with {conversation.num_turns()} entries")
+
+
+@client.command(aliases=['img', 'dalle'])
+async def image(ctx, *, prompt):
+    """Generate an image from a prompt"""
+    job = images.submit(prompt)
+    # Other messages are handled as usual while the image is generated
+    async with ctx.typing():
+        await asyncio.wrap_future(job.future)
+    if job.status != "done":
+        await ctx.send(f"Unable to generate an image: {job.error}")
+        return
+    await ctx.send(file=discord.File(io.BytesIO(images.read(job.digest)), filename=f"{job.digest[:16]}.png"))
+    botlog.info(f"Sent image {job.digest}" + (" from the cache" if job.cached else ""))
+
+
 @client.command()
 async def report(ctx):
     """Provide a JSON report of the current conversation"""
-    # This should be its own helper function. One issue here is that there
-    # will be a line break if the split is midline
-
-    conversation = get_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name)
-    response = conversation.to_message()
+    async with using_conversation(ctx.author.name, ctx.guild.name, ctx.channel.name) as conversation:
+        response = conversation.to_message()
 
     # Convert the dictionary to a JSON string so it displays nicer
     json_str = json.dumps(response, indent=4)
@@ -220,12 +339,8 @@ async def report(ctx):
     # Send the message to Discord
 #    await ctx.send(embed=embed)
 
-    # Split the response into chunks of 1900 characters or less as discord has
-    # a 2000 character response limit, and we want to also provide extra room
-    # for any additional response overhead.
-    # Note: We don't split on line breaks as the response here is in JSON and
-    # may be a single line
-    response_chunks = [json_str[i:i + 1900] for i in range(0, len(json_str), 1900)]
+    # Split the JSON over as many messages as needed, as a code block in each
+    response_chunks = chunker.split_text(f"```json\n{json_str}\n```", chunker.chunk_limit("discord"))
 
     # Send each chunk as a separate message
     for chunk in response_chunks:
@@ -235,20 +350,65 @@ async def report(ctx):
 @client.command()
 async def chats(ctx):
     """Report summary information on all chats"""
-    for serv in conversations:
-        for auth in conversations[serv]:
-            for chan in conversations[serv][auth]:
-                msg = f"Chat stored for Server: {serv} Author: {auth} Chan: {chan} with {int(conversations[serv][auth][chan].num_turns())} entries"
-                await ctx.send(msg)
-    await ctx.send("End of chats")
+    for (serv, auth, chan), conversation in conversations.resident_items():
+        msg = f"Chat stored for Server: {serv} Author: {auth} Chan: {chan} with {int(conversation.num_turns())} entries"
+        await ctx.send(msg)
+    for serv, auth, chan in conversations.spilled_keys():
+        await ctx.send(f"Chat spilled to disk for Server: {serv} Author: {auth} Chan: {chan}")
+    await ctx.send(f"End of chats: {conversations.summary()}")
+
+@client.command()
+async def cache(ctx):
+    """Report response cache statistics"""
+    if chatai.response_cache is None:
+        await ctx.send("The response cache is not enabled")
+        return
+    stats = chatai.response_cache.stats()
+    await ctx.send(f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+                   f"({stats['hit_rate']:.0%}), {stats['entries']} entries")
+
+def setup(bot_args, store, bot_conversations, bot_images):
+    """Give the bot its settings, chat store, live conversations and image service
+
+    main() calls this when the bot runs on its own; botruntime.py calls it
+    with a store and image service shared with the Slack bot"""
+    global args, chat_store, conversations, images, autosaver
+    args = bot_args
+    chat_store = store
+    conversations = bot_conversations
+    images = bot_images
+    if args.debug:
+        botlog.setLevel(logging.DEBUG)
+    if not 0 <= args.discord_worker_index < args.discord_workers:
+        raise ValueError(f"--discord-worker-index must be from 0 to {args.discord_workers - 1}")
+    chatai.set_max_inflight(args.max_inflight)
+
+    if args.autosave_interval:
+        autosaver = AutoSaver(chat_store, "discord",
+                              lambda key: {"server": key[0], "author": key[1], "channel": key[2]},
+                              args.autosave_interval, args.autosave_threshold)
+
+
+def shutdown():
+    """Save anything the autosaver is holding"""
+    if autosaver:
+        autosaver.stop()
+
 
 def main():
-    global args
     args = get_args()
+    botcommon.configure_logging('discord.log')
+    botcommon.configure(args, botlog)
+    setup(args, chatstore.open_store(args.backend, args.directory), botcommon.open_conversations(args),
+          ImageService(model=args.image_model, directory=args.image_dir))
 
-    client.run(token)
+    # Exit cleanly on SIGTERM (as sent by aictrl.sh stop) so the final autosave happens
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        client.run(token)
+    finally:
+        shutdown()
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,56 @@
+"""Keyed work dispatcher
+
+Runs work items on a pool of worker threads while keeping items that share a
+key in strict submission order. The Slack frontend uses this so that turns in
+one thread are answered in order while different threads run in parallel.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+log = logging.getLogger('dispatch')
+
+
+class KeyedDispatcher:
+    """Dispatch callables to a thread pool, serialized per key"""
+
+    def __init__(self, workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.lock = threading.Lock()
+        # Work waiting for each active key; a key is present while one worker is draining it
+        self.pending = {}
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to run after any earlier work with the same key"""
+        with self.lock:
+            queue = self.pending.get(key)
+            if queue is not None:
+                queue.append((fn, args, kwargs))
+                return
+            self.pending[key] = deque([(fn, args, kwargs)])
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        """Run the queued work for a key until there is none left"""
+        while True:
+            with self.lock:
+                queue = self.pending[key]
+                if not queue:
+                    del self.pending[key]
+                    return
+                fn, args, kwargs = queue.popleft()
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                log.exception(f"Work for {key} failed")
+
+    def backlog(self):
+        """Return the number of queued items not yet started"""
+        with self.lock:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def shutdown(self, wait=True):
+        """Stop accepting work, optionally waiting for queued work to finish"""
+        self.executor.shutdown(wait=wait)
@@ -1,17 +1,10 @@
-from openai import OpenAI
+from imagegen import ImageService
 
-from flask import Flask, send_file, make_response
-import io
+from flask import Flask, jsonify, make_response, request, send_file
 import webbrowser
 import time
 import threading
 
-import os
-import base64
-
-# Replace YOUR_API_KEY with your OpenAI API key
-client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-
 # Specify the model to use
 model = 'dall-e-3'
 
@@ -21,47 +14,78 @@ size = '1024x1024'
 # Specify image quality
 quality = 'hd' # Could be 'standard'
 
+# Images generated at once; the scheduler keeps the requests within the model's rate limit
+workers = 4
+
 app = Flask(__name__)
 
-img_ready = False
+images = ImageService(None, model, size, quality, workers, directory='images')
+
+# Job for the most recent prompt, shown at /
+latest_job = None
 
 def ask_input():
-    global img_ready
+    global latest_job
 
     time.sleep(1)
 
     while True:
         prompt = input('dalle3> ')
 
-        img_ready = False
+        # Generation happens in the background, so further prompts can be entered straight away
+        latest_job = images.submit(prompt)
+        print(f'Queued job {latest_job.id}')
 
-        response = client.images.generate(prompt=prompt,
-                                          model=model,
-                                          size=size,
-                                          quality=quality,
-                                          response_format="b64_json")
-
-        global image_data
-        image_data = response.data[0].b64_json
-        with open('image.png', 'wb') as handler:
-            handler.write(base64.b64decode(image_data))
-        img_ready = True
+def image_response(digest, immutable):
+    """Serve a cached image, answering conditional requests with 304 Not Modified"""
+    if request.if_none_match.contains(digest):
+        response = make_response('', 304)
+    else:
+        response = make_response(send_file(images.path(digest), mimetype='image/png'))
+    response.set_etag(digest)
+    if immutable:
+        # The URL names the image's content, so it can never change
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/generate', methods=['POST'])
+def generate():
+    """Queue a prompt given as JSON {"prompt": ...} or form data, returning the job"""
+    data = request.get_json(silent=True) or request.form
+    prompt = data.get('prompt')
+    if not prompt:
+        return jsonify({'error': 'No prompt given'}), 400
+    return jsonify(images.submit(prompt).to_dict()), 202
 
 @app.route('/status')
 def status():
-    return jsonify({'ready': img_ready})
+    """Status of the jobs in ?ids=1,2,3, or of the most recent prompt"""
+    ids = request.args.get('ids')
+    if ids:
+        return jsonify(images.status([job_id for job_id in ids.split(',') if job_id]))
+    job = latest_job
+    return jsonify({'ready': job is not None and job.status == 'done',
+                    'job': job.to_dict() if job else None})
+
+@app.route('/images/<digest>.png')
+def cached_image(digest):
+    if not images.exists(digest):
+        return 'No such image', 404
+    return image_response(digest, immutable=True)
 
 @app.route('/')
 def display_image():
-    if img_ready:
-    #    img_b64 = "..."  # Your base64 string here.
-        img_bytes = base64.b64decode(image_data)
-        img = io.BytesIO(img_bytes)
-        return send_file(img, mimetype='image/png')
+    job = latest_job
+    if job is not None and job.status == 'done':
+        return image_response(job.digest, immutable=False)
     else:
         return "Image is not ready yet. Please refresh later."
 
 if __name__ == '__main__':
-    threading.Thread(target=ask_input).start()
+    threading.Thread(target=ask_input, daemon=True).start()
     webbrowser.open("http://127.0.0.1:5000/")
-    app.run()
\ No newline at end of file
+    app.run()
@@ -0,0 +1,181 @@
+"""Image generation service
+
+Prompts are submitted as jobs, each with an id that can be polled for its
+status, and generated concurrently on a pool of worker threads through the
+request scheduler. Each image is decoded once when it arrives and stored in a
+content-addressed cache on disk, named by the SHA-256 of its bytes, so an
+image can be served (and cached by browsers) forever under its digest.
+
+The digest generated for each prompt is remembered (on disk, so it survives
+restarts), and a prompt already answered, or still being generated, is not
+sent to the API again, as every image generated is billed.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import clients
+from scheduler import get_scheduler
+
+log = logging.getLogger('images')
+
+# Finished jobs remembered for status requests
+MAX_JOBS = 1000
+
+
+class ImageJob:
+    """A prompt waiting for, or turned into, an image"""
+
+    def __init__(self, job_id, prompt):
+        self.id = job_id
+        self.prompt = prompt
+        self.status = "queued"  # then "running", and "done" or "failed"
+        self.digest = None
+        self.error = None
+        self.cached = False     # Whether the image came from the prompt cache
+        self.created = time.time()
+        self.finished = threading.Event()
+        # Resolved when the job finishes; wrap with asyncio.wrap_future to await it
+        self.future = None
+
+    def to_dict(self):
+        return {"id": self.id, "prompt": self.prompt, "status": self.status, "image": self.digest,
+                "error": self.error, "cached": self.cached}
+
+
+class ImageService:
+    """Queue of image generation jobs with an on-disk cache of the results"""
+
+    def __init__(self, client=None, model="dall-e-3", size="1024x1024", quality="hd", workers=4, directory="images"):
+        # The process's shared client is used unless another is given
+        self.client = client
+        self.model = model
+        self.size = size
+        self.quality = quality
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.ids = itertools.count(1)
+        # Prompt key -> digest of the image generated for it, and -> job still generating it
+        self.prompts = {}
+        self.generating = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load_prompts()
+
+    def _prompts_path(self):
+        return os.path.join(self.directory, "prompts.jsonl")
+
+    def _load_prompts(self):
+        try:
+            with open(self._prompts_path()) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.prompts[entry["key"]] = entry["digest"]
+        except FileNotFoundError:
+            pass
+
+    def prompt_key(self, prompt):
+        """Key of the request made for a prompt, ignoring differences in whitespace"""
+        data = json.dumps([self.model, self.size, self.quality, " ".join(prompt.split())])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def submit(self, prompt):
+        """Queue a prompt, returning the job; repeated prompts are answered from the cache"""
+        key = self.prompt_key(prompt)
+        with self.lock:
+            job = self.generating.get(key)
+            if job is not None:
+                return job
+            job = ImageJob(str(next(self.ids)), prompt)
+            self.jobs[job.id] = job
+            self._forget()
+            digest = self.prompts.get(key)
+            if digest is not None and os.path.exists(self.path(digest)):
+                job.digest, job.status, job.cached = digest, "done", True
+                job.future = Future()
+                job.future.set_result(job)
+                job.finished.set()
+                return job
+            self.generating[key] = job
+            job.future = self.executor.submit(self._run, job, key)
+        return job
+
+    def _forget(self):
+        """Drop the oldest finished jobs beyond MAX_JOBS"""
+        while len(self.jobs) > MAX_JOBS and next(iter(self.jobs.values())).finished.is_set():
+            self.jobs.popitem(last=False)
+
+    def _run(self, job, key):
+        job.status = "running"
+        try:
+            client = self.client or clients.openai_client()
+            response = get_scheduler().call(self.model, lambda: client.images.with_raw_response.generate(
+                prompt=job.prompt, model=self.model, size=self.size, quality=self.quality,
+                response_format="b64_json"))
+            job.digest = self.store(base64.b64decode(response.data[0].b64_json))
+            job.status = "done"
+            with self.lock:
+                self.prompts[key] = job.digest
+                with open(self._prompts_path(), "a") as file:
+                    file.write(json.dumps({"key": key, "digest": job.digest}) + "\n")
+        except Exception as error:
+            log.exception(f"Image job {job.id} failed")
+            job.error = str(error)
+            job.status = "failed"
+        finally:
+            with self.lock:
+                self.generating.pop(key, None)
+            job.finished.set()
+        return job
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".png")
+
+    def store(self, data):
+        """Add image bytes to the cache, returning their digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp, "wb") as file:
+                file.write(data)
+            os.replace(temp, path)
+        return digest
+
+    def read(self, digest):
+        """Return the bytes of a cached image"""
+        with open(self.path(digest), "rb") as file:
+            return file.read()
+
+    def get(self, job_id):
+        """Return a job by id, or None"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_ids):
+        """Return the status of each job, by id; unknown jobs are reported as such"""
+        with self.lock:
+            jobs = {job_id: self.jobs.get(job_id) for job_id in job_ids}
+        return {job_id: job.to_dict() if job else {"id": job_id, "status": "unknown"}
+                for job_id, job in jobs.items()}
+
+    def exists(self, digest):
+        """Whether an image is in the cache; digests are checked, so they are safe to use in paths"""
+        return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest) \
+            and os.path.exists(self.path(digest))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,157 @@
+"""Request metrics for the OpenAI tools and bots
+
+Counters and histograms are kept in a process-wide registry and rendered in
+the Prometheus text exposition format, either served over HTTP or dumped to a
+log periodically. Labels such as the platform, guild and channel of the turn
+being handled are set once per turn with labelled() and picked up by every
+metric recorded while handling it, including those recorded by chatai and the
+request scheduler.
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextvars
+import logging
+import random
+import threading
+
+log = logging.getLogger('metrics')
+
+# Histogram buckets for durations in seconds, and for token counts
+SECONDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKENS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+_labels = contextvars.ContextVar("metric_labels", default={})
+
+
+@contextmanager
+def labelled(**labels):
+    """Apply labels to every metric recorded within the block (in this thread or task)"""
+    token = _labels.set(dict(_labels.get(), **labels))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def _key(labels):
+    merged = dict(_labels.get(), **labels)
+    return tuple(sorted((name, str(value)) for name, value in merged.items() if value is not None))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    text = ",".join('{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs)
+    return "{" + text + "}"
+
+
+class Histogram:
+    """Cumulative histogram of observed values"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry:
+    """Counters and histograms keyed by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter"""
+        key = _key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS, **labels):
+        """Record a value in a histogram"""
+        key = _key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', str(bound))])} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+render = registry.render
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve the metrics at http://host:port/metrics from a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            data = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def dump_every(interval, logger):
+    """Write the metrics to logger every interval seconds from a background thread"""
+
+    def run():
+        stop = threading.Event()
+        while not stop.wait(interval):
+            logger.info("metrics\n" + render())
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+
+
+def sampled_debug(logger, rate, message, *args):
+    """Log a debug message for a random fraction rate of calls, so full text logging stays cheap at volume"""
+    if rate and logger.isEnabledFor(logging.DEBUG) and random.random() < rate:
+        logger.debug(message, *args)
@@ -0,0 +1,182 @@
+"""Cache of chat responses for identical prompts
+
+Responses are keyed on a hash of the model, temperature and the message list
+(with whitespace normalized), held in a size-bounded LRU in memory with an
+expiry time, and optionally in a directory on disk so they survive restarts.
+The directory is bounded too: once it holds too many responses, expired ones
+and then the least recently used are removed. Only deterministic requests
+should be cached; see chatai.cache_key.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger('cache')
+
+
+def make_key(model, temperature, messages):
+    """Hash of the request parameters that determine a response"""
+    normalized = [[message["role"], " ".join(message["content"].split())] for message in messages]
+    data = json.dumps([model, temperature, normalized], separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of responses with a time to live and an optional on-disk tier"""
+
+    def __init__(self, max_entries=1000, ttl=24 * 3600, directory=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.lock = threading.Lock()
+        # key -> (expiry time, response), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Held while counting or sweeping the responses on disk
+        self.disk_lock = threading.Lock()
+        self.disk_entries = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._sweep(time.time())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        """Return the cached response for key, or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc("response_cache_hits_total")
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+
+        response = self._read(key, now)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+                metrics.inc("response_cache_misses_total")
+                return None
+            self.hits += 1
+            metrics.inc("response_cache_hits_total")
+            self._remember(key, now + self.ttl, response)
+        return response
+
+    def put(self, key, response):
+        """Cache a response"""
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expires, response)
+        self._write(key, expires, response)
+
+    def _remember(self, key, expires, response):
+        self.entries[key] = (expires, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read(self, key, now):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if entry["expires"] <= now:
+            self._remove(path)
+            return None
+        try:
+            # The modification time records when a response was last used, for the sweep
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["response"]
+
+    def _write(self, key, expires, response):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            added = not os.path.exists(path)
+            # Unique per thread, as two threads may cache the same response at once
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary, "w") as file:
+                json.dump({"expires": expires, "response": response}, file)
+            os.replace(temporary, path)
+        except OSError:
+            log.exception(f"Unable to write cached response {path}")
+            return
+        if added:
+            with self.disk_lock:
+                self.disk_entries += 1
+                full = self.disk_entries > self.max_disk_entries
+            if full:
+                self._sweep(time.time())
+
+    def _remove(self, path):
+        """Remove a response from disk, which another thread may have just removed"""
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self.disk_lock:
+            self.disk_entries -= 1
+
+    def _sweep(self, now):
+        """Remove expired responses from disk, then the least recently used until well within the limit"""
+        with self.disk_lock:
+            found = []
+            for subdirectory in os.scandir(self.directory):
+                if not subdirectory.is_dir():
+                    continue
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith(".json"):
+                        try:
+                            found.append((entry.stat().st_mtime, entry.path))
+                        except OSError:
+                            pass
+            # Sweep down to 90% of the limit so the next sweep isn't needed straight away
+            keep = self.max_disk_entries * 9 // 10
+            found.sort()
+            removed = 0
+            for index, (_, path) in enumerate(found):
+                if len(found) - index <= keep and not self._expired(path, now):
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            self.disk_entries = len(found) - removed
+        if removed:
+            log.info(f"Removed {removed} cached responses from {self.directory}")
+
+    def _expired(self, path, now):
+        try:
+            with open(path) as file:
+                return json.load(file)["expires"] <= now
+        except (OSError, ValueError, KeyError):
+            return True
+
+    def stats(self):
+        """Return hit/miss counters and the number of entries in memory"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
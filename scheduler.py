@@ -0,0 +1,326 @@
+"""Rate limit aware scheduler for OpenAI requests
+
+Every request to the API goes through a RequestScheduler, which
+
+* keeps a requests-per-minute and tokens-per-minute bucket for each model,
+  corrected from the x-ratelimit-* response headers and the reported usage,
+* queues requests that would exceed the limits and paces them out,
+* shares capacity fairly by serving waiting users round-robin, so one busy
+  user can't starve everyone else, and
+* retries rate limited, overloaded and failed connections with jittered
+  exponential backoff, honouring any Retry-After the API sends.
+
+Requests are passed in as a callable making a raw request (the API client's
+with_raw_response methods), so the scheduler can see the response headers.
+The OpenAI clients themselves should be created with max_retries=0. Streamed
+responses are passed back as a generator of their events, which records the
+request's usage (sent in the last event when stream_options asks for it) and
+duration once the stream ends.
+"""
+
+from collections import deque
+import asyncio
+import inspect
+import logging
+import random
+import re
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger('sched')
+
+# Default (requests, tokens) per minute for each model, until the API tells us otherwise
+DEFAULT_LIMITS = {
+    "gpt-3.5-turbo": (3500, 90000),
+    "gpt-4": (500, 10000),
+    "dall-e-3": (7, 0),
+}
+FALLBACK_LIMITS = (500, 40000)
+
+# Status codes worth retrying; anything else is passed straight back to the caller
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def parse_duration(value):
+    """Parse a rate limit reset duration such as '1s', '6m0s' or '20ms' into seconds"""
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+class ModelState:
+    """Rate limit buckets and queue of waiting requests for one model"""
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # Waiting tickets per user, and the order users are served in
+        self.queues = {}
+        self.rotation = deque()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def wait_time(self, tokens, now):
+        """Seconds until a request for tokens fits in the buckets, 0 if it fits now"""
+        wait = max(0.0, self.blocked_until - now)
+        if self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+        if self.tpm and self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+        return wait
+
+    def update_from_headers(self, headers):
+        """Correct the buckets from the rate limit headers of a response"""
+        limit = headers.get("x-ratelimit-limit-requests")
+        if limit:
+            self.rpm = int(limit)
+        limit = headers.get("x-ratelimit-limit-tokens")
+        if limit:
+            self.tpm = int(limit)
+        # The API doesn't know about requests we have in flight, so only ever lower our estimate
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining:
+            self.requests = min(self.requests, float(remaining))
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        if remaining:
+            self.tokens = min(self.tokens, float(remaining))
+
+
+class RequestScheduler:
+    """Pace, prioritize and retry requests to the API"""
+
+    def __init__(self, limits=None, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.models = {}
+
+    def _state(self, model):
+        state = self.models.get(model)
+        if state is None:
+            state = self.models[model] = ModelState(*self.limits.get(model, FALLBACK_LIMITS))
+        return state
+
+    def _enqueue(self, state, user, ticket):
+        if user not in state.queues:
+            state.queues[user] = deque()
+            state.rotation.append(user)
+        state.queues[user].append(ticket)
+
+    def _dequeue(self, state, user, ticket):
+        queue = state.queues[user]
+        queue.remove(ticket)
+        if not queue:
+            del state.queues[user]
+            state.rotation.remove(user)
+        elif state.rotation[0] == user:
+            # Served; the user goes to the back of the line
+            state.rotation.rotate(-1)
+
+    def _try_grant(self, state, user, ticket, tokens):
+        """Grant the ticket if it is next in line and fits; otherwise return how long to wait (None: until notified)"""
+        if state.rotation[0] != user or state.queues[user][0] is not ticket:
+            return None
+        now = time.monotonic()
+        state.refill(now)
+        # A request larger than the whole bucket would never fit; let it through when the bucket is full
+        tokens = min(tokens, state.tpm)
+        wait = state.wait_time(tokens, now)
+        if wait:
+            return wait
+        state.requests -= 1
+        state.tokens -= tokens
+        self._dequeue(state, user, ticket)
+        return 0
+
+    def acquire(self, model, tokens=0, user=None):
+        """Block until a request for tokens may be sent for model"""
+        ticket = object()
+        start = time.monotonic()
+        with self.cond:
+            state = self._state(model)
+            self._enqueue(state, user, ticket)
+            try:
+                while True:
+                    wait = self._try_grant(state, user, ticket, tokens)
+                    if wait == 0:
+                        break
+                    self.cond.wait(wait if wait is not None else 1.0)
+            except BaseException:
+                self._dequeue(state, user, ticket)
+                raise
+            finally:
+                self.cond.notify_all()
+        return time.monotonic() - start
+
+    async def aacquire(self, model, tokens=0, user=None):
+        """Async version of acquire, which doesn't block the event loop while waiting"""
+        ticket = object()
+        start = time.monotonic()
+        with self.lock:
+            state = self._state(model)
+            self._enqueue(state, user, ticket)
+        granted = False
+        try:
+            while True:
+                with self.cond:
+                    wait = self._try_grant(state, user, ticket, tokens)
+                    if wait == 0:
+                        granted = True
+                        self.cond.notify_all()
+                        break
+                await asyncio.sleep(min(wait, 1.0) if wait is not None else 0.05)
+        finally:
+            if not granted:
+                with self.cond:
+                    self._dequeue(state, user, ticket)
+                    self.cond.notify_all()
+        return time.monotonic() - start
+
+    def _completed(self, model, headers, usage, tokens):
+        """Update the buckets from the headers of a successful response and the tokens it used, where known"""
+        with self.lock:
+            state = self._state(model)
+            if headers is not None:
+                state.update_from_headers(headers)
+            if usage is not None and state.tpm:
+                # Settle up the difference between our estimate and what was actually used
+                state.tokens -= usage.total_tokens - min(tokens, state.tpm)
+        if usage is not None:
+            metrics.observe("openai_prompt_tokens", usage.prompt_tokens, metrics.TOKENS, model=model)
+            metrics.observe("openai_completion_tokens", usage.completion_tokens or 0, metrics.TOKENS, model=model)
+            metrics.inc("openai_tokens_total", usage.total_tokens, model=model)
+
+    def _retry_delay(self, model, error, attempt):
+        """Return how long to wait before retrying after error, or None if it shouldn't be retried"""
+        import openai
+
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code not in RETRY_STATUS:
+                return None
+            headers = error.response.headers
+            try:
+                retry_after = float(headers.get("retry-after", ""))
+            except ValueError:
+                retry_after = parse_duration(headers.get("x-ratelimit-reset-requests")) or None
+            if error.status_code == 429:
+                with self.lock:
+                    state = self._state(model)
+                    state.update_from_headers(headers)
+                    state.blocked_until = time.monotonic() + (retry_after or self.base_delay)
+        elif not isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+            return None
+
+        if attempt >= self.max_retries:
+            return None
+        # Full jitter, so that a burst of failed requests doesn't retry in lock step
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def _failed(self, model, error, attempt):
+        """Count a failed request, returning the delay before retrying or None to give up"""
+        delay = self._retry_delay(model, error, attempt)
+        metrics.inc("openai_errors_total", model=model, error=type(error).__name__)
+        if delay is not None:
+            metrics.inc("openai_retries_total", model=model)
+            log.warning(f"{model} request failed ({error}); retry {attempt + 1} in {delay:.1f}s")
+        return delay
+
+    def call(self, model, request, tokens=0, user=None):
+        """Send request() when the model's rate limits allow, retrying transient failures
+
+        request must return a raw API response; its parsed result is returned"""
+        attempt = 0
+        while True:
+            metrics.observe("openai_queue_wait_seconds", self.acquire(model, tokens, user), model=model)
+            start = time.monotonic()
+            try:
+                raw = request()
+                parsed = raw.parse()
+            except Exception as error:
+                delay = self._failed(model, error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            if hasattr(parsed, "__next__"):
+                self._completed(model, raw.headers, None, tokens)
+                return self._stream(model, parsed, tokens, start)
+            metrics.observe("openai_request_seconds", time.monotonic() - start, model=model)
+            self._completed(model, raw.headers, getattr(parsed, "usage", None), tokens)
+            return parsed
+
+    def _stream(self, model, stream, tokens, start):
+        """Pass on the events of a streamed response, then record its usage and duration"""
+        usage = None
+        try:
+            for event in stream:
+                usage = getattr(event, "usage", None) or usage
+                yield event
+        finally:
+            metrics.observe("openai_request_seconds", time.monotonic() - start, model=model)
+            self._completed(model, None, usage, tokens)
+
+    async def acall(self, model, request, tokens=0, user=None):
+        """Async version of call; request must return an awaitable raw API response"""
+        attempt = 0
+        while True:
+            metrics.observe("openai_queue_wait_seconds", await self.aacquire(model, tokens, user), model=model)
+            start = time.monotonic()
+            try:
+                raw = await request()
+                parsed = raw.parse()
+                if inspect.isawaitable(parsed):
+                    parsed = await parsed
+            except Exception as error:
+                delay = self._failed(model, error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            if hasattr(parsed, "__anext__"):
+                self._completed(model, raw.headers, None, tokens)
+                return self._astream(model, parsed, tokens, start)
+            metrics.observe("openai_request_seconds", time.monotonic() - start, model=model)
+            self._completed(model, raw.headers, getattr(parsed, "usage", None), tokens)
+            return parsed
+
+    async def _astream(self, model, stream, tokens, start):
+        """Async version of _stream"""
+        usage = None
+        try:
+            async for event in stream:
+                usage = getattr(event, "usage", None) or usage
+                yield event
+        finally:
+            metrics.observe("openai_request_seconds", time.monotonic() - start, model=model)
+            self._completed(model, None, usage, tokens)
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """Return the scheduler shared by everything in this process"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler()
+    return _scheduler
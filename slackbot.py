@@ -13,37 +13,70 @@ TODO
   and regenerating responses. Perhaps look at automatically threading conversations should there is
   natural interface for multiple conversations
 * Define a few default system roles that can be easily selected
-* Allow interface to different models, such as images
 
 """
 
 
 import argparse
+import botcommon
 import chatai
-from datetime import datetime
+import chatstore
+import chunker
+import metrics
+from autosave import AutoSaver
+from dedupe import SeenSet
+from dispatcher import KeyedDispatcher
+from imagegen import ImageService
+from slackhistory import ThreadHistoryCache, ts_key
+from statebackend import shard
 import json
 import logging
+import multiprocessing
 import os
+import signal
+import sys
+import threading
+import time
+import weakref
 
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from slack_sdk import WebClient
 
 import pprint as pp
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(name)-7s | %(levelname)-8s | %(module)s:%(lineno)-4d | %(message)s",
-    datefmt='%a %d %b %Y %I:%M:%S %p %z',
-    filename='slack.log',
-)
 botlog = logging.getLogger('sbot')
 
-# Create a dictionary of conversations
-conversations = {}
+# Conversations keyed by (user, channel, thread); set by setup()
+conversations = None
+
+# Background saver of changed conversations, if enabled
+autosaver = None
+
+# Image generation for /chatgpt image; set by setup()
+images = None
+
+# The Slack app and its Socket Mode handler; created by connect()
+app = None
+handler = None
+
+# For each conversation, its key and the Slack timestamp of the message behind each turn (by seq), so a
+# summary of the conversation can be recorded with the last message it covers
+turn_timestamps = weakref.WeakKeyDictionary()
+turn_timestamps_lock = threading.Lock()
+
+# With --processes, the worker processes answering messages and the queue of jobs for each: ("turn", event),
+# ("save", user, channel, thread) or ("chats", response URL)
+workers = []
+worker_queues = []
+
+def add_arguments(parser):
+    """Add the options only the Slack bot has"""
+    parser.add_argument("-w", "--workers", help="Number of threads answering messages (in each process)", type=int,
+                        default=8)
+    parser.add_argument("-p", "--processes", help="Answer messages in this many worker processes, each thread's "
+                                                  "messages in the same one (0 to answer them in this process). "
+                                                  "Worker N serves its metrics on --metrics-port + N + 1",
+                        type=int, default=0)
+    parser.add_argument("--history-dir", help="Directory to cache Slack thread history", default="slack_history")
 
-# Initialize the Slack app with your bot token
-app = App(token=os.environ["SLACK_BOT_TOKEN"])
 
 def get_args():
     """Get command-line arguments"""
@@ -52,86 +85,183 @@ def get_args():
         description="Interface to chatGPT discord-bot",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-
-    parser.add_argument("-f", "--directory", help="Directory to store chats", default="slack_chats")
-    parser.add_argument("-m", "--model", help="Select the model to use", default="gpt-4") # gpt-4
+    botcommon.add_arguments(parser, "slack_chats", "slack_images")
+    add_arguments(parser)
 
     return parser.parse_args()
 
 
-def set_system_role(conversation, system_role=None):
-    if system_role is None:
-        conversation.set_system_role("You are a helpful assistant")
-    else:
-        conversation.set_system_role(system_role)
-
-def get_system_role(conversation):
-    return conversation.get_system_role()
-
-
-def get_conversation(user_id, channel_id, thread_id, add_final_msg = True):
+def get_conversation(user_id, channel_id, thread_id, add_final_msg = True, claim=False):
 #    print(f'get_conversation user {user_id} {thread_id}')
 
-    if user_id not in conversations:
-        conversations[user_id] = {}
-    if channel_id not in conversations[user_id]:
-        conversations[user_id][channel_id] = {}
-    if thread_id not in conversations[user_id][channel_id]:
-        conversations[user_id][channel_id][thread_id] = chatai.Conversation()
-        set_system_role(conversations[user_id][channel_id][thread_id])
-
+    def reload(conversation):
         # Reload the conversation if we don't have it in memory
-        result = slack_web_client.conversations_replies(channel=channel_id, ts=thread_id)
-        conversation_history = result["messages"]
+        conversation_history = thread_history.fetch(slack_web_client, channel_id, thread_id)
         if conversation_history:
-            load_conversation(conversations[user_id][channel_id][thread_id], conversation_history, add_final_msg)
-
-    return conversations[user_id][channel_id][thread_id]
-
-
-def process_chat_turn(conversation, message, model):
-    botlog.info(f"user asks: {message}")
-    response = chatai.take_turn(conversation, model, message)
-    botlog.info(f"assistant responses: {response}")
-
-    # This should be its own helper function. One issue here is that there
-    # will be a line break if the split is midline
-
-    # Discord has a 2000 character response limit - Split the response into
-    # chunks of 1900 characters or less, and also prevent splitting in the
-    # middle of a line; we use 1900 to give plenty of room for any additional
-    # message overhead
-
-    response_chunks = []
-    chunk = ""
-    for line in response.split("\n"):
-        if len(chunk) + len(line) + 1 > 1900:
-            response_chunks.append(chunk)
-            chunk = ""
-        chunk += line + "\n"
-    response_chunks.append(chunk)
-
-    return response_chunks
-
-def load_conversation(conversation, conversation_history, add_final_msg):
+            summary = thread_history.summary(channel_id, thread_id, user_id)
+            load_conversation(conversation, conversation_history, add_final_msg, (user_id, channel_id, thread_id),
+                              summary)
+
+    return botcommon.get_conversation(conversations, (user_id, channel_id, thread_id), reload, claim)
+
+
+# Minimum number of seconds between updates of a message being streamed
+UPDATE_INTERVAL = 1.0
+
+
+def stream_chat_turn(client, channel, thread_ts, conversation, message, model, user=None):
+    """Stream a response into the thread, posting the first text early and updating it as it grows
+
+    Chunks are split as in botcommon.process_chat_turn; once a chunk is
+    complete it is finalized and the rest of the response continues in a new
+    message. Returns the timestamp of the last message posted"""
+    metrics.sampled_debug(botlog, args.log_sample, "user asks: %s", message)
+    chunks = chunker.StreamChunker(chunker.chunk_limit("slack"))
+    sent_ts = None  # Timestamp of the message holding the chunk currently being filled
+    last_ts = None  # Timestamp of the last message posted
+    shown = ""      # What that message currently displays
+    last_update = 0
+    response = []
+
+    def post(text):
+        nonlocal last_ts
+        last_ts = timed_send(client.chat_postMessage, channel=channel, thread_ts=thread_ts, text=text)["ts"]
+        return last_ts
+
+    def update(text):
+        timed_send(client.chat_update, channel=channel, ts=sent_ts, text=text)
+
+    def finalize(chunk):
+        nonlocal sent_ts, shown
+        if sent_ts is None:
+            post(chunk)
+        elif chunk != shown:
+            update(chunk)
+        sent_ts, shown = None, ""
+
+    for delta in chatai.take_turn(conversation, model, message, stream=True,
+                                   temperature=args.temperature, user=user):
+        response.append(delta)
+        for chunk in chunks.feed(delta):
+            finalize(chunk)
+
+        now = time.monotonic()
+        if sent_ts is not None and now - last_update < UPDATE_INTERVAL:
+            continue
+        text = chunks.pending()
+        if not text.strip() or text == shown:
+            continue
+        if sent_ts is None:
+            sent_ts = post(text)
+        else:
+            update(text)
+        shown, last_update = text, now
+
+    for chunk in chunks.flush():
+        finalize(chunk)
+    metrics.sampled_debug(botlog, args.log_sample, "assistant responses: %s", "".join(response))
+    return last_ts
+
+
+def timed_send(method, **kwargs):
+    """Call a Slack method posting or updating a message, recording how long Slack took"""
+    start = time.monotonic()
+    result = method(**kwargs)
+    metrics.observe("bot_send_seconds", time.monotonic() - start)
+    return result
+
+
+def load_conversation(conversation, conversation_history, add_final_msg, key=None, summary=None):
     """
     Load a slack conversation thread into our conversation object
+
+    Given a summary from the history cache, the conversation starts with it
+    and the messages it covers are left out
     """
+    if summary:
+        # The summary covers no turn of this conversation, so record the last message it covers under seq -1
+        conversation.add_turn("system", summary['content'], covers=-1)
+        note_turn(conversation, key, -1, summary['ts'])
 
     # We might want to skip the final message depending what circumstances
     # we have reloaded the conversation
     end = None if add_final_msg else -1
     for i, entry in enumerate(conversation_history[:end]):
+        if summary and ts_key(entry['ts']) <= ts_key(summary['ts']):
+            continue
         if entry['type'] == 'message':
             role = 'assistant' if 'bot_id' in entry else 'user'
             conversation.add_turn(role, entry['text'])
+            note_turn(conversation, key, conversation.turns[-1].seq, entry['ts'])
         if i == 0:
             botlog.info(f"Reloaded conversation from slack '{entry['text'][:20]} ... ")
 
 
+def note_turn(conversation, key, seq, ts):
+    """Record the timestamp of the message behind a turn, if conversations are being summarized"""
+    if key is None or chatai.background_summarizer is None:
+        return
+    with turn_timestamps_lock:
+        if conversation not in turn_timestamps:
+            turn_timestamps[conversation] = (key, {})
+        turn_timestamps[conversation][1][seq] = ts
+
+
+def record_summary(conversation, turn):
+    """Keep a summary swapped into a conversation with the thread's history, so reloads start from it"""
+    with turn_timestamps_lock:
+        key, timestamps = turn_timestamps.get(conversation, (None, {}))
+        ts = timestamps.get(turn.covers)
+        # Only the last covered turn is needed by later summaries
+        for seq in [seq for seq in timestamps if seq < turn.covers]:
+            del timestamps[seq]
+    if ts is None:
+        return
+    user, channel, thread_ts = key
+    thread_history.set_summary(channel, thread_ts, user, turn.content, ts)
+    botlog.info(f"Recorded summary of {key} up to {ts}")
+
+
+# Ids of the events and messages handled recently, to drop redelivered events
+seen_events = SeenSet()
+
+# Subtypes of messages users write; the others are edits, deletions, joins and other changes to the channel
+USER_MESSAGE_SUBTYPES = {None, "file_share", "thread_broadcast"}
+
+
+def is_duplicate(event, body):
+    """Return True if the event, or the message it carries, has already been handled"""
+    ids = [("event", (body or {}).get("event_id")), ("message", event.get("client_msg_id"))]
+    # Record every id, even once one has been seen
+    duplicate = [seen_events.seen(key) for key in ids if key[1]]
+    return any(duplicate)
+
+
 # Define a function to handle incoming messages
-@app.event("message")
-def handle_message(event, say, client):
+def handle_message(event, say, client, body=None):
+    """Queue the turn and return straight away so Slack sees a prompt acknowledgement"""
+    # Replies from bots (including ours) have a bot_id
+    if event.get('subtype') not in USER_MESSAGE_SUBTYPES or event.get('bot_id'):
+        return
+    if is_duplicate(event, body):
+        botlog.info(f"Dropped duplicate event {(body or {}).get('event_id')} {event.get('client_msg_id')}")
+        metrics.inc("bot_duplicate_events_total", platform="slack")
+        return
+
+    user = event['user']
+    channel = event['channel']
+    thread_ts = event.get('thread_ts', event.get('event_ts'))
+
+    if worker_queues:
+        send_to_worker(channel, thread_ts, ("turn", event))
+        return
+
+    # Turns within the same thread are run in order; different threads run in parallel
+    dispatcher.submit((user, channel, thread_ts), run_turn, event, client)
+
+
+def run_turn(event, client):
+    """Answer a single message; runs on a dispatcher worker thread"""
     msg = event["text"]
     user = event['user']
     channel = event['channel']
@@ -146,13 +276,34 @@ def handle_message(event, say, client):
         slack_web_client.chat_postEphemeral(channel=channel, text='ChatGPT is thinking... will create new thread',
                                             user=user)
 
-    conversation = get_conversation(user, channel, thread_ts, False)
-
-    botlog.debug(f"user={user} channel={channel} thread_id={thread_ts}: {conversation.num_turns()} entries")
-    response_chunks = process_chat_turn(conversation, msg, args.model)
-
-    for chunk in response_chunks:
-        client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=chunk)
+    # Claimed so the store doesn't evict it before the turn has been taken and committed
+    conversation = get_conversation(user, channel, thread_ts, False, claim=True)
+    try:
+        botlog.debug(f"user={user} channel={channel} thread_id={thread_ts}: {conversation.num_turns()} entries")
+        with metrics.labelled(platform="slack", channel=channel, model=args.model):
+            start = time.monotonic()
+            reply_ts = None
+            if args.stream:
+                reply_ts = stream_chat_turn(client, channel, thread_ts, conversation, msg, args.model, user)
+            else:
+                response_chunks = botcommon.process_chat_turn(conversation, msg, args, "slack", botlog, user)
+
+                for chunk in response_chunks:
+                    reply_ts = timed_send(client.chat_postMessage, channel=channel, thread_ts=thread_ts,
+                                          text=chunk)["ts"]
+            metrics.observe("bot_turn_seconds", time.monotonic() - start)
+
+        # The turn's question and reply are the last two turns, whatever has been summarized meanwhile
+        question, reply = conversation.turns[-2:]
+        note_turn(conversation, (user, channel, thread_ts), question.seq, event.get('ts', event.get('event_ts')))
+        if reply_ts:
+            note_turn(conversation, (user, channel, thread_ts), reply.seq, reply_ts)
+
+        conversations.commit((user, channel, thread_ts))
+        if autosaver:
+            autosaver.mark_dirty((user, channel, thread_ts), conversation)
+    finally:
+        conversation.finish_turn()
 
 def handle_new_command(ack, body, respond):
 
@@ -162,14 +313,12 @@ def handle_new_command(ack, body, respond):
     thread_ts = body.get('thread_ts', body.get('event_ts'))
     conversation = get_conversation(user, channel, thread_ts)
     conversation.clear()
-    set_system_role(conversation)
+    botcommon.set_system_role(conversation)
+    conversations.commit((user, channel, thread_ts))
     respond("Starting a new conversation")
 
 def handle_report_command(ack, body, respond):
     """Provide a JSON report of the current conversation"""
-    # This should be its own helper function. One issue here is that there
-    # will be a line break if the split is midline
-
     user = body['user_id']
     channel = body['channel_id']
     thread_ts = body.get('thread_ts', body.get('event_ts'))
@@ -179,12 +328,8 @@ def handle_report_command(ack, body, respond):
     # Convert the dictionary to a JSON string so it displays nicer
     json_str = json.dumps(response, indent=4)
 
-    # Split the response into chunks of 1900 characters or less as discord has
-    # a 2000 character response limit, and we want to also provide extra room
-    # for any additional response overhead.
-    # Note: We don't split on line breaks as the response here is in JSON and
-    # may be a single line
-    response_chunks = [json_str[i:i + 1900] for i in range(0, len(json_str), 1900)]
+    # Split the JSON over as many messages as needed, as a code block in each
+    response_chunks = chunker.split_text(f"```json\n{json_str}\n```", chunker.chunk_limit("slack"))
 
     # Send each chunk as a separate message
     for chunk in response_chunks:
@@ -192,30 +337,82 @@ def handle_report_command(ack, body, respond):
     botlog.info("Sent .report response")
 
 
+def chat_report():
+    """Lines of summary information on the chats held by this process"""
+    lines = []
+    for (user, chan, thread), conversation in conversations.resident_items():
+        lines.append(f"Chat stored User: {user} Chan: {chan} Thread {thread} with "
+                     f"{int(conversation.num_turns())} entries")
+    for user, chan, thread in conversations.spilled_keys():
+        lines.append(f"Chat spilled to disk User: {user} Chan: {chan} Thread {thread}")
+    lines.append(f"End of chats: {conversations.summary()}")
+    return lines
+
 def handle_chat_command(ack, body, respond):
     """Report summary information on all chats"""
-    for user in conversations:
-        for chan in conversations[user]:
-            for thread in conversations[user][chan]:
-                msg = f"Chat stored User: {user} Chan: {chan} Thread {thread} with {int(conversations[user][chan][thread].num_turns())} entries"
-                respond (msg)
-    respond("End of chats")
+    if worker_queues:
+        # The chats are held by the worker processes; each reports its own
+        for queue in worker_queues:
+            queue.put(("chats", body['response_url']))
+        return
+    for line in chat_report():
+        respond(line)
+
+def handle_saved_command(ack, body, respond):
+    """List the user's saved chats"""
+    chats = chat_store.find(platform="slack", author=body['user_id'])
+    for chat in chats:
+        respond(f"{chat['id']}: {chat['title']} (Chan: {chat['channel']} Thread {chat['thread']}, "
+                f"updated {chat['updated']})")
+    respond(f"{len(chats)} saved chats")
+
+def handle_image_command(ack, body, respond):
+    """Generate an image from a prompt and post it to the channel"""
+    prompt = body['text'].split(' ', 1)[1].strip() if ' ' in body['text'] else ''
+    if not prompt:
+        respond("Usage: /chatgpt image <prompt>")
+        return
+    channel = body['channel_id']
+    job = images.submit(prompt)
+    if not job.finished.is_set():
+        respond(f"Generating image {job.id}...")
+
+    # Upload once the image is ready, without holding up the command handler
+    def upload(future):
+        if job.status != "done":
+            respond(f"Unable to generate an image: {job.error}")
+            return
+        try:
+            slack_web_client.files_upload_v2(channel=channel, file=images.read(job.digest),
+                                             filename=f"{job.digest[:16]}.png", title=prompt[:100])
+            botlog.info(f"Sent image {job.digest}" + (" from the cache" if job.cached else ""))
+        except Exception:
+            botlog.exception(f"Unable to upload image {job.digest}")
+            respond("Unable to upload the image")
+
+    job.future.add_done_callback(upload)
+
+def handle_cache_command(ack, body, respond):
+    """Report response cache statistics"""
+    if chatai.response_cache is None:
+        respond("The response cache is not enabled")
+        return
+    stats = chatai.response_cache.stats()
+    respond(f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%}), {stats['entries']} entries")
 
 def save_command(user, channel, thread_ts):
-    """Store a chat to a file"""
-    save_time = datetime.now()
-    save_time = save_time.strftime("%Y-%m-%d %H:%M:%S")
-    # TODO: Would be nice if we had a one line summary of conversation in the title
-
+    """Store a chat"""
     conversation = get_conversation(user, channel, thread_ts)
-    filename = chatai.write_chat(args.directory, save_time, conversation)
-    msg = f'Chat written to {filename}'
+    chat_id = chatai.write_chat(chat_store, conversation, "slack", channel=channel, thread=thread_ts, author=user)
+    msg = f'Chat saved as {chat_id}'
     botlog.info(msg)
 
 # The open_modal shortcut opens a plain old modal
 # Shortcuts require the command scope
-@app.shortcut("save_thread")
 def open_modal(ack, shortcut, client, logger):
+    import slack_sdk.errors
+
     # Acknowledge shortcut request
     ack()
 
@@ -237,7 +434,7 @@ def open_modal(ack, shortcut, client, logger):
                         "type": "section",
                         "text": {
                             "type": "mrkdwn",
-                            "text": "The current conversation thread has been saved to the server's slack_chats directory",
+                            "text": "The current conversation thread has been saved on the server",
                         },
                     },
                 ],
@@ -246,11 +443,15 @@ def open_modal(ack, shortcut, client, logger):
         # logger.info(f"shortcut = {shortcut['message']['thread_ts']}")
         logger.info(f"result = {result}")
 
-    except SlackApiError as e:
+    except slack_sdk.errors.SlackApiError as e:
         logger.error("Error creating conversation: {}".format(e))
 
     # TODO: We should do this after confirming the modal conversation box, rather than here
-    save_command(user, channel, thread_ts)
+    if worker_queues:
+        # The worker answering the thread holds its conversation
+        send_to_worker(channel, thread_ts, ("save", user, channel, thread_ts))
+    else:
+        save_command(user, channel, thread_ts)
 
 
 # TODO: Most of these commands only make sense in the context of a thread
@@ -264,11 +465,13 @@ def open_modal(ack, shortcut, client, logger):
 chatgpt_cmds = {
     # 'save': handle_save_command,
     'chats': handle_chat_command,
+    'saved': handle_saved_command,
+    'cache': handle_cache_command,
+    'image': handle_image_command,
     # 'report': handle_report_command,
     # 'new': handle_new_command
 }
 
-@app.command("/chatgpt")
 def handle_chatgpt_command(ack, body, respond):
     ack()
 
@@ -284,20 +487,160 @@ def handle_chatgpt_command(ack, body, respond):
         respond(f"Unknown command: Try one of {[cmd for cmd in chatgpt_cmds]}")
 
 
-def main():
-    global args
-    args = get_args()
+def create_app():
+    """Create the Slack app and register its handlers
+
+    slack_bolt is imported here rather than at the top of the module as it is
+    slow to import, and creating the app checks the token with Slack"""
+    from slack_bolt import App
+
+    app = App(token=os.environ["SLACK_BOT_TOKEN"])
+    app.event("message")(handle_message)
+    app.shortcut("save_thread")(open_modal)
+    app.command("/chatgpt")(handle_chatgpt_command)
+    return app
+
+
+def setup(bot_args, store, bot_conversations, bot_images):
+    """Give the bot its settings, chat store, live conversations and image service
+
+    main() calls this when the bot runs on its own; botruntime.py calls it
+    with a store and image service shared with the Discord bot"""
+    global args, chat_store, conversations, images, autosaver, dispatcher, thread_history
+    args = bot_args
+    chat_store = store
+    conversations = bot_conversations
+    images = bot_images
+    if args.debug:
+        botlog.setLevel(logging.DEBUG)
+
+    dispatcher = KeyedDispatcher(args.workers)
+    thread_history = ThreadHistoryCache(args.history_dir)
+    if chatai.background_summarizer:
+        chatai.background_summarizer.add_listener(record_summary)
+    if args.processes:
+        start_workers(args.processes)
+
+    if args.autosave_interval:
+        autosaver = AutoSaver(chat_store, "slack",
+                              lambda key: {"author": key[0], "channel": key[1], "thread": key[2]},
+                              args.autosave_interval, args.autosave_threshold)
+
+
+def start_workers(count):
+    """Start the worker processes answering messages
+
+    They are started fresh rather than forked, as this process may already be
+    running threads"""
+    context = multiprocessing.get_context("spawn")
+    for index in range(count):
+        queue = context.Queue()
+        process = context.Process(target=worker_main, args=(index, queue, args), name=f"slack-worker-{index}")
+        process.start()
+        workers.append(process)
+        worker_queues.append(queue)
+    botlog.info(f"Started {count} worker processes")
+
+
+def send_to_worker(channel, thread_ts, job):
+    """Queue a job for the worker process answering a thread
+
+    Every message in a thread goes to the same worker, which answers them in order"""
+    worker_queues[shard((channel, thread_ts), len(worker_queues))].put(job)
+
+
+def report_chats(index, response_url):
+    """Send a worker's chat report to the /chatgpt command it is for"""
+    from slack_sdk.webhook import WebhookClient
+
+    WebhookClient(response_url).send(text="\n".join([f"Worker {index}:"] + chat_report()))
+
+
+def worker_main(index, queue, worker_args):
+    """Run the jobs queued for a worker process until given None"""
+    # aictrl.sh stop signals every bot process; the workers are stopped by the receiving process once it has
+    # stopped receiving, so they finish the messages already queued for them
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    botcommon.configure_logging(f"slack-worker-{index}.log")
+    worker_args.processes = 0
+    # The turns' metrics are recorded here, so each worker serves its own on one of the ports after the
+    # receiving process's
+    if worker_args.metrics_port:
+        worker_args.metrics_port += index + 1
+    botcommon.configure(worker_args, botlog)
+    setup(worker_args, chatstore.open_store(worker_args.backend, worker_args.directory),
+          botcommon.open_conversations(worker_args), None)
+
+    from slack_sdk import WebClient
 
-    # Initialize a Web API client
     global slack_web_client
     slack_web_client = WebClient(token=os.environ["SLACK_BOT_TOKEN"])
+    botlog.info(f"Worker {index} started")
+    try:
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            if job[0] == "turn":
+                event = job[1]
+                thread_ts = event.get('thread_ts', event.get('event_ts'))
+                dispatcher.submit((event['user'], event['channel'], thread_ts), run_turn, event, slack_web_client)
+            elif job[0] == "save":
+                # Saved after any turns in the thread queued before it
+                dispatcher.submit(job[1:], save_command, *job[1:])
+            else:
+                dispatcher.submit(("chats",), report_chats, index, job[1])
+    finally:
+        shutdown()
+        botlog.info(f"Worker {index} stopped")
+
+
+def connect():
+    """Create the Slack app and connect to Slack in Socket Mode
+
+    Events are received and handled on the Socket Mode client's own threads,
+    so this returns once connected"""
+    global app, slack_web_client, handler
+    app = create_app()
+
+    # Use the app's Web API client rather than opening connections from a second one
+    slack_web_client = app.client
+
+    from slack_bolt.adapter.socket_mode import SocketModeHandler
 
-    # Start the Socket Mode handler
-    global handler
     handler = SocketModeHandler(app, app_token=os.environ["SLACK_APP_TOKEN"])
-    handler.start()
+    handler.connect()
 
-if __name__ == "__main__":
-    main()
 
+def shutdown():
+    """Disconnect from Slack, finish the queued turns and save anything the autosaver is holding"""
+    if handler:
+        handler.close()
+    for queue in worker_queues:
+        queue.put(None)
+    for process in workers:
+        process.join()
+    dispatcher.shutdown()
+    if autosaver:
+        autosaver.stop()
+
+
+def main():
+    args = get_args()
+    botcommon.configure_logging('slack.log')
+    botcommon.configure(args, botlog)
+    setup(args, chatstore.open_store(args.backend, args.directory), botcommon.open_conversations(args),
+          ImageService(model=args.image_model, directory=args.image_dir))
+
+    # Exit cleanly on SIGTERM (as sent by aictrl.sh stop) so the final autosave happens
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        connect()
+        # Wait until interrupted or terminated
+        threading.Event().wait()
+    finally:
+        shutdown()
 
+if __name__ == "__main__":
+    main()
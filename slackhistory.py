@@ -0,0 +1,107 @@
+"""Persistent cache of Slack thread history
+
+When the Slack frontend needs a thread it doesn't have in memory it rebuilds
+the conversation from the thread's messages. Rather than pulling the whole
+thread with conversations_replies every time, the messages are cached on disk
+per (channel, thread_ts) and only messages newer than the cached tail are
+fetched, following the cursor through as many pages as Slack returns.
+
+Edits or deletions of messages already in the cache are not picked up.
+
+Summaries of each user's conversation in a thread are kept alongside, with
+the timestamp of the last message they cover, so a conversation rebuilt from
+the thread starts from the summary instead of every message.
+"""
+
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger('history')
+
+# Fields of a Slack message needed to rebuild a conversation
+MESSAGE_FIELDS = ("type", "ts", "user", "bot_id", "text")
+
+
+def ts_key(ts):
+    """Sort key for a Slack timestamp, which is too precise to compare safely as a float"""
+    seconds, _, micros = ts.partition(".")
+    return int(seconds), int(micros.ljust(6, "0"))
+
+
+class ThreadHistoryCache:
+    """On-disk cache of thread messages, topped up incrementally from Slack"""
+
+    def __init__(self, directory="slack_history"):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # One lock per thread so different threads can be fetched in parallel
+        self.thread_locks = {}
+
+    def _path(self, channel, thread_ts, kind=""):
+        return os.path.join(self.directory, channel, thread_ts + kind + ".json")
+
+    def _thread_lock(self, channel, thread_ts):
+        with self.lock:
+            return self.thread_locks.setdefault((channel, thread_ts), threading.Lock())
+
+    def _load(self, channel, thread_ts, kind="", empty=list):
+        try:
+            with open(self._path(channel, thread_ts, kind)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return empty()
+        except ValueError:
+            log.warning(f"Discarding corrupt history for {channel} {thread_ts}")
+            return empty()
+
+    def _store(self, channel, thread_ts, messages, kind=""):
+        path = self._path(channel, thread_ts, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a crash never leaves a half written file behind
+        with open(path + ".tmp", "w") as file:
+            json.dump(messages, file)
+        os.replace(path + ".tmp", path)
+
+    def summary(self, channel, thread_ts, user):
+        """Return the summary of a user's conversation in a thread as {"content": ..., "ts": ...}, or None"""
+        with self._thread_lock(channel, thread_ts):
+            return self._load(channel, thread_ts, ".summary", dict).get(user)
+
+    def set_summary(self, channel, thread_ts, user, content, ts):
+        """Record a summary of a user's conversation covering the thread's messages up to ts"""
+        with self._thread_lock(channel, thread_ts):
+            summaries = self._load(channel, thread_ts, ".summary", dict)
+            summaries[user] = {"content": content, "ts": ts}
+            self._store(channel, thread_ts, summaries, ".summary")
+
+    def fetch(self, client, channel, thread_ts):
+        """Return the messages in a thread, oldest first, fetching only those not already cached"""
+        with self._thread_lock(channel, thread_ts):
+            messages = self._load(channel, thread_ts)
+            tail = messages[-1]["ts"] if messages else None
+
+            new = []
+            cursor = None
+            while True:
+                kwargs = {"channel": channel, "ts": thread_ts, "limit": 200}
+                if tail is not None:
+                    kwargs["oldest"] = tail
+                if cursor:
+                    kwargs["cursor"] = cursor
+                result = client.conversations_replies(**kwargs)
+                for message in result["messages"]:
+                    # The thread's parent message is always returned, so filter on the tail
+                    if tail is None or ts_key(message["ts"]) > ts_key(tail):
+                        new.append({field: message[field] for field in MESSAGE_FIELDS if field in message})
+                cursor = result.get("response_metadata", {}).get("next_cursor")
+                if not result.get("has_more") or not cursor:
+                    break
+
+            if new:
+                new.sort(key=lambda message: ts_key(message["ts"]))
+                messages.extend(new)
+                self._store(channel, thread_ts, messages)
+            log.info(f"History for {channel} {thread_ts}: {len(messages) - len(new)} cached, {len(new)} fetched")
+            return messages
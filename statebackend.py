@@ -0,0 +1,118 @@
+"""Shared state backends for live conversations
+
+With a shared backend, several bot processes (on one machine) can serve the
+same Discord guild or Slack workspace: whichever process receives a message
+picks up the conversation where another left it.
+
+Each conversation is stored with a version that is incremented on every
+write. Writers pass the version they last read, and a write is refused if
+another process has written since (optimistic locking), so nothing is locked
+while a turn is being answered. ConversationStore then merges its new turns
+into the latest copy and tries again.
+
+SQLiteStateBackend keeps conversations in SQLite databases in WAL mode, so
+reads carry on while another process writes. Keys are spread over several
+databases by a hash of the key, so writes to different conversations mostly
+don't wait for each other.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger('state')
+
+# Seconds a write waits for another process to finish writing the same database
+BUSY_TIMEOUT = 10
+
+
+def key_hash(key):
+    """Stable hash of a conversation key, the same in every process"""
+    return int(hashlib.sha1(json.dumps(list(key)).encode()).hexdigest()[:8], 16)
+
+
+def shard(key, count):
+    """Return which of count shards a conversation key belongs to"""
+    return key_hash(key) % count
+
+
+class StateBackend:
+    """Interface shared by the state backends"""
+
+    def version(self, key):
+        """Return the version of the conversation stored for key, 0 if there is none"""
+        raise NotImplementedError
+
+    def load(self, key):
+        """Return (conversation dictionary, version) for key, or (None, 0) if there is none"""
+        raise NotImplementedError
+
+    def save(self, key, data, version):
+        """Store a conversation dictionary if the stored version is still version
+
+        Returns the new version, or None if another writer got there first"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteStateBackend(StateBackend):
+    """Conversations stored in SQLite databases sharded by key"""
+
+    def __init__(self, directory, shards=4):
+        os.makedirs(directory, exist_ok=True)
+        self.locks = []
+        self.dbs = []
+        for index in range(shards):
+            db = sqlite3.connect(os.path.join(directory, f"state-{index}.db"), timeout=BUSY_TIMEOUT,
+                                 check_same_thread=False)
+            with db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS conversations (key TEXT PRIMARY KEY, "
+                           "version INTEGER, data TEXT, updated REAL)")
+            self.locks.append(threading.Lock())
+            self.dbs.append(db)
+
+    def _shard(self, key):
+        index = shard(key, len(self.dbs))
+        return self.locks[index], self.dbs[index]
+
+    def version(self, key):
+        lock, db = self._shard(key)
+        with lock:
+            row = db.execute("SELECT version FROM conversations WHERE key = ?", (json.dumps(list(key)),)).fetchone()
+        return row[0] if row else 0
+
+    def load(self, key):
+        lock, db = self._shard(key)
+        with lock:
+            row = db.execute("SELECT data, version FROM conversations WHERE key = ?",
+                             (json.dumps(list(key)),)).fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def save(self, key, data, version):
+        lock, db = self._shard(key)
+        name = json.dumps(list(key))
+        with lock, db:
+            if version == 0:
+                cursor = db.execute("INSERT OR IGNORE INTO conversations (key, version, data, updated) "
+                                    "VALUES (?, 1, ?, ?)", (name, json.dumps(data), time.time()))
+            else:
+                cursor = db.execute("UPDATE conversations SET version = version + 1, data = ?, updated = ? "
+                                    "WHERE key = ? AND version = ?", (json.dumps(data), time.time(), name, version))
+        if cursor.rowcount == 0:
+            log.debug(f"Conflicting write of {key} at version {version}")
+            return None
+        return version + 1
+
+    def close(self):
+        for lock, db in zip(self.locks, self.dbs):
+            with lock:
+                db.close()
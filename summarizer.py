@@ -0,0 +1,82 @@
+"""Rolling summaries of long conversations, written in the background
+
+With the "background" context strategy, chatai hands a conversation to the
+Summarizer once it grows past a threshold fraction of the model's token
+budget, and carries on answering with the oldest turns trimmed. A worker
+thread asks a cheaper model to summarize the oldest turns and swaps the
+summary into the conversation in their place, so later turns send the
+summary rather than the turns (or nothing). Summary turns are saved with the
+chat like any other turn, so reloading a saved chat stays small too.
+
+Listeners are told about each summary swapped in, for example so the Slack
+bot can remember it alongside the thread's history.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+import chatai
+import metrics
+
+log = logging.getLogger('summary')
+
+# Fraction of the token budget a conversation has to grow past before it is
+# summarized, and the fraction it is summarized down to, so summaries aren't
+# written on every turn
+THRESHOLD = 0.75
+TARGET = 0.5
+
+
+class Summarizer:
+    """Thread pool summarizing the oldest turns of conversations that have grown too long"""
+
+    def __init__(self, model=chatai.SUMMARY_MODEL, threshold=THRESHOLD, target=TARGET, workers=2):
+        self.model = model
+        self.threshold = threshold
+        self.target = target
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary")
+        self.lock = threading.Lock()
+        # Ids of the conversations being summarized
+        self.pending = set()
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(conversation, summary turn) after each summary is swapped in"""
+        self.listeners.append(listener)
+
+    def check(self, conversation, budget):
+        """Summarize a conversation in the background if it has grown past the threshold"""
+        if conversation.total_tokens <= budget * self.threshold:
+            return
+        with self.lock:
+            if id(conversation) in self.pending:
+                return
+            self.pending.add(id(conversation))
+        self.executor.submit(self._summarize, conversation, budget)
+
+    def _summarize(self, conversation, budget):
+        try:
+            count = conversation.overflow(int(budget * self.target))
+            if not count:
+                return
+            removed = conversation.oldest_turns(count)
+            start = time.monotonic()
+            response = chatai.complete(self.model, chatai.summary_request(removed), temperature=0.2)
+            turn = conversation.replace_turns(removed, response.choices[0].message.content)
+            if turn is None:
+                log.info("Discarded a summary of a conversation that changed while it was written")
+                return
+            metrics.observe("summary_seconds", time.monotonic() - start)
+            log.info(f"Summarized {count} turns in {time.monotonic() - start:.1f}s")
+            for listener in self.listeners:
+                listener(conversation, turn)
+        except Exception:
+            log.exception("Summarizing a conversation failed")
+        finally:
+            with self.lock:
+                self.pending.discard(id(conversation))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the top of the repository, and the fake API in benchmarks
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
@@ -0,0 +1,28 @@
+"""Tests of resuming batch runs"""
+
+import json
+
+import batch
+
+
+def answer(jobs):
+    return [{"response": job["prompt"].upper()} for job in jobs]
+
+
+def test_resume_after_partial_line(tmp_path):
+    prompts = tmp_path / "prompts.jsonl"
+    prompts.write_text("".join(json.dumps(prompt) + "\n" for prompt in ["a", "b", "c"]))
+    output = tmp_path / "results.jsonl"
+    # An earlier run answered the first prompt and was stopped while writing the second's result
+    output.write_text(json.dumps({"response": "A", "id": 1}) + "\n" + '{"response": "B", "i')
+
+    assert batch.run_file(str(prompts), str(output), answer, workers=2)
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert records == [{"response": "A", "id": 1}, {"response": "B", "id": 2}, {"response": "C", "id": 3}]
+
+
+def test_partial_only_line(tmp_path):
+    output = tmp_path / "results.jsonl"
+    output.write_text('{"resp')
+    batch.drop_partial_line(str(output))
+    assert output.read_text() == ""
@@ -0,0 +1,20 @@
+"""Tests of the options of the bots run together by botruntime.py"""
+
+import pytest
+
+pytest.importorskip("discord")
+
+import botruntime
+
+
+def test_parser_combines_both_bots_options():
+    args = botruntime.make_parser().parse_args(["--workers", "4", "--discord-workers", "2",
+                                                "--discord-worker-index", "1"])
+    assert args.workers == 4
+    assert (args.discord_workers, args.discord_worker_index) == (2, 1)
+    assert args.discord and args.slack
+
+
+def test_parser_defaults():
+    args = botruntime.make_parser().parse_args([])
+    assert (args.discord_workers, args.discord_worker_index) == (1, 0)
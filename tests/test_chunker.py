@@ -0,0 +1,89 @@
+"""Tests of splitting responses into chunks that fit a platform's message limit"""
+
+import random
+
+import pytest
+
+from chunker import FENCE, StreamChunker, split_text
+
+
+def fence_lines(chunk):
+    return [line for line in chunk.split("\n") if line.lstrip().startswith(FENCE)]
+
+
+def content(text):
+    """Text without its fence lines or whitespace"""
+    return "".join("".join(line.split()) for line in text.split("\n") if not line.lstrip().startswith(FENCE))
+
+
+def check_chunks(chunks, limit):
+    for chunk in chunks:
+        assert len(chunk) <= limit
+        # Every code block opened in a chunk is closed in it
+        assert len(fence_lines(chunk)) % 2 == 0, chunk
+
+
+def response(seed):
+    """Text with prose, code blocks and lines of all lengths, including some longer than a message"""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(rng.randrange(5, 60)):
+        if rng.random() < 0.2:
+            lines.append(FENCE + rng.choice(["", "py", "python", "sh"]))
+            lines += ["x = %d  # %s" % (i, "pad" * rng.randrange(40)) for i in range(rng.randrange(30))]
+            lines.append(FENCE)
+        else:
+            lines.append("word " * rng.choice([0, 1, 5, 20, 100, 500]))
+    return "\n".join(lines) + "\n"
+
+
+def test_closing_fence_near_limit():
+    text = "Here is the code:\n```py\n" + "x = 1  # padding\n" * 110 + "\n```\nExplanation...\n"
+    chunks = split_text(text, 1900)
+    check_chunks(chunks, 1900)
+    assert chunks[-1] == "Explanation...\n"
+
+
+def test_fence_when_no_room_left():
+    # Too long a fence line for so short a limit to be taken for one, but the limit still holds
+    chunks = split_text("```py\naaaaaaaaaaa\n```\n" + "a" * 20 + "\n", 23)
+    assert all(len(chunk) <= 23 for chunk in chunks)
+
+
+def test_reopens_code_block_with_its_language():
+    chunks = split_text("```python\n" + "print(1)\n" * 50 + "```\n", 100)
+    check_chunks(chunks, 100)
+    assert len(chunks) > 1
+    assert all(chunk.startswith("```python\n") for chunk in chunks)
+
+
+def test_hard_splits_long_lines():
+    chunks = split_text("a" * 250, 100)
+    assert chunks == ["a" * 100, "a" * 100, "a" * 50]
+
+
+@pytest.mark.parametrize("limit", [60, 200, 1900])
+@pytest.mark.parametrize("seed", range(20))
+def test_limit_and_fence_balance(seed, limit):
+    text = response(seed)
+    chunks = split_text(text, limit)
+    check_chunks(chunks, limit)
+    # Nothing but the fences closing and reopening code blocks (and blank lines) is added or lost
+    assert "".join(content(chunk) for chunk in chunks) == content(text)
+
+
+@pytest.mark.parametrize("limit", [60, 200, 1900])
+@pytest.mark.parametrize("seed", range(20))
+def test_streamed_matches_whole(seed, limit):
+    text = response(seed)
+    rng = random.Random(seed)
+    chunker = StreamChunker(limit)
+    chunks = []
+    position = 0
+    while position < len(text):
+        size = rng.randrange(1, 40)
+        chunks += chunker.feed(text[position:position + size])
+        assert len(chunker.pending()) <= limit
+        position += size
+    chunks += chunker.flush()
+    assert chunks == split_text(text, limit)
@@ -0,0 +1,74 @@
+"""Tests of the Conversation model's cached message list"""
+
+import sys
+import threading
+
+import pytest
+
+from conversation import SUMMARY_PREFIX, Conversation
+
+
+def expected_messages(conversation):
+    return [turn.to_message() for turn in conversation.turns]
+
+
+def check_order(messages):
+    """The messages are the system role, at most one summary and then turns in the order they were added"""
+    assert messages[0] == {"role": "system", "content": "role"}
+    rest = messages[1:]
+    if rest and rest[0]["content"].startswith(SUMMARY_PREFIX):
+        rest = rest[1:]
+    numbers = [int(message["content"][1:]) for message in rest]
+    assert numbers == sorted(numbers)
+    assert len(set(numbers)) == len(numbers)
+
+
+@pytest.fixture
+def frequent_switches():
+    """Switch threads as often as possible, so races show up"""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def swap_summaries_while_building(conversation, budget):
+    """Swap summaries in, as the background summarizer does, while other threads build message lists"""
+    stop = threading.Event()
+    errors = []
+
+    def build():
+        try:
+            while not stop.is_set():
+                check_order(conversation.to_message())
+                check_order(conversation.to_message(budget))
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    builders = [threading.Thread(target=build) for _ in range(2)]
+    for builder in builders:
+        builder.start()
+    for number in range(len(conversation.turns) // 3):
+        if stop.is_set():
+            break
+        assert conversation.replace_turns(conversation.oldest_turns(2), f"summary {number}") is not None
+    stop.set()
+    for builder in builders:
+        builder.join()
+    assert not errors, errors[0]
+
+
+@pytest.mark.parametrize("round", range(20))
+def test_summary_swapped_in_while_messages_are_built(frequent_switches, round):
+    conversation = Conversation()
+    conversation.add_turn("system", "role")
+    for number in range(2000):
+        conversation.add_turn("user" if number % 2 == 0 else "assistant", f"m{number}")
+
+    swap_summaries_while_building(conversation, conversation.total_tokens // 2)
+
+    # The cached list wasn't left built from turns that have since been replaced
+    assert conversation.to_message() == expected_messages(conversation)
+    conversation.add_turn("user", "m2000")
+    assert conversation.to_message() == expected_messages(conversation)
@@ -0,0 +1,204 @@
+"""Tests of conversations shared between threads, and between processes through a state backend
+
+Each ConversationStore opened on the same directory stands for a bot process;
+one test also runs a second real process."""
+
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+import botcommon
+import convstore
+from convstore import ConversationStore
+from statebackend import SQLiteStateBackend
+
+KEY = ("server", "author", "channel")
+
+
+@pytest.fixture
+def state_dir(tmp_path):
+    return str(tmp_path / "state")
+
+
+def open_store(state_dir, **options):
+    return ConversationStore(backend=SQLiteStateBackend(state_dir, 2), **options)
+
+
+def contents(conversation):
+    return [(turn.role, turn.content) for turn in conversation.turns]
+
+
+def take_turn(store, key, message):
+    conversation = botcommon.get_conversation(store, key)
+    conversation.add_turn("user", message)
+    conversation.add_turn("assistant", f"re: {message}")
+    store.commit(key)
+    return conversation
+
+
+def user_turns(conversation):
+    return [turn.content for turn in conversation.turns if turn.role == "user"]
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_threads_starting_a_conversation_get_the_same_one(state_dir, shared):
+    store = open_store(state_dir) if shared else ConversationStore()
+    start = threading.Barrier(4)
+    got = []
+
+    def load(conversation):
+        # Like reading the thread's history from Slack, slow enough for the others to ask meanwhile
+        time.sleep(0.05)
+
+    def ask():
+        start.wait()
+        got.append(botcommon.get_conversation(store, KEY, load, claim=True))
+
+    threads = [threading.Thread(target=ask) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(conversation) for conversation in got}) == 1
+    assert store.get(KEY) is got[0]
+    assert got[0].pending_turns == 4
+
+
+def test_get_picks_up_turns_written_elsewhere(state_dir):
+    first, second = open_store(state_dir), open_store(state_dir)
+    take_turn(first, KEY, "one")
+    take_turn(second, KEY, "two")
+    take_turn(first, KEY, "three")
+
+    assert user_turns(second.get(KEY)) == ["one", "two", "three"]
+    assert user_turns(first.get(KEY)) == ["one", "two", "three"]
+
+
+def test_commit_merges_turns_taken_on_a_stale_copy(state_dir):
+    first, second = open_store(state_dir), open_store(state_dir)
+    take_turn(first, KEY, "one")
+    stale = botcommon.get_conversation(second, KEY)
+
+    take_turn(first, KEY, "two")
+    # second hasn't seen "two" when it takes its turn
+    stale.add_turn("user", "three")
+    stale.add_turn("assistant", "re: three")
+    second.commit(KEY)
+
+    assert user_turns(stale) == ["one", "two", "three"]
+    assert contents(open_store(state_dir).get(KEY)) == contents(stale)
+    # first picks up the merged turns, and its next turn comes after them
+    take_turn(first, KEY, "four")
+    assert user_turns(open_store(state_dir).get(KEY)) == ["one", "two", "three", "four"]
+
+
+def test_clear_replaces_the_shared_copy(state_dir):
+    first, second = open_store(state_dir), open_store(state_dir)
+    take_turn(first, KEY, "one")
+    take_turn(second, KEY, "two")
+
+    # first clears without having seen "two"; the clear wins rather than being merged
+    conversation = first.get(KEY)
+    conversation.clear()
+    botcommon.set_system_role(conversation, "new role")
+    first.commit(KEY)
+
+    assert contents(open_store(state_dir).get(KEY)) == [("system", "new role")]
+    assert contents(second.get(KEY)) == [("system", "new role")]
+    take_turn(second, KEY, "three")
+    assert user_turns(first.get(KEY)) == ["three"]
+
+
+def summarize(conversation, count):
+    conversation.replace_turns(conversation.oldest_turns(count), f"{count} turns")
+
+
+def summary_contents(store):
+    return [content for _, content in contents(store.get(KEY))][1:]
+
+
+def test_summary_keeps_turns_written_elsewhere(state_dir):
+    first, second = open_store(state_dir), open_store(state_dir)
+    for message in ["a0", "a1", "a2"]:
+        take_turn(first, KEY, message)
+    stale = first.get(KEY)
+    take_turn(second, KEY, "b0")
+
+    # first summarizes without having seen "b0", then takes a turn
+    summarize(stale, 4)
+    stale.add_turn("user", "a3")
+    first.commit(KEY)
+
+    expected = ["Summary of the earlier conversation: 4 turns", "a2", "re: a2", "b0", "re: b0", "a3"]
+    assert summary_contents(open_store(state_dir)) == expected
+    assert summary_contents(second) == expected
+    assert summary_contents(first) == expected
+
+
+def test_summary_written_by_get(state_dir):
+    first, second = open_store(state_dir), open_store(state_dir)
+    for message in ["a0", "a1", "a2"]:
+        take_turn(first, KEY, message)
+    stale = first.get(KEY)
+    take_turn(second, KEY, "b0")
+    summarize(stale, 4)
+
+    # Reading the backend's newer copy doesn't undo the summary
+    assert user_turns(first.get(KEY)) == ["a2", "b0"]
+    assert user_turns(second.get(KEY)) == ["a2", "b0"]
+
+
+def test_summary_of_turns_changed_elsewhere_is_dropped(state_dir):
+    first, second = open_store(state_dir), open_store(state_dir)
+    for message in ["a0", "a1"]:
+        take_turn(first, KEY, message)
+    stale = first.get(KEY)
+    summarize(second.get(KEY), 2)
+    take_turn(second, KEY, "b0")
+
+    # first summarizes the same turns differently; its new turn is kept, its summary isn't
+    summarize(stale, 3)
+    stale.add_turn("user", "a2")
+    first.commit(KEY)
+
+    assert summary_contents(open_store(state_dir)) == [
+        "Summary of the earlier conversation: 2 turns", "a1", "re: a1", "b0", "re: b0", "a2"]
+
+
+# With one lock, evicting a conversation needs the lock already held for the conversation being got
+@pytest.mark.parametrize("locks", [convstore.SYNC_LOCKS, 1])
+def test_evicted_conversations_are_written_and_read_back(state_dir, monkeypatch, locks):
+    monkeypatch.setattr(convstore, "SYNC_LOCKS", locks)
+    store = open_store(state_dir, max_conversations=1)
+    take_turn(store, KEY, "one")
+    conversation = store.get(KEY)
+    conversation.add_turn("user", "not yet committed")
+    take_turn(store, ("other",), "two")
+
+    assert [key for key, _ in store.resident_items()] == [("other",)]
+    assert user_turns(store.get(KEY)) == ["one", "not yet committed"]
+
+
+def add_turns(state_dir, name, count):
+    store = open_store(state_dir)
+    for index in range(count):
+        take_turn(store, KEY, f"{name}{index}")
+
+
+def test_concurrent_processes_lose_no_turns(state_dir):
+    botcommon.get_conversation(open_store(state_dir), KEY)
+    context = multiprocessing.get_context("spawn")
+    other = context.Process(target=add_turns, args=(state_dir, "b", 50))
+    other.start()
+    add_turns(state_dir, "a", 50)
+    other.join()
+    assert other.exitcode == 0
+
+    turns = user_turns(open_store(state_dir).get(KEY))
+    assert sorted(turns) == sorted([f"a{index}" for index in range(50)] + [f"b{index}" for index in range(50)])
+    # Each process's turns stay in the order it took them
+    for name in "ab":
+        assert [turn for turn in turns if turn[0] == name] == [f"{name}{index}" for index in range(50)]
@@ -0,0 +1,206 @@
+"""Tests of the request scheduler's pacing, fair sharing, retries and accounting
+
+The retry and fake API stream tests send real requests to the fake API in benchmarks/fakeopenai.py,
+so they need the openai package."""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import fakeopenai
+import metrics
+from scheduler import RequestScheduler, parse_duration
+
+
+def empty_scheduler(model, rpm, tpm=0):
+    """Scheduler whose request bucket for model starts empty, so every request is paced"""
+    scheduler = RequestScheduler(limits={model: (rpm, tpm)})
+    scheduler._state(model).requests = 0
+    return scheduler
+
+
+def test_parse_duration():
+    assert parse_duration("1s") == 1
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration(None) == 0
+
+
+def test_paces_requests_to_rpm():
+    # 600 requests a minute is one every 0.1s
+    scheduler = empty_scheduler("m", 600)
+    start = time.monotonic()
+    for _ in range(3):
+        scheduler.acquire("m")
+    assert time.monotonic() - start >= 0.28
+
+
+def test_paces_async_requests_to_rpm():
+    scheduler = empty_scheduler("m", 600)
+
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(*(scheduler.aacquire("m", user=f"user{i}") for i in range(3)))
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.28
+
+
+def test_paces_tokens_to_tpm():
+    scheduler = RequestScheduler(limits={"m": (10 ** 6, 6000)})
+    scheduler.acquire("m", tokens=6000)
+    start = time.monotonic()
+    # 6000 tokens a minute is 100 a second
+    scheduler.acquire("m", tokens=30)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_oversized_request_waits_for_a_full_bucket():
+    scheduler = RequestScheduler(limits={"m": (10 ** 6, 6000)})
+    start = time.monotonic()
+    scheduler.acquire("m", tokens=10 ** 6)
+    assert time.monotonic() - start < 0.1
+
+
+def test_serves_users_round_robin():
+    scheduler = empty_scheduler("m", 600)
+    state = scheduler._state("m")
+    order = []
+    lock = threading.Lock()
+
+    def request(user):
+        scheduler.acquire("m", user=user)
+        with lock:
+            order.append(user)
+
+    threads = []
+    # A busy user queues three requests before a quiet one queues its only one
+    for user in ["busy", "busy", "busy", "quiet"]:
+        queued = len(state.queues.get(user, ()))
+        thread = threading.Thread(target=request, args=(user,))
+        thread.start()
+        threads.append(thread)
+        while len(state.queues.get(user, ())) == queued:
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+    assert order == ["busy", "quiet", "busy", "busy"]
+
+
+class RawResponse:
+    """Stands in for a raw API response"""
+
+    headers = {}
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+
+    def parse(self):
+        return self.parsed
+
+
+def stream_events(usage, delay):
+    """Events of a streamed response taking delay seconds, ending with one carrying its usage"""
+    for word in ["one", " two"]:
+        time.sleep(delay / 2)
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))], usage=None)
+    yield SimpleNamespace(choices=[], usage=usage)
+
+
+def request_seconds(model):
+    return metrics.registry.histograms["openai_request_seconds"][(("model", model),)]
+
+
+def test_stream_usage_settles_the_token_bucket():
+    scheduler = RequestScheduler(limits={"stream": (10 ** 6, 60000)})
+    usage = SimpleNamespace(prompt_tokens=100, completion_tokens=1900, total_tokens=2000)
+    events = scheduler.call("stream", lambda: RawResponse(stream_events(usage, 0.2)), tokens=500)
+    assert scheduler._state("stream").tokens == pytest.approx(60000 - 500, abs=100)
+
+    assert [event.choices[0].delta.content for event in events if event.choices] == ["one", " two"]
+    # The estimate of 500 tokens was corrected to the 2000 used
+    assert scheduler._state("stream").tokens == pytest.approx(60000 - 2000, abs=100)
+    # The request took as long as the whole stream, not just until its headers arrived
+    assert request_seconds("stream").sum >= 0.2
+
+
+def test_async_stream_usage_settles_the_token_bucket():
+    scheduler = RequestScheduler(limits={"astream": (10 ** 6, 60000)})
+    usage = SimpleNamespace(prompt_tokens=100, completion_tokens=1900, total_tokens=2000)
+
+    async def events():
+        for event in stream_events(usage, 0):
+            yield event
+
+    async def request():
+        return RawResponse(events())
+
+    async def run():
+        stream = await scheduler.acall("astream", request, tokens=500)
+        return [event async for event in stream]
+
+    assert len(asyncio.run(run())) == 3
+    assert scheduler._state("astream").tokens == pytest.approx(60000 - 2000, abs=100)
+
+
+@pytest.fixture
+def fake_api():
+    server, url = fakeopenai.start_server()
+    yield server, url
+    server.shutdown()
+
+
+def raw_request(url):
+    openai = pytest.importorskip("openai")
+    client = openai.OpenAI(base_url=url, api_key="unused", max_retries=0)
+    return lambda: client.chat.completions.with_raw_response.create(
+        model="gpt-4", messages=[{"role": "user", "content": "hello"}])
+
+
+def test_retries_after_rate_limit(fake_api):
+    server, url = fake_api
+    request = raw_request(url)
+    # The fake's requests for the last minute are used up, the oldest almost a minute ago
+    server.fake.rpm = 100
+    server.fake.recent.extend([time.monotonic() - 59.5] * 100)
+    scheduler = RequestScheduler(limits={"gpt-4": (10 ** 6, 0)}, base_delay=0.1)
+
+    start = time.monotonic()
+    response = scheduler.call("gpt-4", request)
+    assert response.choices[0].message.content
+    assert server.fake.rejected == 1
+    assert server.fake.requests == 2
+    # The Retry-After sent with the 429 was honoured
+    assert time.monotonic() - start >= 0.4
+    # The limits were picked up from the 429's headers
+    assert scheduler._state("gpt-4").rpm == 100
+
+
+def test_gives_up_after_max_retries(fake_api):
+    server, url = fake_api
+    request = raw_request(url)
+    import openai
+    server.fake.fail_rate = 1.0
+    scheduler = RequestScheduler(max_retries=2, base_delay=0.01)
+
+    with pytest.raises(openai.InternalServerError):
+        scheduler.call("gpt-4", request)
+    assert server.fake.requests == 3
+
+
+def test_records_usage_of_fake_api_stream(fake_api):
+    server, url = fake_api
+    openai = pytest.importorskip("openai")
+    client = openai.OpenAI(base_url=url, api_key="unused", max_retries=0)
+    scheduler = RequestScheduler()
+    before = metrics.registry.histograms.get("openai_prompt_tokens", {}).get((("model", "gpt-4"),))
+    before = before.count if before else 0
+
+    stream = scheduler.call("gpt-4", lambda: client.chat.completions.with_raw_response.create(
+        model="gpt-4", messages=[{"role": "user", "content": "hello"}], stream=True,
+        stream_options={"include_usage": True}))
+    assert "".join(event.choices[0].delta.content or "" for event in stream if event.choices)
+    assert metrics.registry.histograms["openai_prompt_tokens"][(("model", "gpt-4"),)].count == before + 1